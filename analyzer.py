@@ -2,61 +2,240 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import json
-import codecs
+import itertools
+import os
+import time
 import tqdm
 
+import concurrent.futures
+
 from collections import Counter
 from datetime import datetime
 
+import serializer
+
+from columnar_export import ColumnarExport
+from manifest_store import JournalManifestStore, ManifestStore, open_store
+from post import Post
+
+# Posts hold only the fields that are counted
+read_post = Post.reader(['shortcode', 'is_ad', 'tags', 'location'])
+
 class Analyzer(object):
+  POSTS_PER_SHARD = 5000 # for manifests that cannot be split by byte range
+
   def __init__(self, **kwargs):
     """
     initializes:
       self.manifest_path
       self.output_path
-      self.manifest
+      self.shards
+      self.cache_path
+      self.manifest_store
+      self.columnar_export
     """
     # Load arguments as instance variables
     for key, value in kwargs.iteritems():
       self.__dict__[key] = value
 
-    self.__load_manifest()
+    self.__open_manifest()
 
   def analyze(self):
-    if self.manifest:
-      hashtags_counter = Counter()
-      locations_counter = Counter()
-      
-      for shortcode, post in tqdm.tqdm(self.manifest.iteritems(), total=len(self.manifest), desc='Analyzing manifest'):
-        # filter
-        if post['is_ad']:
-          continue
-
-        hashtags_counter.update([tag.lower() for tag in post['tags']])
-        if post['location']:
-          pair = (post['location']['id'], post['location']['name'])
-          locations_counter.update([pair])
-      
-      self.__write_output(hashtags_counter, locations_counter)
+    """
+    Counts hashtags and locations over manifest, in parallel if more than one shard was requested
+    Journal counts are cached, so later runs only count the lines appended since
+    A columnar export is counted from its tags and posts columns alone
+    """
+    timings = []
+    start_time = time.time()
+    if self.columnar_export:
+      post_count, hashtags_counter, locations_counter = self.__count_columns(timings)
+    elif isinstance(self.manifest_store, JournalManifestStore):
+      post_count, hashtags_counter, locations_counter = self.__count_journal(timings)
+    elif self.shards > 1:
+      post_count, hashtags_counter, locations_counter = self.__count_post_shards(timings)
+    else:
+      # Posts are streamed from manifest, so memory does not grow with it
+      posts = tqdm.tqdm(self.manifest_store.iter_posts(read_post), desc='Analyzing manifest', unit=' posts')
+      post_count, hashtags_counter, locations_counter = count_posts(posts)
+      timings.append(('count', time.time() - start_time))
+
+    print 'Analyzed {0} posts in {1} shards:'.format(post_count, self.shards)
+    for phase, seconds in timings + [('total', time.time() - start_time)]:
+      print '  {0:<8} {1:.2f}s'.format(phase, seconds)
+
+    if post_count:
+      self.__write_output(post_count, hashtags_counter, locations_counter)
       print 'Analysis complete! Output written to', self.output_path
     else:
       print 'No analytics to be done. Program will now exit'
 
   ######## PRIVATE METHODDS ####################################################
-  def __load_manifest(self):
-    """Loads json manifest and assign to self.manifest"""
-    try:
-      with open(self.manifest_path) as f:
-        self.manifest = json.load(f) # load previous manifest if exists
-    except:
+  def __open_manifest(self):
+    """
+    Opens manifest for streaming and assign its store to self.manifest_store
+    A directory holding a columnar export of manifest is assigned to self.columnar_export instead
+    """
+    self.manifest_store = None
+    self.columnar_export = None
+    if os.path.isdir(self.manifest_path) and ColumnarExport(self.manifest_path).format():
+      self.columnar_export = ColumnarExport(self.manifest_path)
+      return
+    if not os.path.isfile(self.manifest_path):
       print 'Manifest not found'
-      self.manifest = json.loads("{}") # else use empty manifest
+    self.manifest_store = open_store(self.manifest_path) # streams no posts if manifest not found
+
+  def __count_columns(self, timings):
+    """Counts posts of columnar export as count_posts does, reading only the columns it needs"""
+    phase_start_time = time.time()
+    posts = self.columnar_export.read_columns('posts', ['shortcode', 'is_ad', 'location_id', 'location_name'])
+    tags = self.columnar_export.read_columns('tags', ['post_shortcode', 'tag'])
+    timings.append(('load', time.time() - phase_start_time))
+
+    phase_start_time = time.time()
+    ads = set(shortcode for shortcode, is_ad in itertools.izip(posts['shortcode'], posts['is_ad']) if is_ad)
+    if ads:
+      hashtags_counter = Counter(tag.lower() for shortcode, tag in itertools.izip(tags['post_shortcode'], tags['tag']) if shortcode not in ads)
+    else:
+      hashtags_counter = Counter(tag.lower() for tag in tags['tag'])
+    locations_counter = Counter(
+      (location_id, name)
+      for location_id, name, is_ad in itertools.izip(posts['location_id'], posts['location_name'], posts['is_ad'])
+      if location_id is not None and not is_ad
+    )
+    timings.append(('count', time.time() - phase_start_time))
+    return len(posts['shortcode']), hashtags_counter, locations_counter
 
-  def __write_output(self, hashtags_counter, locations_counter):
+  def __count_journal(self, timings):
+    """
+    Counts journal lines past the cached watermark, split into one byte range per shard, and folds them into the
+    cached aggregates. Lines superseded by a later line of the same post are counted again and subtracted
+    """
+    if not os.path.isfile(self.manifest_path):
+      return 0, Counter(), Counter()
+    phase_start_time = time.time()
+    stat = os.stat(self.manifest_path) # the journal as counted, which the scraper may compact meanwhile
+    cache = self.__load_cache(stat)
+    post_count, hashtags_counter, locations_counter = cache['counts']
+    last_offsets = cache['offsets'] # journal offset of the last counted line of each shortcode
+    start = cache['watermark']
+    size = stat.st_size
+    timings.append(('load', time.time() - phase_start_time))
+
+    phase_start_time = time.time()
+    bounds = [start + (size - start) * i // self.shards for i in range(self.shards + 1)]
+    if self.shards > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=self.shards) as executor:
+        results = list(executor.map(count_journal_range, itertools.repeat(self.manifest_path), bounds[:-1], bounds[1:]))
+    else:
+      results = [count_journal_range(self.manifest_path, start, size)]
+    timings.append(('count', time.time() - phase_start_time))
+
+    phase_start_time = time.time()
+    superseded = []
+    watermark = max([start] + [result[5] for result in results if result[5] is not None])
+    for shard_post_count, shard_hashtags_counter, shard_locations_counter, shard_offsets, shard_superseded, _ in results: # shards are in file order
+      post_count += shard_post_count
+      hashtags_counter.update(shard_hashtags_counter)
+      locations_counter.update(shard_locations_counter)
+      superseded.extend(shard_superseded)
+      for shortcode, offset in shard_offsets.iteritems():
+        if shortcode in last_offsets:
+          superseded.append(last_offsets[shortcode])
+        last_offsets[shortcode] = offset
+    if superseded:
+      superseded_post_count, superseded_hashtags_counter, superseded_locations_counter = \
+        count_posts(read_journal_lines(self.manifest_path, sorted(superseded)))
+      post_count -= superseded_post_count
+      hashtags_counter = subtract(hashtags_counter, superseded_hashtags_counter)
+      locations_counter = subtract(locations_counter, superseded_locations_counter)
+    timings.append(('merge', time.time() - phase_start_time))
+
+    phase_start_time = time.time()
+    self.__write_cache(stat, watermark, (post_count, hashtags_counter, locations_counter), last_offsets)
+    timings.append(('cache', time.time() - phase_start_time))
+    return post_count, hashtags_counter, locations_counter
+
+  def __count_post_shards(self, timings):
+    """Counts manifest streamed into shards of POSTS_PER_SHARD posts on a process pool and merges the counts"""
+    phase_start_time = time.time()
+    counts = []
+    pending = set()
+    posts = self.manifest_store.iter_posts(read_post)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=self.shards) as executor:
+      while True:
+        shard = list(itertools.islice(posts, Analyzer.POSTS_PER_SHARD))
+        if not shard:
+          break
+        pending.add(executor.submit(count_posts, shard))
+        if len(pending) >= 2 * self.shards: # bound shards held in memory
+          done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+          counts.extend(future.result() for future in done)
+      counts.extend(future.result() for future in concurrent.futures.as_completed(pending))
+    timings.append(('count', time.time() - phase_start_time))
+
+    phase_start_time = time.time()
+    post_count, hashtags_counter, locations_counter = 0, Counter(), Counter()
+    for shard_post_count, shard_hashtags_counter, shard_locations_counter in counts:
+      post_count += shard_post_count
+      hashtags_counter.update(shard_hashtags_counter)
+      locations_counter.update(shard_locations_counter)
+    timings.append(('merge', time.time() - phase_start_time))
+    return post_count, hashtags_counter, locations_counter
+
+  def __load_cache(self, stat):
+    """
+    Returns cached aggregates of journal with given stat if they are still valid for it, else empty ones
+    The cache is invalid once the journal was replaced (e.g. compacted) or truncated below its watermark
+    """
+    empty_cache = {'watermark': 0, 'counts': (0, Counter(), Counter()), 'offsets': {}}
+    if not self.cache_path or not os.path.isfile(self.cache_path):
+      return empty_cache
+    with open(self.cache_path, 'rb') as f:
+      cache = serializer.load(f)
+    if cache['manifest_path'] != os.path.abspath(self.manifest_path) or cache['inode'] != stat.st_ino \
+        or cache['watermark'] > stat.st_size:
+      print 'Analysis cache is stale; counting from scratch'
+      return empty_cache
+    print 'Counting posts added since last analysis'
+    return {
+      'watermark': cache['watermark'],
+      'counts': (
+        cache['post_count'],
+        Counter(cache['hashtags']),
+        Counter(dict(((location_id, name), count) for location_id, name, count in cache['locations']))
+      ),
+      'offsets': cache['offsets']
+    }
+
+  def __write_cache(self, stat, watermark, counts, offsets):
+    """
+    Saves aggregates of journal up to byte offset watermark, with the offsets of the lines counted in them
+    Nothing is saved if the journal, whose stat was taken before counting, was replaced meanwhile, e.g. compacted,
+    as the offsets are of the replaced file
+    """
+    if not self.cache_path:
+      return
+    if os.stat(self.manifest_path).st_ino != stat.st_ino:
+      print 'Manifest was compacted during analysis; not caching its counts'
+      return
+    post_count, hashtags_counter, locations_counter = counts
+    cache = {
+      'manifest_path': os.path.abspath(self.manifest_path),
+      'inode': stat.st_ino,
+      'watermark': watermark,
+      'post_count': post_count,
+      'hashtags': hashtags_counter,
+      'locations': [[location_id, name, count] for (location_id, name), count in locations_counter.iteritems()],
+      'offsets': offsets
+    }
+    with ManifestStore.atomic_writer(self.cache_path) as f:
+      serializer.dump(cache, f)
+
+  def __write_output(self, post_count, hashtags_counter, locations_counter):
     with open(self.output_path, 'w') as o:
       o.write('#################### ANALYZED ON {0} ####################\n'.format(str(datetime.now())))
-      o.write('{0} posts analyzed\n'.format(len(self.manifest)))
+      o.write('{0} posts analyzed\n'.format(post_count))
       if hashtags_counter:
         o.write('\n-------------------------- HASHTAGS --------------------------\n')
         o.write('{0} unique hashtags:\n'.format(len(hashtags_counter)))
@@ -68,13 +247,77 @@ class Analyzer(object):
         for location, count in locations_counter.most_common():
           o.write('{0}, {1} : {2}\n'.format(location[0], location[1].encode('utf-8'), count))
 
+######## SHARD WORKERS #########################################################
+def count_posts(posts):
+  """Returns (post count, hashtags counter, locations counter) over given Post records, leaving out ads"""
+  post_count = 0
+  hashtags_counter = Counter()
+  locations_counter = Counter()
+  for post in posts:
+    post_count += 1
+    # filter
+    if post.is_ad:
+      continue
+
+    hashtags_counter.update([tag.lower() for tag in post.tags])
+    if post.location:
+      pair = (post.location.id, post.location.name)
+      locations_counter.update([pair])
+  return post_count, hashtags_counter, locations_counter
+
+def count_journal_range(path, start, end):
+  """
+  Counts posts of journal lines starting within byte range [start, end)
+  Returns counts as count_posts does, plus the offset of the last line of each shortcode, the offsets of
+  lines superseded within the range and the end offset of the last line counted (None if there was none)
+  """
+  offsets = {}
+  superseded = []
+  watermark = [None]
+
+  def posts(f):
+    while f.tell() < end:
+      offset = f.tell()
+      line = f.readline()
+      if not line.endswith('\n'):
+        break # torn write from a crash during commit
+      watermark[0] = f.tell()
+      if not line.strip():
+        continue
+      post = read_post(serializer.loads(line))
+      if post.shortcode in offsets:
+        superseded.append(offsets[post.shortcode])
+      offsets[post.shortcode] = offset
+      yield post
+
+  with open(path, 'rb') as f:
+    if start:
+      f.seek(start - 1)
+      f.readline() # skip to first line starting in range
+    post_count, hashtags_counter, locations_counter = count_posts(posts(f))
+  return post_count, hashtags_counter, locations_counter, offsets, superseded, watermark[0]
+
+def read_journal_lines(path, offsets):
+  """Yields posts of journal lines at given offsets"""
+  with open(path, 'rb') as f:
+    for offset in offsets:
+      f.seek(offset)
+      yield read_post(serializer.loads(f.readline()))
+
+def subtract(counter, other):
+  """Returns counter less the counts of other, without the keys whose count drops to zero"""
+  counter.subtract(other)
+  return Counter(dict((key, count) for key, count in counter.iteritems() if count > 0))
+
 def main():
   parser = argparse.ArgumentParser(
     description="Analyzes scraped posts information from the manifest",
     formatter_class=argparse.RawDescriptionHelpFormatter
   )
-  parser.add_argument('--manifest-path', '-mp', default='./manifest.json', help='Path for JSON manifest file')
+  parser.add_argument('--manifest-path', '-mp', default='./manifest.jsonl', help='Path for manifest file (.jsonl journal or .json file), or directory of its columnar export')
   parser.add_argument('--output-path', '-o', default='./output.txt', help='Path for analyzed output to be written to')
+  parser.add_argument('--shards', '-s', type=int, default=1, help='Number of shards counted in parallel processes. 1 counts serially')
+  parser.add_argument('--cache-path', '-cp', default='./analysis_cache.json', help='Path for aggregates cached between analyses of a .jsonl manifest. Empty to always count from scratch')
 
   args = parser.parse_args()
   analyzer = Analyzer(**vars(args))
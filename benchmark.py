@@ -0,0 +1,340 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import requests
+
+import serializer
+import tag_tokenizer
+
+from jinstascrape import JinstaScrape
+from manifest_store import open_store
+from post import Post, as_dict
+from replay_server import ReplayServer, _synthetic_post_node, generate_fixtures
+from session_pool import SessionPool
+
+######## HASHTAG EXTRACTION ####################################################
+# extract_tags as it was before tag_tokenizer, kept as the baseline
+LEGACY_TAG_PATTERN = r"(?<!&)#(\w+|(?:[\xA9\xAE\u203C\u2049\u2122\u2139\u2194-\u2199\u21A9\u21AA\u231A\u231B\u2328\u2388\u23CF\u23E9-\u23F3\u23F8-\u23FA\u24C2\u25AA\u25AB\u25B6\u25C0\u25FB-\u25FE\u2600-\u2604\u260E\u2611\u2614\u2615\u2618\u261D\u2620\u2622\u2623\u2626\u262A\u262E\u262F\u2638-\u263A\u2648-\u2653\u2660\u2663\u2665\u2666\u2668\u267B\u267F\u2692-\u2694\u2696\u2697\u2699\u269B\u269C\u26A0\u26A1\u26AA\u26AB\u26B0\u26B1\u26BD\u26BE\u26C4\u26C5\u26C8\u26CE\u26CF\u26D1\u26D3\u26D4\u26E9\u26EA\u26F0-\u26F5\u26F7-\u26FA\u26FD\u2702\u2705\u2708-\u270D\u270F\u2712\u2714\u2716\u271D\u2721\u2728\u2733\u2734\u2744\u2747\u274C\u274E\u2753-\u2755\u2757\u2763\u2764\u2795-\u2797\u27A1\u27B0\u27BF\u2934\u2935\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55\u3030\u303D\u3297\u3299]|\uD83C[\uDC04\uDCCF\uDD70\uDD71\uDD7E\uDD7F\uDD8E\uDD91-\uDD9A\uDE01\uDE02\uDE1A\uDE2F\uDE32-\uDE3A\uDE50\uDE51\uDF00-\uDF21\uDF24-\uDF93\uDF96\uDF97\uDF99-\uDF9B\uDF9E-\uDFF0\uDFF3-\uDFF5\uDFF7-\uDFFF]|\uD83D[\uDC00-\uDCFD\uDCFF-\uDD3D\uDD49-\uDD4E\uDD50-\uDD67\uDD6F\uDD70\uDD73-\uDD79\uDD87\uDD8A-\uDD8D\uDD90\uDD95\uDD96\uDDA5\uDDA8\uDDB1\uDDB2\uDDBC\uDDC2-\uDDC4\uDDD1-\uDDD3\uDDDC-\uDDDE\uDDE1\uDDE3\uDDEF\uDDF3\uDDFA-\uDE4F\uDE80-\uDEC5\uDECB-\uDED0\uDEE0-\uDEE5\uDEE9\uDEEB\uDEEC\uDEF0\uDEF3]|\uD83E[\uDD10-\uDD18\uDD80-\uDD84\uDDC0]|(?:0\u20E3|1\u20E3|2\u20E3|3\u20E3|4\u20E3|5\u20E3|6\u20E3|7\u20E3|8\u20E3|9\u20E3|#\u20E3|\\*\u20E3|\uD83C(?:\uDDE6\uD83C(?:\uDDEB|\uDDFD|\uDDF1|\uDDF8|\uDDE9|\uDDF4|\uDDEE|\uDDF6|\uDDEC|\uDDF7|\uDDF2|\uDDFC|\uDDE8|\uDDFA|\uDDF9|\uDDFF|\uDDEA)|\uDDE7\uD83C(?:\uDDF8|\uDDED|\uDDE9|\uDDE7|\uDDFE|\uDDEA|\uDDFF|\uDDEF|\uDDF2|\uDDF9|\uDDF4|\uDDE6|\uDDFC|\uDDFB|\uDDF7|\uDDF3|\uDDEC|\uDDEB|\uDDEE|\uDDF6|\uDDF1)|\uDDE8\uD83C(?:\uDDF2|\uDDE6|\uDDFB|\uDDEB|\uDDF1|\uDDF3|\uDDFD|\uDDF5|\uDDE8|\uDDF4|\uDDEC|\uDDE9|\uDDF0|\uDDF7|\uDDEE|\uDDFA|\uDDFC|\uDDFE|\uDDFF|\uDDED)|\uDDE9\uD83C(?:\uDDFF|\uDDF0|\uDDEC|\uDDEF|\uDDF2|\uDDF4|\uDDEA)|\uDDEA\uD83C(?:\uDDE6|\uDDE8|\uDDEC|\uDDF7|\uDDEA|\uDDF9|\uDDFA|\uDDF8|\uDDED)|\uDDEB\uD83C(?:\uDDF0|\uDDF4|\uDDEF|\uDDEE|\uDDF7|\uDDF2)|\uDDEC\uD83C(?:\uDDF6|\uDDEB|\uDDE6|\uDDF2|\uDDEA|\uDDED|\uDDEE|\uDDF7|\uDDF1|\uDDE9|\uDDF5|\uDDFA|\uDDF9|\uDDEC|\uDDF3|\uDDFC|\uDDFE|\uDDF8|\uDDE7)|\uDDED\uD83C(?:\uDDF7|\uDDF9|\uDDF2|\uDDF3|\uDDF0|\uDDFA)|\uDDEE\uD83C(?:\uDDF4|\uDDE8|\uDDF8|\uDDF3|\uDDE9|\uDDF7|\uDDF6|\uDDEA|\uDDF2|\uDDF1|\uDDF9)|\uDDEF\uD83C(?:\uDDF2|\uDDF5|\uDDEA|\uDDF4)|\uDDF0\uD83C(?:\uDDED|\uDDFE|\uDDF2|\uDDFF|\uDDEA|\uDDEE|\uDDFC|\uDDEC|\uDDF5|\uDDF7|\uDDF3)|\uDDF1\uD83C(?:\uDDE6|\uDDFB|\uDDE7|\uDDF8|\uDDF7|\uDDFE|\uDDEE|\uDDF9|\uDDFA|\uDDF0|\uDDE8)|\uDDF2\uD83C(?:\uDDF4|\uDDF0|\uDDEC|\uDDFC|\uDDFE|\uDDFB|\uDDF1|\uDDF9|\uDDED|\uDDF6|\uDDF7|\uDDFA|\uDDFD|\uDDE9|\uDDE8|\uDDF3|\uDDEA|\uDDF8|\uDDE6|\uDDFF|\uDDF2|\uDDF5|\uDDEB)|\uDDF3\uD83C(?:\uDDE6|\uDDF7|\uDDF5|\uDDF1|\uDDE8|\uDDFF|\uDDEE|\uDDEA|\uDDEC|\uDDFA|\uDDEB|\uDDF4)|\uDDF4\uD83C\uDDF2|\uDDF5\uD83C(?:\uDDEB|\uDDF0|\uDDFC|\uDDF8|\uDDE6|\uDDEC|\uDDFE|\uDDEA|\uDDED|\uDDF3|\uDDF1|\uDDF9|\uDDF7|\uDDF2)|\uDDF6\uD83C\uDDE6|\uDDF7\uD83C(?:\uDDEA|\uDDF4|\uDDFA|\uDDFC|\uDDF8)|\uDDF8\uD83C(?:\uDDFB|\uDDF2|\uDDF9|\uDDE6|\uDDF3|\uDDE8|\uDDF1|\uDDEC|\uDDFD|\uDDF0|\uDDEE|\uDDE7|\uDDF4|\uDDF8|\uDDED|\uDDE9|\uDDF7|\uDDEF|\uDDFF|\uDDEA|\uDDFE)|\uDDF9\uD83C(?:\uDDE9|\uDDEB|\uDDFC|\uDDEF|\uDDFF|\uDDED|\uDDF1|\uDDEC|\uDDF0|\uDDF4|\uDDF9|\uDDE6|\uDDF3|\uDDF7|\uDDF2|\uDDE8|\uDDFB)|\uDDFA\uD83C(?:\uDDEC|\uDDE6|\uDDF8|\uDDFE|\uDDF2|\uDDFF)|\uDDFB\uD83C(?:\uDDEC|\uDDE8|\uDDEE|\uDDFA|\uDDE6|\uDDEA|\uDDF3)|\uDDFC\uD83C(?:\uDDF8|\uDDEB)|\uDDFD\uD83C\uDDF0|\uDDFE\uD83C(?:\uDDF9|\uDDEA)|\uDDFF\uD83C(?:\uDDE6|\uDDF2|\uDDFC))))[\ufe00-\ufe0f\u200d]?)+"
+
+def legacy_extract_tags(text):
+  """Extracts the hashtags from given text with the legacy surrogate pair regex"""
+  tags = re.findall(LEGACY_TAG_PATTERN, text, re.UNICODE)
+  return list(set(tags))
+
+def synthetic_captions(count):
+  """Returns count captions mixing words, emoji and hashtags; a third of them carry no hashtag"""
+  random.seed(0)
+  words = [u'sunset', u'love', u'caf\xe9', u'東京', u'instagood', u'photo', u'friends', u'&#128525;']
+  emoji = [u'\U0001F600', u'❤️', u'\U0001F1F8\U0001F1EC', u'\U0001F355', u'☀']
+  captions = []
+  for i in range(count):
+    tokens = [random.choice(words) for _ in range(random.randint(5, 40))]
+    tokens += [random.choice(emoji) for _ in range(random.randint(0, 5))]
+    if i % 3:
+      tokens += [u'#' + random.choice(words + emoji) for _ in range(random.randint(1, 25))]
+    random.shuffle(tokens)
+    captions.append(u' '.join(tokens))
+  return captions
+
+def manifest_captions(manifest_path, count):
+  """Returns up to count captions streamed from manifest"""
+  captions = []
+  for post in open_store(manifest_path).iter_posts():
+    captions.append(post['caption']['text'])
+    if len(captions) >= count:
+      break
+  return captions
+
+def benchmark_tags(args):
+  """Times legacy and tokenizer hashtag extraction over the same captions"""
+  if args.manifest_path:
+    captions = manifest_captions(args.manifest_path, args.count)
+  else:
+    captions = synthetic_captions(args.count)
+  print 'Extracting hashtags from {0} captions, best of {1} runs'.format(len(captions), args.repeat)
+
+  candidates = [
+    ('legacy extract_tags', lambda: [legacy_extract_tags(text) for text in captions]),
+    ('extract_tags', lambda: [tag_tokenizer.extract_tags(text) for text in captions]),
+    ('extract_tags_batch', lambda: tag_tokenizer.extract_tags_batch(captions))
+  ]
+  baseline = None
+  for name, run in candidates:
+    seconds = min(timeit.repeat(run, number=1, repeat=args.repeat))
+    baseline = baseline or seconds
+    print '  {0:<20} {1:8.2f}us/caption {2:6.2f}x'.format(name, seconds / len(captions) * 1e6, baseline / seconds)
+
+  differing = sum(
+    set(legacy_extract_tags(text)) != set(tag_tokenizer.extract_tags(text))
+    for text in captions
+  )
+  print '{0} captions tagged differently than legacy (e.g. astral emoji on wide builds)'.format(differing)
+
+######## JSON ENCODING AND DECODING ##########################################
+def synthetic_posts(count):
+  """Returns count posts processed from synthetic post nodes, as Post records"""
+  rng = random.Random(0)
+  return [JinstaScrape.process_post(_synthetic_post_node('bench{0:07d}'.format(i), rng)) for i in range(count)]
+
+def legacy_dumps(manifest):
+  """Encodes manifest as ManifestStore.commit did before serializer: indented, with non-ASCII kept as is"""
+  return json.dumps(manifest, indent=2, ensure_ascii=False, default=as_dict).encode('utf-8')
+
+def replayed_response(content):
+  """Returns a requests response holding given JSON body, as received from a server"""
+  response = requests.models.Response()
+  response.status_code = 200
+  response.headers['Content-Type'] = 'application/json'
+  response._content = content
+  return response
+
+def benchmark_json(args):
+  """Times manifest encoding and decoding through every installed serializer backend, against the legacy encoding"""
+  if args.manifest_path:
+    posts = list(open_store(args.manifest_path).iter_posts(Post.from_dict))[:args.count]
+  else:
+    posts = synthetic_posts(args.count)
+  manifest = dict((post.shortcode, post) for post in posts)
+  print 'Encoding and decoding {0} posts, best of {1} runs. Installed backends: {2}'.format(
+    len(posts), args.repeat, ', '.join(serializer.BACKENDS))
+  best = lambda run: min(timeit.repeat(run, number=1, repeat=args.repeat))
+
+  encoded = legacy_dumps(manifest)
+  print '  {0:<11} pretty   encode {1:7.2f}us/post {2:8.1f}MB'.format(
+    'legacy', best(lambda: legacy_dumps(manifest)) / len(posts) * 1e6, len(encoded) / float(1 << 20))
+  del encoded
+  body = json.dumps({'graphql': {'shortcode_media': _synthetic_post_node('response', random.Random(0))}})
+  responses = [replayed_response(body) for _ in range(len(posts))]
+  for backend in serializer.BACKENDS:
+    serializer.use(backend)
+    lines = [serializer.dumps(as_dict(post)) for post in posts]
+    pretty = serializer.dumps(dict((shortcode, as_dict(post)) for shortcode, post in manifest.iteritems()), pretty=True)
+    for label, size, encode, decode in [
+      ('compact', sum(len(line) + 1 for line in lines),
+        lambda: [serializer.dumps(as_dict(post)) for post in posts],
+        lambda: [Post.from_dict(serializer.loads(line)) for line in lines]),
+      ('pretty', len(pretty),
+        lambda: serializer.dumps(dict((shortcode, as_dict(post)) for shortcode, post in manifest.iteritems()), pretty=True),
+        lambda: [Post.from_dict(post) for post in serializer.loads(pretty).itervalues()])
+    ]:
+      print '  {0:<11} {1:<8} encode {2:7.2f}us/post {3:8.1f}MB, decode {4:7.2f}us/post'.format(
+        backend, label, best(encode) / len(posts) * 1e6, size / float(1 << 20), best(decode) / len(posts) * 1e6)
+  print 'Decoding {0} response bodies of {1} bytes:'.format(len(responses), len(body))
+  print '  {0:<20} {1:7.2f}us/response'.format('response.json()',
+    best(lambda: [response.json() for response in responses]) / len(responses) * 1e6)
+  for backend in serializer.BACKENDS:
+    serializer.use(backend)
+    print '  {0:<20} {1:7.2f}us/response'.format(backend + ' loads(content)',
+      best(lambda: [serializer.loads(response.content) for response in responses]) / len(responses) * 1e6)
+
+######## SCRAPE AND DOWNLOAD THROUGHPUT #######################################
+UNPACED = 1e9 # requests per second and burst size that never throttle
+
+def benchmark_scrape(args):
+  """Times scrape(), the media downloads and the conditional refresh that follow against a local replay server"""
+  work_directory = tempfile.mkdtemp(prefix='jinstascrape-benchmark-')
+  try:
+    fixtures_directory = args.fixtures_directory
+    if fixtures_directory:
+      hashtags = sorted(os.listdir(os.path.join(fixtures_directory, 'hashtags')))
+    else:
+      fixtures_directory = os.path.join(work_directory, 'fixtures')
+      hashtags = ['benchmark{0}'.format(i) for i in range(args.hashtags)]
+      generate_fixtures(fixtures_directory, hashtags, args.pages, media_size=args.media_size)
+
+    user_agents = ['jinstascrape-benchmark/{0}'.format(i) for i in range(args.sessions)]
+    server = start_replay_server(fixtures_directory, latency=args.latency, jitter=args.latency / 2,
+      rate_limit_ratio=args.rate_limit_ratio, retry_after=args.retry_after, drop_ratio=args.drop_ratio,
+      url_lifetime=args.url_lifetime, throttled_agents=user_agents[:args.throttled_sessions] or None)
+    try:
+      sessions_path = os.path.join(work_directory, 'sessions.txt')
+      with open(sessions_path, 'w') as f:
+        f.write(''.join(user_agent + '\n' for user_agent in user_agents))
+      scraper = make_replay_scraper(args, work_directory, hashtags, sessions_path)
+      latencies = []
+      for identity in scraper.sessions.identities:
+        identity.session.hooks['response'].append(
+          lambda response, *_, **__: latencies.append(response.elapsed.total_seconds()))
+
+      if args.pipeline:
+        scraper.download = True
+        scrape_seconds = download_seconds = timed_quietly(scraper.scrape)
+      else:
+        scrape_seconds = timed_quietly(scraper.scrape)
+      post_count = len(scraper.manifest)
+      print 'Scraped {0} posts from {1} hashtags in {2:.2f}s: {3:.1f} posts/s'.format(
+        post_count, len(hashtags), scrape_seconds, post_count / scrape_seconds)
+      if not args.pipeline:
+        print_latencies(latencies)
+        print_peak_rss()
+        print_stages(['paginate', 'fetch_post', 'process_post', 'save_manifest'])
+        print_sessions(scraper.sessions)
+
+        del latencies[:]
+        scraper.hashtags = []
+        scraper.download = True
+        download_seconds = timed_quietly(scraper.scrape)
+      media = [media for post in scraper.manifest.itervalues() for media in post.media_items if media.downloaded_path]
+      megabytes = sum(media_item.size for media_item in media) / float(1 << 20)
+      print 'Downloaded {0} media ({1:.1f}MB) in {2:.2f}s: {3:.2f}MB/s'.format(
+        len(media), megabytes, download_seconds, megabytes / download_seconds)
+      print_latencies(latencies)
+      print_peak_rss()
+      print_stages(['download_media', 'refresh_urls', 'save_manifest'])
+      print_sessions(scraper.sessions)
+      print 'Scraped and downloaded in {0:.2f}s{1}'.format(
+        scrape_seconds + download_seconds if not args.pipeline else scrape_seconds, ' pipelined' if args.pipeline else '')
+
+      del latencies[:]
+      scraper.hashtags = []
+      scraper.download = False
+      scraper.pipeline = False
+      scraper.refresh_age = 0 # every post is due
+      refresh_seconds = timed_quietly(scraper.scrape)
+      outcomes = dict((entry['labels']['outcome'], entry['value'])
+        for entry in JinstaScrape.METRICS.snapshot()['counters'].get('posts_refreshed_total', []))
+      print 'Refreshed {0} posts in {1:.2f}s: {2:.1f} posts/s, {3} not modified, {4} refetched'.format(
+        sum(outcomes.values()), refresh_seconds, sum(outcomes.values()) / refresh_seconds,
+        outcomes.get('not_modified', 0), outcomes.get('refetched', 0))
+      print_latencies(latencies)
+      print_stages(['refresh_post', 'save_manifest'])
+    finally:
+      server.terminate()
+  finally:
+    shutil.rmtree(work_directory)
+
+def start_replay_server(fixtures_directory, **options):
+  """
+  Starts a replay server in its own process, so that it competes with the scraper for neither GIL nor memory
+  Points JinstaScrape at it and returns the process
+  """
+  base_urls = multiprocessing.Queue()
+  server = multiprocessing.Process(target=serve_replay, args=(fixtures_directory, options, base_urls))
+  server.daemon = True
+  server.start()
+  base_url = base_urls.get()
+  for name in ['VIEW_MEDIA_URL', 'QUERY_HASHTAG', 'QUERY_LOCATION', 'INSTAGRAM_URL']:
+    setattr(JinstaScrape, name, getattr(JinstaScrape, name).replace(JinstaScrape.INSTAGRAM_URL, base_url))
+  return server
+
+def serve_replay(fixtures_directory, options, base_urls):
+  replay = ReplayServer(fixtures_directory, **options)
+  base_urls.put(replay.base_url)
+  replay.serve_forever()
+
+def make_replay_scraper(args, work_directory, hashtags, sessions_path=None):
+  """Returns a scraper of hashtags writing to work_directory, with the sessions of sessions_path if given, unpaced unless args.paced"""
+  if not args.paced:
+    JinstaScrape.RATE_LIMITS = {budget: (UNPACED, UNPACED) for budget in JinstaScrape.RATE_LIMITS}
+  JinstaScrape.RETRY_COOLDOWN = args.retry_cooldown
+  scraper = JinstaScrape(
+    scrape_by_hashtags=False, hashtags_path=None, scrape_by_locations=False, locations_path=None,
+    manifest_path=os.path.join(work_directory, 'manifest.jsonl'),
+    scrape_workers=args.scrape_workers, parallel_queries=args.parallel_queries, stop_at_scraped=False,
+    engine='threads', role='standalone', queue_path=None, worker_id=None, sessions_path=sessions_path,
+    download=False, downloads_directory=os.path.join(work_directory, 'downloads'),
+    download_workers=args.download_workers, chunk_size=JinstaScrape.DOWNLOAD_CHUNK_SIZE,
+    metrics_path=None, metrics_format='json', metrics_interval=10, index_manifest=False,
+    refresh_age=None, refresh_pending=False, video_workers=None, pipeline=args.pipeline, pretty_json=False,
+    max_bytes_in_flight=JinstaScrape.MAX_DOWNLOAD_BYTES_IN_FLIGHT
+  )
+  scraper.hashtags = hashtags
+  return scraper
+
+def timed_quietly(run):
+  """Returns seconds taken by run, whose prints are discarded so that they do not skew the timing"""
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    start_time = time.time()
+    run()
+    return time.time() - start_time
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+def print_latencies(latencies):
+  """Prints p50 and p99 of request latencies in seconds, i.e. time until response headers"""
+  if not latencies:
+    return
+  latencies = sorted(latencies)
+  percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+  print '  {0} requests, latency p50 {1:.1f}ms p99 {2:.1f}ms'.format(len(latencies), percentile(0.5) * 1e3, percentile(0.99) * 1e3)
+
+def print_stages(stages):
+  """Prints count and total seconds of given stages so far, with bucketed p50/p99 in ms"""
+  snapshot = JinstaScrape.METRICS.snapshot()
+  for entry in snapshot['histograms'].get('stage_seconds', []):
+    if entry['labels']['stage'] in stages:
+      print '  {0:<14} {1:6} times {2:8.2f}s total, p50 <= {3}ms p99 <= {4}ms'.format(entry['labels']['stage'],
+        entry['count'], entry['sum'], bucket_ms(entry['p50']), bucket_ms(entry['p99']))
+
+def print_sessions(sessions):
+  """Prints requests by outcome of every session so far, with the seconds it was cooled down for"""
+  for name, outcomes, cooldown_seconds, _ in sessions.stats():
+    print '  {0:<14} {1:6} requests, {2} throttled, {3} errors, {4} dropped, cooled down {5}s'.format(name,
+      sum(outcomes.values()), outcomes['throttled'], outcomes['error'], outcomes['dropped'], cooldown_seconds)
+
+def bucket_ms(bound):
+  return bound if bound == '+Inf' else int(bound * 1e3)
+
+def print_peak_rss():
+  print '  peak RSS so far {0:.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Benchmarks for JinstaScrape hot paths and throughput",
+    formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  subparsers = parser.add_subparsers(dest='benchmark')
+
+  tags_parser = subparsers.add_parser('tags', help='Hashtag extraction from captions')
+  tags_parser.add_argument('--count', '-n', type=int, default=10000, help='Number of captions')
+  tags_parser.add_argument('--repeat', '-r', type=int, default=5, help='Number of timed runs')
+  tags_parser.add_argument('--manifest-path', '-mp', default=None, help='Take captions from this manifest instead of synthetic ones')
+  tags_parser.set_defaults(run=benchmark_tags)
+
+  json_parser = subparsers.add_parser('json', help='Manifest encoding and decoding per JSON backend')
+  json_parser.add_argument('--count', '-n', type=int, default=100000, help='Number of posts')
+  json_parser.add_argument('--repeat', '-r', type=int, default=3, help='Number of timed runs')
+  json_parser.add_argument('--manifest-path', '-mp', default=None, help='Take posts from this manifest instead of synthetic ones')
+  json_parser.set_defaults(run=benchmark_json)
+
+  scrape_parser = subparsers.add_parser('scrape', help='Scrape and download throughput against a local replay server')
+  scrape_parser.add_argument('--fixtures-directory', '-fd', default=None, help='Replay these fixtures instead of generated ones')
+  scrape_parser.add_argument('--hashtags', '-t', type=int, default=4, help='Number of hashtags to generate')
+  scrape_parser.add_argument('--pages', '-p', type=int, default=5, help='Pages of 100 posts per generated hashtag')
+  scrape_parser.add_argument('--media-size', '-ms', type=int, default=32 * 1024, help='Bytes per generated media file')
+  scrape_parser.add_argument('--latency', '-l', type=float, default=0.02, help='Seconds every request is delayed by, +/- half as much')
+  scrape_parser.add_argument('--rate-limit-ratio', '-rl', type=float, default=0, help='Fraction of requests answered with HTTP 429')
+  scrape_parser.add_argument('--retry-after', '-ra', type=int, default=1, help='Retry-After seconds sent with HTTP 429')
+  scrape_parser.add_argument('--drop-ratio', '-dr', type=float, default=0, help='Fraction of requests whose connection is dropped')
+  scrape_parser.add_argument('--url-lifetime', '-ul', type=float, default=0, help='Seconds signed media urls stay valid. 0 serves unsigned urls')
+  scrape_parser.add_argument('--retry-cooldown', '-rc', type=float, default=JinstaScrape.RETRY_COOLDOWN, help='Seconds before retrying a dropped connection')
+  scrape_parser.add_argument('--pipeline', action='store_true', help='Download media as posts are scraped, in one pass, instead of afterwards')
+  scrape_parser.add_argument('--sessions', '-s', type=int, default=1, help='Number of sessions to spread requests across, each with its own user agent and rate limits')
+  scrape_parser.add_argument('--throttled-sessions', '-ts', type=int, default=0, help='Number of sessions that -rl applies to, instead of every request')
+  scrape_parser.add_argument('--paced', action='store_true', help='Keep the rate limits of RATE_LIMITS instead of running unpaced')
+  scrape_parser.add_argument('--scrape-workers', '-sw', type=int, default=JinstaScrape.MAX_WORKERS, help='Number of concurrent post fetches')
+  scrape_parser.add_argument('--parallel-queries', '-pq', type=int, default=JinstaScrape.MAX_PARALLEL_QUERIES, help='Number of hashtags paged at once')
+  scrape_parser.add_argument('--download-workers', '-dw', type=int, default=JinstaScrape.MAX_WORKERS, help='Number of concurrent media downloads')
+  scrape_parser.set_defaults(run=benchmark_scrape)
+
+  args = parser.parse_args()
+  args.run(args)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import os
+import time
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+import serializer
+
+from manifest_store import open_store
+
+class ColumnarExport(object):
+  """
+  Manifest exported as tables of columns under directory, for analytics that only scan a few fields of every post
+  Tables are written either as <table>.parquet files (requires pyarrow) or, without pyarrow, as
+  <table>/<column>.json files holding one JSON array per column
+  Owners are deduplicated by id, and posts refer to them by owner_id
+  """
+  # table -> [(column, type)]
+  TABLES = collections.OrderedDict([
+    ('posts', [
+      ('shortcode', 'string'), ('id', 'string'), ('typename', 'string'), ('is_video', 'bool'),
+      ('taken_at_timestamp', 'int'), ('last_scraped_at', 'string'), ('is_ad', 'bool'),
+      ('location_id', 'string'), ('location_name', 'string'), ('location_slug', 'string'), ('owner_id', 'string'),
+      ('caption_text', 'string'), ('caption_is_edited', 'bool'),
+      ('comments_count', 'int'), ('comments_disabled', 'bool'), ('likes_count', 'int')
+    ]),
+    ('media_items', [
+      ('post_shortcode', 'string'), ('position', 'int'), ('typename', 'string'), ('shortcode', 'string'),
+      ('id', 'string'), ('url', 'string'), ('downloaded_path', 'string'), ('downloaded_at', 'string'),
+      ('size', 'int'), ('sha256', 'string'), ('tagged_users', 'string') # tagged user nodes as JSON
+    ]),
+    ('tags', [('post_shortcode', 'string'), ('tag', 'string')]),
+    ('comments', [
+      ('post_shortcode', 'string'), ('position', 'int'), ('id', 'string'), ('text', 'string'),
+      ('created_at', 'int'), ('owner_id', 'string'), ('owner_username', 'string')
+    ]),
+    ('owners', [
+      ('id', 'string'), ('username', 'string'), ('full_name', 'string'), ('profile_pic_url', 'string'),
+      ('is_private', 'bool'), ('is_unpublished', 'bool'), ('is_verified', 'bool')
+    ])
+  ])
+  FORMATS = ['parquet', 'columns']
+  ROWS_PER_GROUP = 100000 # rows buffered per table before they are written out
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def format(self):
+    """Returns the format the export on disk was written in, or None if there is none"""
+    if os.path.isfile(os.path.join(self.directory, 'posts.parquet')):
+      return 'parquet'
+    if os.path.isdir(os.path.join(self.directory, 'posts')):
+      return 'columns'
+    return None
+
+  def write(self, posts, table_format=None):
+    """
+    Exports posts, streamed one at a time, in given format; parquet if pyarrow is available and none is given
+    Returns the number of rows written per table
+    """
+    table_format = table_format or ('parquet' if pyarrow else 'columns')
+    if table_format == 'parquet' and not pyarrow:
+      raise ValueError('Parquet export requires pyarrow (pip install pyarrow)')
+    if self.format() not in (None, table_format):
+      raise ValueError('{0} already holds an export in {1} format'.format(self.directory, self.format()))
+    writers = dict(
+      (table, (_ParquetWriter if table_format == 'parquet' else _ColumnFilesWriter)(self.directory, table, columns))
+      for table, columns in ColumnarExport.TABLES.iteritems()
+    )
+    owners = {}
+    try:
+      for post in posts:
+        for table, row in ColumnarExport.post_rows(post):
+          writers[table].append(row)
+        owners[post['owner']['id']] = post['owner'] # last scraped wins
+      for owner in owners.itervalues():
+        writers['owners'].append(ColumnarExport.owner_row(owner))
+    finally:
+      for writer in writers.itervalues():
+        writer.close()
+    return dict((table, writer.row_count) for table, writer in writers.iteritems())
+
+  def read_columns(self, table, columns):
+    """Returns given columns of table as a dict of column name -> list of values"""
+    if self.format() == 'parquet':
+      if not pyarrow:
+        raise ValueError('Reading a Parquet export requires pyarrow (pip install pyarrow)')
+      return pyarrow.parquet.read_table(os.path.join(self.directory, table + '.parquet'), columns=columns).to_pydict()
+    values = {}
+    for column in columns:
+      with open(os.path.join(self.directory, table, column + '.json'), 'rb') as f:
+        values[column] = serializer.load(f)
+    return values
+
+  @staticmethod
+  def post_rows(post):
+    """Yields (table, row) of every row of post but its owner's"""
+    location = post['location'] or {}
+    yield 'posts', (
+      post['shortcode'], post['id'], post['__typename'], post['is_video'], post['taken_at_timestamp'],
+      post['last_scraped_at'], post['is_ad'], location.get('id'), location.get('name'), location.get('slug'),
+      post['owner']['id'], post['caption']['text'], post['caption'].get('caption_is_edited'),
+      post['comments']['count'], post['comments']['comments_disabled'], post['likes']['count']
+    )
+    for position, media in enumerate(post['media_items']):
+      yield 'media_items', (
+        post['shortcode'], position, media['__typename'], media['shortcode'], media['id'], media.get('url'),
+        media['downloaded_path'], media.get('downloaded_at'), media.get('size'), media.get('sha256'),
+        serializer.dumps(media['tagged_users']).decode('utf-8')
+      )
+    for tag in post['tags']:
+      yield 'tags', (post['shortcode'], tag)
+    for position, comment in enumerate(post['comments']['entries']):
+      owner = comment.get('owner') or {}
+      yield 'comments', (
+        post['shortcode'], position, comment.get('id'), comment.get('text'), comment.get('created_at'),
+        owner.get('id'), owner.get('username')
+      )
+
+  @staticmethod
+  def owner_row(owner):
+    return (
+      owner['id'], owner['username'], owner['full_name'], owner['profile_pic_url'],
+      owner['is_private'], owner['is_unpublished'], owner['is_verified']
+    )
+
+def _coerce(value, column_type):
+  """Returns value as given column type, keeping None"""
+  if value is None:
+    return None
+  if column_type == 'string':
+    return value if isinstance(value, unicode) else unicode(value)
+  if column_type == 'int':
+    return int(value)
+  return bool(value)
+
+class _ColumnFilesWriter(object):
+  """Streams rows of a table into one JSON array file per column, encoding ROWS_PER_GROUP rows at a time"""
+  def __init__(self, directory, table, columns):
+    table_directory = os.path.join(directory, table)
+    if not os.path.isdir(table_directory):
+      os.makedirs(table_directory)
+    self.columns = columns
+    self.files = [open(os.path.join(table_directory, column + '.json'), 'wb') for column, _ in columns]
+    for f in self.files:
+      f.write('[')
+    self.rows = []
+    self.row_count = 0
+
+  def append(self, row):
+    self.rows.append(row)
+    self.row_count += 1
+    if len(self.rows) >= ColumnarExport.ROWS_PER_GROUP:
+      self.__flush()
+
+  def close(self):
+    self.__flush()
+    for f in self.files:
+      f.write(']')
+      f.close()
+
+  def __flush(self):
+    if not self.rows:
+      return
+    separator = ',' if self.row_count > len(self.rows) else ''
+    for f, (_, column_type), values in zip(self.files, self.columns, zip(*self.rows)):
+      encoded = serializer.dumps([_coerce(value, column_type) for value in values])
+      f.write(separator + encoded[1:-1]) # elements only, the brackets enclose the whole file
+    self.rows = []
+
+class _ParquetWriter(object):
+  """Writes rows of a table to a Parquet file, one row group per ROWS_PER_GROUP rows"""
+  TYPES = {'string': 'string', 'int': 'int64', 'bool': 'bool_'}
+
+  def __init__(self, directory, table, columns):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.columns = columns
+    self.schema = pyarrow.schema([
+      pyarrow.field(column, getattr(pyarrow, _ParquetWriter.TYPES[column_type])()) for column, column_type in columns
+    ])
+    self.writer = pyarrow.parquet.ParquetWriter(os.path.join(directory, table + '.parquet'), self.schema)
+    self.rows = []
+    self.row_count = 0
+
+  def append(self, row):
+    self.rows.append(row)
+    self.row_count += 1
+    if len(self.rows) >= ColumnarExport.ROWS_PER_GROUP:
+      self.__flush()
+
+  def close(self):
+    self.__flush()
+    self.writer.close()
+
+  def __flush(self):
+    if not self.rows:
+      return
+    arrays = [
+      pyarrow.array([_coerce(value, column_type) for value in values], type=field.type)
+      for (_, column_type), field, values in zip(self.columns, self.schema, zip(*self.rows))
+    ]
+    self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+    self.rows = []
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Exports a manifest to columnar tables of posts, media_items, tags, comments and owners",
+    formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('--manifest-path', '-mp', default='./manifest.jsonl', help='Path for manifest file (.jsonl journal or .json file)')
+  parser.add_argument('--output-directory', '-o', default='./manifest_columns', help='Directory to write tables to')
+  parser.add_argument('--format', '-f', choices=ColumnarExport.FORMATS, default=None, help='Table format. Defaults to parquet if pyarrow is installed, else columns')
+
+  args = parser.parse_args()
+  start_time = time.time()
+  row_counts = ColumnarExport(args.output_directory).write(open_store(args.manifest_path).iter_posts(), args.format)
+  print 'Exported to {0} in {1:.2f}s:'.format(args.output_directory, time.time() - start_time)
+  for table in ColumnarExport.TABLES:
+    print '  {0:<12} {1} rows'.format(table, row_counts[table])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Cooperative engine for JinstaScrape
+
+Monkey-patches the standard library with gevent before requests is imported.
+Every worker of JinstaScrape's executors then runs as a greenlet and all of
+them share one pool of sessions, so thousands of requests can be in flight
+from a single OS thread. Takes the same options as jinstascrape.py, e.g.
+  python gevent_engine.py -sw 1000 -dw 1000 -d
+which is what `python jinstascrape.py --engine gevent` hands over to.
+"""
+
+import sys
+
+try:
+  from gevent import monkey
+except ImportError:
+  sys.exit('gevent is required for the gevent engine: pip install gevent')
+monkey.patch_all()
+
+import jinstascrape
+
+if __name__ == '__main__':
+  if '--engine' not in sys.argv and '-e' not in sys.argv:
+    sys.argv += ['--engine', 'gevent']
+  jinstascrape.main()
@@ -2,13 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import codecs
-import errno
-import json
+import collections
+import hashlib
 import logging.config
 import os
 import re
+import socket
 import sys
+import threading
 import time
 
 import concurrent.futures
@@ -16,7 +17,23 @@ import requests
 import tqdm
 
 from http import Response
-from datetime import datetime
+from datetime import datetime, timedelta
+from urlparse import urlparse, parse_qs
+
+import serializer
+import tag_tokenizer
+
+from manifest_index import ManifestIndex
+from manifest_store import JournalManifestStore, open_store
+from media_store import MediaStore
+from metrics import Metrics, MetricsReporter
+from post import Post
+from scheduler import DownloadScheduler, RateScheduler, RequestDeferred, RequeueingExecutor
+from session_pool import SessionPool
+from work_queue import WorkQueue
+
+logger = logging.getLogger('jinstascrape')
+logger.addHandler(logging.NullHandler()) # silent unless main configures logging
 
 class JinstaScrape(object):
   ######## CONSTANTS ###########################################################
@@ -33,6 +50,30 @@ class JinstaScrape(object):
   MAX_RETRIES = 5
   RETRY_COOLDOWN = 6
   MAX_WORKERS = 10
+  MAX_PARALLEL_QUERIES = 4
+  MAX_PENDING_FETCHES_PER_WORKER = 2
+  POSTS_PER_COMMIT = 500
+  DOWNLOADS_PER_COMMIT = 500
+  RESULTS_PER_MERGE = 1000
+  QUEUE_POLL_INTERVAL = 5 # seconds
+  DOWNLOAD_CHUNK_SIZE = 1 << 20 # bytes
+  MAX_DOWNLOAD_BYTES_IN_FLIGHT = 256 << 20 # bytes
+  VIDEO_WORKER_SHARE = 4 # one download worker in this many is kept for videos
+  PIPELINE_MAX_WAITING_DOWNLOADS = 1000 # media waiting for download before pipelined scraping holds back
+  PIPELINE_POLL_INTERVAL = 0.5 # seconds
+  INTERRUPT_POLL_INTERVAL = 0.5 # seconds between checks for KeyboardInterrupt while the main thread waits
+  LEGACY_MANIFEST_PATH = './manifest.json' # default manifest path of earlier versions
+  MEDIA_URL_EXPIRY_MARGIN = 600 # seconds before a signed media url expires that it is refreshed at
+  NOT_MODIFIED = object() # post node of a post that did not change since its validators were sent
+  ENGINES = ['threads', 'gevent']
+  ROLES = ['standalone', 'coordinator', 'worker']
+  # Request budgets of each session as (requests per second, burst size)
+  RATE_LIMITS = {
+    'graphql': (0.5, 5),
+    'post': (2.0, 10),
+    'media': (10.0, 20)
+  }
+  METRICS = Metrics()
 
   def __init__(self, **kwargs):
     """
@@ -40,233 +81,964 @@ class JinstaScrape(object):
       self.scrape_by_hashtags
       self.hashtags_path
       self.hashtags
+      self.scrape_by_locations
+      self.locations_path
+      self.locations
+      self.scrape_workers
+      self.parallel_queries
+      self.stop_at_scraped
+      self.refresh_age
+      self.refresh_pending
+      self.engine
+      self.role
+      self.queue_path
+      self.worker_id
+      self.work_queue
       self.download
+      self.pipeline
+      self.pipeline_thread
+      self.scraping
+      self.stop_downloads
       self.downloads_directory
-      self.session
+      self.media_store
+      self.download_workers
+      self.chunk_size
+      self.video_workers
+      self.max_bytes_in_flight
+      self.pending_downloads
+      self.metrics_path
+      self.metrics_format
+      self.metrics_interval
+      self.sessions_path
+      self.sessions
       self.manifest_path
+      self.pretty_json
+      self.manifest_store
+      self.index_manifest
+      self.manifest_index
       self.manifest
+      self.manifest_lock
+      self.changed_shortcodes
+      self.claimed_shortcodes
+      self.stop_requested
+      self.checkpoints
+      self.checkpoints_changed
+      self.completed_queries
+      self.fetch_queues
+      self.download_queue
+      self.url_refresh_locks
     """
     # Load arguments as instance variables
     for key, value in kwargs.iteritems():
       self.__dict__[key] = value
 
-    self.session = requests.Session()
+    self.sessions = SessionPool.from_specs( # stages run one after the other unless pipelined
+      SessionPool.read_specs(self.sessions_path) if self.sessions_path else None,
+      self.scrape_workers + self.download_workers if self.pipeline else max(self.scrape_workers, self.download_workers),
+      JinstaScrape.RATE_LIMITS, JinstaScrape.METRICS
+    )
+    self.manifest_lock = threading.Lock() # guards self.manifest across fetch workers
+    self.changed_shortcodes = set() # posts changed since the manifest was last written out
+    self.completed_queries = set() # queries paged through to the end during this run
+    self.claimed_shortcodes = set() # posts being fetched, by whichever query reached them first
+    self.stop_requested = False # set on keyboard interrupt for queries paging on other threads
+    self.stop_downloads = False # set on keyboard interrupt for pipelined downloads
+    self.pipeline_thread = None # downloading media as posts are scraped, in pipeline mode
+    self.scraping = threading.Event() # set while pipelined downloads should wait for more media
+    self.work_queue = WorkQueue(self.queue_path) if self.role != 'standalone' else None
+    self.fetch_queues = [] # post fetches of the queries being paged
+    self.download_queue = None
+    self.url_refresh_locks = {} # shortcode -> [lock held while the media urls of post are refreshed, threads using it]
+    video_workers = self.video_workers or max(1, self.download_workers // JinstaScrape.VIDEO_WORKER_SHARE)
+    self.pending_downloads = DownloadScheduler( # filled as posts are loaded and added
+      [('image', max(1, self.download_workers - video_workers)), ('video', video_workers)],
+      self.max_bytes_in_flight
+    )
+    JinstaScrape.METRICS.gauge('queue_depth', lambda: sum(len(fetches) for fetches in list(self.fetch_queues)), queue='fetch')
+    JinstaScrape.METRICS.gauge('queue_depth', lambda: len(self.download_queue or ()), queue='download')
+    JinstaScrape.METRICS.gauge('queue_depth', lambda: len(self.changed_shortcodes), queue='unsaved_posts')
+    JinstaScrape.METRICS.gauge('queue_depth', lambda: len(self.pending_downloads), queue='pending_downloads')
+    JinstaScrape.METRICS.gauge('download_bytes_in_flight', lambda: self.pending_downloads.bytes_in_flight)
+    JinstaScrape.METRICS.gauge('sessions_cooling', self.sessions.cooling)
     self.__load_hashtags() # assign self.hashtags
+    self.__load_locations() # assign self.locations
     self.__load_manifest() # assign self.manifest
 
   def scrape(self):
-    """Scraping function"""
-    if self.scrape_by_hashtags:
-      try:
-        self.__scrape_hashtags()
-      except KeyboardInterrupt:
-        print 'Force exit requested!'
-        self.__writeout_manifest() # save current manifest
-        print 'Exiting program...\n'
+    """
+    Scraping function
+    In pipeline mode, media is downloaded on a background thread as posts are scraped rather than afterwards
+    """
+    reporter = self.__start_metrics_reporter()
+    try:
+      queries = [('hashtag', tag_name) for tag_name in self.hashtags] + \
+        [('location', location_id) for location_id in self.locations]
+      refresh = (self.refresh_age is not None or self.refresh_pending) and self.role != 'worker'
+      downloading = self.download and self.role != 'worker' # workers leave media to the coordinator
+      if downloading and self.pipeline:
+        self.__start_pipeline()
+      if queries or refresh or self.role == 'worker': # workers lease their queries from the work queue
+        try:
+          if refresh: # instead of queries
+            self.__refresh_posts()
+          elif self.role == 'worker':
+            self.__work()
+          elif self.role == 'coordinator':
+            self.__coordinate(queries)
+          else:
+            self.__scrape_queries(queries)
+        except KeyboardInterrupt:
+          print 'Force exit requested!'
+          if self.pipeline_thread:
+            self.__stop_pipeline()
+          self.__writeout_manifest() # save current manifest
+          print 'Exiting program...\n'
 
-    if self.download:
-      try:
-        self.__download_scraped_media()
-      except KeyboardInterrupt:
-        print 'Force exit requested!'
-        self.__writeout_manifest() # save current manifest
-        print 'Exiting program...\n'
+      if self.pipeline_thread:
+        self.__finish_pipeline()
+      elif downloading:
+        try:
+          self.__download_scraped_media()
+        except KeyboardInterrupt:
+          print 'Force exit requested!'
+          self.__writeout_manifest() # save current manifest
+          print 'Exiting program...\n'
+      if self.manifest_index:
+        self.manifest_index.sync() # a .json manifest is only indexed once done with, see __writeout_manifest
+    finally:
+      self.__print_session_stats()
+      if reporter:
+        reporter.stop() # exports a final snapshot
 
   ######## PRIVATE METHODDS ####################################################
+  def __start_metrics_reporter(self):
+    """Starts exporting metrics periodically if requested. Returns the reporter or None"""
+    if not self.metrics_path and self.metrics_format != 'log':
+      return None
+    reporter = MetricsReporter(JinstaScrape.METRICS, self.metrics_path, self.metrics_format, self.metrics_interval)
+    reporter.start()
+    return reporter
+
+  def __print_session_stats(self):
+    """Prints requests by outcome and time spent cooling down of every session"""
+    print 'Sessions:'
+    print '  {0:<10} {1:>8} {2:>8} {3:>10} {4:>8} {5:>8} {6:>10}'.format(
+      'session', 'requests', 'ok', 'throttled', 'errors', 'dropped', 'cooldown')
+    for name, outcomes, cooldown_seconds, cooling in self.sessions.stats():
+      print '  {0:<10} {1:>8} {2:>8} {3:>10} {4:>8} {5:>8} {6:>9}s{7}'.format(name, sum(outcomes.values()),
+        outcomes['ok'], outcomes['throttled'], outcomes['error'], outcomes['dropped'], cooldown_seconds,
+        ' (cooling)' if cooling else '')
+
   def __load_manifest(self):
-    """Loads json manifest and assign to self.manifest"""
-    try:
-      with open(self.manifest_path) as f:
-        self.manifest = json.load(f) # load previous manifest if exists
-    except:
-      self.manifest = json.loads("{}") # else use new empty manifest
+    """
+    Loads manifest and assign to self.manifest, with its posts as compact Post records
+    whose media left to download is queued in self.pending_downloads as they are read
+    A new empty manifest is used if none exists yet
+    A worker starts empty and sends its posts back through the work queue instead
+    If requested, the manifest's index is brought up to date, and kept so on every write out of a journal
+    """
+    self.manifest_index = None
+    if self.role == 'worker':
+      self.manifest_store = self.work_queue.store(self.worker_id)
+    else:
+      self.manifest_store = open_store(self.manifest_path, self.pretty_json)
+      if self.index_manifest:
+        self.manifest_index = ManifestIndex(self.manifest_path)
+        self.manifest_index.sync()
+    self.manifest = self.manifest_store.load(self.__load_post)
+    self.checkpoints = self.manifest_store.load_checkpoints()
+    self.checkpoints_changed = False
+
+  def __load_post(self, post):
+    """Returns post read from manifest as a Post record, queueing its media left to download"""
+    post = Post.from_dict(post)
+    self.__queue_downloads(post)
+    return post
+
+  def __queue_downloads(self, post):
+    """Queues media of post left to download in self.pending_downloads. Workers leave media to the coordinator"""
+    if self.role == 'worker':
+      return
+    for media in post.media_items:
+      if getattr(media, 'url', None): # else of a typename without media
+        self.pending_downloads.add(post.shortcode, media, JinstaScrape.download_lane(media))
 
   def __load_hashtags(self):
     """Loads hashtags and assign to self.hashtags"""
     self.hashtags = []
     if self.scrape_by_hashtags:
       try:
-        with open(self.hashtags_path) as f:
-          for line in f.readlines():
-            tag = line.strip()
-            # if not empty and not comment
-            if tag and not tag.startswith('#'):
-              self.hashtags.append(tag)
+        self.hashtags = JinstaScrape.read_list(self.hashtags_path)
       except:
         print 'Please provide a valid text file path for hashtags list'
 
-  def __scrape_hashtags(self):
-    """Scrape posts via hashtags and save information to manifest"""
-    scrape_start_time = datetime.now()
-    # For every hashtag in list
-    for tag_name in self.hashtags:
-      print 'INITIATED SCRAPING FOR #{0}'.format(tag_name)
-      new_scrape_count = 0
+  def __load_locations(self):
+    """Loads location ids and assign to self.locations"""
+    self.locations = []
+    if self.scrape_by_locations:
       try:
-        nodes = JinstaScrape.get_posts_generator('hashtag', tag_name, self.session)
-        if nodes: # if not None
-          for node in nodes:
-            shortcode = node['shortcode']
-            if self.__not_already_scraped(shortcode):
-              post_node = JinstaScrape.get_post_node(shortcode, self.session)
-              if post_node: # if not None
-                self.__update_manifest(post_node)
-                print 'Post shortcode={0} scraped!'.format(shortcode)
-                new_scrape_count += 1
-      except Exception as e:
-        print 'Exception encountered during scraping: ', e
-        self.__writeout_manifest() # save current manifest
-        print 'Retrying scrape...'
-        self.__scrape_hashtags()
-        return
-      
-      # Upon completion of scraping hashtag with tag_name
-      print '{0} new posts collected for #{1}!'.format(new_scrape_count, tag_name)
+        self.locations = JinstaScrape.read_list(self.locations_path)
+      except:
+        print 'Please provide a valid text file path for locations list'
+
+  def __scrape_queries(self, queries):
+    """
+    Scrape posts via (query type, query value) queries, i.e. hashtags and locations, and save information to manifest
+    Up to parallel_queries queries are paged at once, sharing one pool of scrape_workers for post fetches
+    Failed queries are retried once the others are done
+    """
+    scrape_start_time = datetime.now()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.scrape_workers)
+    query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_queries)
+    failed_queries = []
+    try:
+      # For every query in list
+      futures = collections.OrderedDict()
+      for query in queries:
+        if JinstaScrape.query_key(*query) in self.completed_queries:
+          continue # already done before a retry
+        futures[query_executor.submit(self.__scrape_and_report, executor, *query)] = query
+      for future in JinstaScrape.as_completed(futures):
+        try:
+          future.result()
+        except Exception as e:
+          print 'Exception encountered during scraping {0}: {1}'.format(JinstaScrape.query_label(*futures[future]), e)
+          self.__writeout_manifest() # save current manifest
+          failed_queries.append(futures[future])
+    except KeyboardInterrupt:
+      self.stop_requested = True # let queries on other threads wind down
+      raise
+    finally:
+      query_executor.shutdown(wait=True)
+      executor.shutdown(wait=True)
 
-    # Upon completion of scraping all hashtags
+    if failed_queries:
+      print 'Retrying scrape...'
+      self.__scrape_queries(failed_queries)
+      return
+
+    # Upon completion of scraping all queries
     print 'SCRAPING COMPLETED!'
     print 'Scrape time elapsed: {}s'.format(JinstaScrape.time_elapsed(scrape_start_time))
     
     self.__writeout_manifest() # Save completed manifest
 
-  def __download_scraped_media(self):
-    """Downloads all undownloaded media in manifest"""
-    # Terminate if manifest is empty
-    if not self.manifest:
+  def __coordinate(self, queries):
+    """
+    Queues queries for workers and merges the posts they send back into manifest until every query is done
+    Queries resume from the checkpoints of manifest, which mirror those of the queue as workers advance
+    """
+    scrape_start_time = datetime.now()
+    self.work_queue.enqueue(
+      [(JinstaScrape.query_key(*query),) + query for query in queries],
+      self.checkpoints
+    )
+    self.work_queue.mark_scraped(self.manifest.keys())
+    print 'Queued {0} queries in {1}. Start workers with: -r worker -qp {1}'.format(len(queries), self.queue_path)
+    reported = None
+    while True:
+      done_count, query_count = self.work_queue.progress()
+      done_count = done_count or 0
+      posts = self.work_queue.take_results(JinstaScrape.RESULTS_PER_MERGE)
+      if posts:
+        with self.manifest_lock:
+          for post in posts:
+            post = Post.from_dict(post)
+            self.manifest[post.shortcode] = post
+            self.__queue_downloads(post)
+            self.changed_shortcodes.add(post.shortcode)
+          self.checkpoints = self.work_queue.checkpoints()
+          self.checkpoints_changed = True
+        self.__writeout_manifest()
+      if (done_count, len(self.manifest)) != reported:
+        reported = done_count, len(self.manifest)
+        print '{0} of {1} queries done, {2} posts in manifest'.format(done_count, query_count, len(self.manifest))
+      if done_count == query_count and not posts: # workers commit posts before completing their query
+        break
+      if len(posts) < JinstaScrape.RESULTS_PER_MERGE:
+        time.sleep(JinstaScrape.QUEUE_POLL_INTERVAL)
+
+    print 'SCRAPING COMPLETED!'
+    print 'Scrape time elapsed: {}s'.format(JinstaScrape.time_elapsed(scrape_start_time))
+    with self.manifest_lock:
+      self.checkpoints = {}
+      self.checkpoints_changed = True
+    self.__writeout_manifest() # Save completed manifest
+
+  def __work(self):
+    """Scrapes queries leased from the work queue, up to parallel_queries at once, until none is left"""
+    scrape_start_time = datetime.now()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.scrape_workers)
+    query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_queries)
+    try:
+      futures = [query_executor.submit(self.__work_on_leases, executor) for _ in range(self.parallel_queries)]
+      for future in JinstaScrape.as_completed(futures):
+        future.result()
+    except KeyboardInterrupt:
+      self.stop_requested = True # let queries on other threads wind down and release their leases
+      raise
+    finally:
+      query_executor.shutdown(wait=True)
+      executor.shutdown(wait=True)
+
+    print 'No queries left in {0}'.format(self.queue_path)
+    print 'Scrape time elapsed: {}s'.format(JinstaScrape.time_elapsed(scrape_start_time))
+
+  def __work_on_leases(self, executor):
+    """Leases and scrapes one query after another. Runs on a query thread"""
+    while not self.stop_requested:
+      task = self.work_queue.lease(self.worker_id)
+      if task is None:
+        return
+      query_type, query_value, checkpoint = task
+      query_key = JinstaScrape.query_key(query_type, query_value)
+      with self.manifest_lock:
+        self.checkpoints[query_key] = checkpoint
+      try:
+        self.__scrape_and_report(executor, query_type, query_value)
+      except Exception as e:
+        print 'Exception encountered during scraping {0}: {1}'.format(JinstaScrape.query_label(query_type, query_value), e)
+        self.__writeout_manifest() # send back posts and checkpoint before another worker takes over
+      with self.manifest_lock:
+        self.checkpoints.pop(query_key, None)
+      if query_key in self.completed_queries:
+        self.work_queue.complete(query_key, self.worker_id)
+      else:
+        self.work_queue.release(query_key, self.worker_id)
+
+  def __scrape_and_report(self, executor, query_type, query_value):
+    """Scrapes query, then reports its new posts and writes out manifest. Runs on a query thread"""
+    label = JinstaScrape.query_label(query_type, query_value)
+    print 'INITIATED SCRAPING FOR {0}'.format(label)
+    new_scrape_count = self.__scrape_query(executor, query_type, query_value)
+
+    # Upon completion of scraping query
+    print '{0} new posts collected for {1}!'.format(new_scrape_count, label)
+    self.__writeout_manifest() # checkpoint
+
+  def __scrape_query(self, executor, query_type, query_value):
+    """
+    Pages through query results and fetches every new post node on executor
+    Pagination continues while fetches are in flight, but no more than
+    MAX_PENDING_FETCHES_PER_WORKER fetches per worker are queued at once across parallel queries
+    A post is fetched once, by the first query to claim it
+    Paging resumes from the query's checkpoint, which advances past a page once all its fetches are done,
+    as well as those of its posts claimed by other queries
+    Returns the number of new posts added to manifest
+    """
+    query_key = JinstaScrape.query_key(query_type, query_value)
+    checkpoint = self.checkpoints.get(query_key, {'end_cursor': '', 'page_count': 0})
+    if checkpoint['end_cursor']:
+      print 'Resuming from page {0}'.format(checkpoint['page_count'] + 1)
+    scraped = [] # shortcodes of posts added to manifest
+    open_pages = collections.deque() # [page count, end_cursor, fetches outstanding, shortcodes claimed elsewhere] of pages past checkpoint
+    shortcode_pages = {} # shortcode -> its entry in open_pages
+
+    def on_result(shortcode, added):
+      if added:
+        scraped.append(shortcode)
+      shortcode_pages.pop(shortcode)[2] -= 1
+      self.__advance_checkpoint(query_key, open_pages)
+      if added and len(scraped) % JinstaScrape.POSTS_PER_COMMIT == 0:
+        self.__writeout_manifest()
+
+    max_pending = max(1, self.scrape_workers * JinstaScrape.MAX_PENDING_FETCHES_PER_WORKER // self.parallel_queries)
+    fetches = RequeueingExecutor(executor, max_pending, on_result)
+    self.fetch_queues.append(fetches)
+    exhausted = False # if paged through to the last page
+    try:
+      page_count = checkpoint['page_count']
+      pages = JinstaScrape.get_pages_generator(query_type, query_value, self.sessions, checkpoint['end_cursor'])
+      for nodes, end_cursor in pages:
+        if self.stop_requested:
+          break
+        page_count += 1
+        exhausted = not end_cursor
+        page = [page_count, end_cursor, 0, set()]
+        open_pages.append(page)
+        new_node_count = 0
+        for node in nodes:
+          shortcode = node['shortcode']
+          claim = self.__claim_shortcode(shortcode)
+          if claim is None: # scraped before
+            continue
+          new_node_count += 1
+          if not claim: # being fetched for an earlier page or another query
+            page[3].add(shortcode)
+            continue
+          page[2] += 1
+          shortcode_pages[shortcode] = page
+          self.__wait_for_download_room()
+          fetches.submit(self.__fetch_post, shortcode) # blocks pagination while executor is saturated
+        self.__advance_checkpoint(query_key, open_pages)
+        if self.stop_at_scraped and not new_node_count:
+          print 'Page {0} was scraped before; stopping early'.format(page_count)
+          exhausted = True
+          break
+      while open_pages and not self.stop_requested: # a stop drops deferred retries rather than waiting them out
+        if len(fetches):
+          fetches.wait(JinstaScrape.INTERRUPT_POLL_INTERVAL)
+        else: # only posts claimed by other queries are left
+          self.__writeout_manifest() # a worker's own claims resolve once its posts are sent back
+          time.sleep(JinstaScrape.INTERRUPT_POLL_INTERVAL)
+        self.__advance_checkpoint(query_key, open_pages)
+      exhausted = exhausted and not open_pages
+    finally:
+      # Drop queued fetches if we are bailing out early, and their claims along with them
+      fetches.cancel()
+      self.fetch_queues.remove(fetches)
+      for shortcode in shortcode_pages:
+        self.__release_claim(shortcode)
+
+    if exhausted:
+      self.__complete_checkpoint(query_key)
+    return len(scraped)
+
+  def __advance_checkpoint(self, query_key, open_pages):
+    """Moves checkpoint of query past the leading open pages whose fetches, and those of posts claimed elsewhere, are all done"""
+    while open_pages and open_pages[0][2] == 0 and not self.__claims_pending(open_pages[0][3]):
+      page_count, end_cursor, _, _ = open_pages.popleft()
+      if end_cursor: # else last page, which __complete_checkpoint handles
+        with self.manifest_lock:
+          self.checkpoints[query_key] = {'end_cursor': end_cursor, 'page_count': page_count}
+          self.checkpoints_changed = True
+
+  def __complete_checkpoint(self, query_key):
+    """Drops checkpoint of a query that was paged through, so that a later run starts over from its newest posts"""
+    self.completed_queries.add(query_key)
+    with self.manifest_lock:
+      if query_key in self.checkpoints:
+        del self.checkpoints[query_key]
+        self.checkpoints_changed = True
+
+  def __fetch_post(self, shortcode, retry_count):
+    """
+    Fetches post node of given shortcode and adds it to manifest
+    Runs on worker threads and raises RequestDeferred rather than waiting out rate limits
+    Returns True if post was added
+    """
+    with JinstaScrape.METRICS.timer('stage_seconds', stage='fetch_post'):
+      post_node, validators = JinstaScrape.fetch_post_node(shortcode, self.sessions, None, retry_count, block=False)
+    if not post_node: # if None
+      self.__release_claim(shortcode) # let a later page or query try again
+      return False
+    self.__update_manifest(post_node, validators)
+    logger.debug('Post shortcode=%s scraped!', shortcode)
+    return True
+
+  def __refresh_posts(self):
+    """
+    Refetches the posts due for a refresh (see __stale_shortcodes) on scrape_workers, sending the validators they
+    were last fetched with, so that an unchanged post costs a 304 and only has its last_scraped_at bumped
+    """
+    refresh_start_time = datetime.now()
+    shortcodes = self.__stale_shortcodes()
+    if not shortcodes:
+      print 'No posts due for a refresh'
+      return
+    progress = tqdm.tqdm(total=len(shortcodes), desc='Refreshing posts')
+    outcomes = collections.Counter()
+
+    def on_result(shortcode, outcome):
+      outcomes[outcome] += 1
+      progress.update()
+      if progress.n % JinstaScrape.POSTS_PER_COMMIT == 0:
+        self.__writeout_manifest() # checkpoint
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.scrape_workers)
+    fetches = RequeueingExecutor(executor, self.scrape_workers * JinstaScrape.MAX_PENDING_FETCHES_PER_WORKER, on_result)
+    self.fetch_queues.append(fetches)
+    try:
+      for shortcode in shortcodes:
+        self.__wait_for_download_room()
+        fetches.submit(self.__refresh_post, shortcode, poll_interval=JinstaScrape.INTERRUPT_POLL_INTERVAL)
+      fetches.drain(JinstaScrape.INTERRUPT_POLL_INTERVAL) # on the main thread, see as_completed
+    finally:
+      fetches.cancel()
+      self.fetch_queues.remove(fetches)
+      executor.shutdown(wait=True)
+      progress.close()
+
+    # Upon completion of refreshing
+    print 'REFRESH COMPLETED!'
+    print '{0} posts refetched, {1} not modified, {2} failed'.format(
+      outcomes['refetched'], outcomes['not_modified'], outcomes['failed'])
+    print 'Refresh time elapsed: {}s'.format(JinstaScrape.time_elapsed(refresh_start_time))
+
+    self.__writeout_manifest() # Save refreshed manifest
+
+  def __stale_shortcodes(self):
+    """
+    Returns shortcodes of the posts due for a refresh, least recently scraped first: those last scraped over
+    refresh_age hours ago, and if refresh_pending, those with media left to download
+    """
+    cutoff = str(datetime.now() - timedelta(hours=self.refresh_age)) if self.refresh_age is not None else None
+    with self.manifest_lock:
+      stale = [
+        (post.last_scraped_at, shortcode) for shortcode, post in self.manifest.iteritems()
+        if (cutoff is not None and post.last_scraped_at < cutoff) or
+          (self.refresh_pending and any(not media.downloaded() for media in post.media_items))
+      ]
+    return [shortcode for _, shortcode in sorted(stale)]
+
+  def __refresh_post(self, shortcode, retry_count):
+    """
+    Refetches post of given shortcode unless the server answers it did not change. Runs on worker threads
+    Returns 'refetched', 'not_modified' or 'failed'
+    """
+    with self.manifest_lock:
+      post = self.manifest[shortcode]
+      validators = JinstaScrape.post_validators(post)
+    with JinstaScrape.METRICS.timer('stage_seconds', stage='refresh_post'):
+      post_node, validators = JinstaScrape.fetch_post_node(shortcode, self.sessions, validators, retry_count, block=False)
+    if post_node is None:
+      outcome = 'failed'
+    elif post_node is JinstaScrape.NOT_MODIFIED:
+      with self.manifest_lock:
+        post.last_scraped_at = str(datetime.now())
+        for name, value in validators.iteritems():
+          if value:
+            setattr(post, name, value)
+        self.changed_shortcodes.add(shortcode)
+      outcome = 'not_modified'
+    else:
+      self.__update_manifest(post_node, validators)
+      outcome = 'refetched'
+    JinstaScrape.METRICS.count('posts_refreshed_total', outcome=outcome)
+    return outcome
+
+  def __start_pipeline(self):
+    """Starts downloading media on a background thread as posts are scraped, until __finish_pipeline"""
+    self.scraping.set()
+    self.stop_downloads = False
+    self.pipeline_thread = threading.Thread(target=self.__download_pipelined_media)
+    self.pipeline_thread.daemon = True
+    self.pipeline_thread.start()
+
+  def __finish_pipeline(self):
+    """Lets pipelined downloads go through the media left once scraping is done, and waits for them"""
+    self.scraping.clear()
+    try:
+      while self.pipeline_thread.is_alive():
+        self.pipeline_thread.join(JinstaScrape.PIPELINE_POLL_INTERVAL) # with a timeout, KeyboardInterrupt gets through
+    except KeyboardInterrupt:
+      print 'Force exit requested!'
+      self.__stop_pipeline()
+      self.__writeout_manifest() # save current manifest
+      print 'Exiting program...\n'
+    self.pipeline_thread = None
+
+  def __stop_pipeline(self):
+    """Drops the media waiting for pipelined downloads and waits for those in flight, unless interrupted again"""
+    self.stop_downloads = True # downloads in flight are recorded, the others dropped
+    try:
+      while self.pipeline_thread.is_alive():
+        self.pipeline_thread.join(JinstaScrape.PIPELINE_POLL_INTERVAL) # with a timeout, KeyboardInterrupt gets through
+    except KeyboardInterrupt:
+      print 'Not waiting for downloads in flight'
+
+  def __download_pipelined_media(self):
+    """Downloads media as it is queued, on the pipeline thread"""
+    try:
+      self.__download_scraped_media(streaming=True)
+    except Exception as e:
+      print 'Exception encountered during downloading: {0}'.format(e)
+      self.__writeout_manifest() # save current manifest
+
+  def __wait_for_download_room(self):
+    """
+    Holds back post fetches while PIPELINE_MAX_WAITING_DOWNLOADS media wait for pipelined downloads, so that
+    scraping does not run ahead of downloads and leave media urls to expire. Runs on query threads
+    """
+    pipeline_thread = self.pipeline_thread
+    while pipeline_thread and pipeline_thread.is_alive() and not self.stop_requested:
+      if self.pending_downloads.wait_for_room(JinstaScrape.PIPELINE_MAX_WAITING_DOWNLOADS, JinstaScrape.PIPELINE_POLL_INTERVAL):
+        return
+
+  def __download_scraped_media(self, streaming=False):
+    """
+    Downloads all undownloaded media in manifest, as queued in self.pending_downloads
+    Downloads are taken from there whenever a worker and room in their lane and in bytes in flight free up
+    When streaming, i.e. on the pipeline thread, media queued meanwhile is downloaded as well until scraping is
+    done and nothing is left, or until stop_downloads is set
+    """
+    # Terminate if there is nothing left to download
+    if not streaming and not len(self.pending_downloads):
       print 'Nothing to download! Exiting program...'
       return
 
     download_start_time = datetime.now()
-    future_to_download = {}
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=JinstaScrape.MAX_WORKERS)
-    
-    # Iterate each scraped post in manifest and add to concurrent download executor
-    for shortcode in self.manifest:
-      post = self.manifest[shortcode]
-      # Iterate each media in post
-      for media in post['media_items']:
-        # If media not yet downloaded
-        if not media['downloaded_path']:
-          future = executor.submit(JinstaScrape.download_media, media, self.downloads_directory, shortcode, self.session)
-          future_to_download[future] = media
-    
-    # Download each post in executor's list
-    failure_count = 0
-    for future in tqdm.tqdm(concurrent.futures.as_completed(future_to_download), total=len(future_to_download), desc='Downloading media'):
-      media = future_to_download[future]
-      if future.exception() is not None:
-        print 'Media shortcode={0} at {1} generated an exception: {2}'.format(media['shortcode'], media['url'], future.exception())
-        failure_count += 1
+    self.media_store = MediaStore(self.downloads_directory)
+    progress = tqdm.tqdm(total=len(self.pending_downloads), desc='Downloading media')
+    failures = []
+
+    def on_error(key, e):
+      shortcode, media = key
+      self.pending_downloads.done(shortcode, media)
+      print 'Media shortcode={0} at {1} generated an exception: {2}'.format(media.shortcode, media.url, e)
+      failures.append(key)
+      progress.update()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers)
+    def on_result(key, result):
+      self.pending_downloads.done(*key)
+      progress.update()
+      if progress.n % JinstaScrape.DOWNLOADS_PER_COMMIT == 0:
+        self.__writeout_manifest() # checkpoint
+
+    def on_cancel(key):
+      shortcode, media = key
+      self.pending_downloads.done(shortcode, media) # frees its room, and
+      self.pending_downloads.add(shortcode, media, JinstaScrape.download_lane(media)) # queues it again for a later run
+
+    downloads = RequeueingExecutor(executor, self.download_workers * JinstaScrape.MAX_PENDING_FETCHES_PER_WORKER,
+      on_result, on_error, on_cancel)
+    self.download_queue = downloads
+    poll_interval = JinstaScrape.PIPELINE_POLL_INTERVAL if streaming else JinstaScrape.INTERRUPT_POLL_INTERVAL # see as_completed
+    try:
+      while not self.stop_downloads:
+        scraping = streaming and self.scraping.is_set() # before take, so nothing queued meanwhile is missed
+        key = None if downloads.saturated() else self.pending_downloads.take()
+        if key:
+          downloads.submit(self.__download_task, key)
+          progress.total = max(progress.total, progress.n + len(downloads) + len(self.pending_downloads))
+        elif len(downloads):
+          downloads.wait(poll_interval) # for room to free up, or for media queued meanwhile
+        elif scraping:
+          self.pending_downloads.wait_for_media(poll_interval)
+        else:
+          break # nothing in flight, so nothing is left either
+    finally:
+      downloads.cancel()
+      self.download_queue = None
+      executor.shutdown(wait=True)
+      progress.close()
+    failure_count = len(failures)
 
     # Upon completion
     print 'Download time elapsed: {}s'.format(JinstaScrape.time_elapsed(download_start_time))
+    if self.media_store.reused_count:
+      print self.media_store.reused_count, 'media were already in store and not downloaded again'
     if failure_count:
       print failure_count, 'failed downloads'
     
     self.__writeout_manifest() # write out updated manifest
 
-  def __not_already_scraped(self, shortcode):
-    """Asserts if post with given shortcode has been scraped"""
-    return shortcode not in self.manifest
+  def __download_task(self, key, retry_count):
+    """
+    Downloads media of key=(post shortcode, media) on a worker thread
+    A signed media url about to expire is refreshed first
+    """
+    shortcode, media = key
+    if JinstaScrape.media_url_expiring(media.url):
+      self.__refresh_media_urls(shortcode, media, retry_count)
+    with JinstaScrape.METRICS.timer('stage_seconds', stage='download_media'):
+      file_path, size, sha256 = JinstaScrape.download_media(media, self.media_store, shortcode, self.sessions, retry_count, self.chunk_size)
+    with self.manifest_lock: # manifest commits serialize media meanwhile
+      JinstaScrape.record_download(media, file_path, size, sha256)
+      self.changed_shortcodes.add(shortcode)
+
+  def __refresh_media_urls(self, shortcode, media, retry_count):
+    """
+    Refetches post of given shortcode for fresh media urls, unless another media item of the post just did
+    Its media items are updated in place (see keep_downloads), so media holds the fresh url afterwards
+    """
+    with self.manifest_lock:
+      entry = self.url_refresh_locks.setdefault(shortcode, [threading.Lock(), 0])
+      entry[1] += 1
+    try:
+      with entry[0]:
+        if not JinstaScrape.media_url_expiring(media.url):
+          return # refreshed meanwhile
+        with JinstaScrape.METRICS.timer('stage_seconds', stage='refresh_urls'):
+          post_node, validators = JinstaScrape.fetch_post_node(shortcode, self.sessions, None, retry_count, block=False)
+        if post_node: # else the download goes ahead and fails over to a retry
+          self.__update_manifest(post_node, validators)
+    finally:
+      with self.manifest_lock:
+        entry[1] -= 1
+        if not entry[1]: # last one out
+          del self.url_refresh_locks[shortcode]
+
+  def __claim_shortcode(self, shortcode):
+    """
+    Claims the fetch of post with given shortcode for the caller
+    Returns None if it has been scraped, False if it is already claimed, else True
+    Workers claim through the work queue, which is shared with the other workers
+    """
+    if self.role == 'worker':
+      return self.work_queue.claim(shortcode, self.worker_id)
+    with self.manifest_lock:
+      if shortcode in self.manifest:
+        return None
+      if shortcode in self.claimed_shortcodes:
+        return False
+      self.claimed_shortcodes.add(shortcode)
+      return True
 
-  def __update_manifest(self, post_node):
-    """Update manifest with give post_node"""
-    self.manifest[post_node['shortcode']] = JinstaScrape.process_post(post_node)
+  def __release_claim(self, shortcode):
+    """Gives up the claim of the caller on post with given shortcode, whose fetch failed or was dropped"""
+    with self.manifest_lock:
+      self.claimed_shortcodes.discard(shortcode)
+    if self.role == 'worker':
+      self.work_queue.unclaim(shortcode)
+
+  def __claims_pending(self, shortcodes):
+    """Drops the posts whose claims were resolved, by a fetch or by giving them up, from set shortcodes, and returns it"""
+    if shortcodes:
+      if self.role == 'worker':
+        pending = self.work_queue.claimed(shortcodes)
+      else:
+        with self.manifest_lock:
+          pending = shortcodes & self.claimed_shortcodes
+      shortcodes.intersection_update(pending)
+    return shortcodes
+
+  def __update_manifest(self, post_node, validators=None):
+    """Update manifest with give post_node, fetched with given validators. Downloads of a refetched post are kept"""
+    with JinstaScrape.METRICS.timer('stage_seconds', stage='process_post'):
+      processed_post = JinstaScrape.process_post(post_node, validators) # process outside of lock
+    with self.manifest_lock:
+      if post_node['shortcode'] in self.manifest:
+        JinstaScrape.keep_downloads(self.manifest[post_node['shortcode']], processed_post)
+      self.manifest[post_node['shortcode']] = processed_post
+      self.changed_shortcodes.add(post_node['shortcode'])
+      self.claimed_shortcodes.discard(post_node['shortcode']) # manifest now answers for it
+    self.__queue_downloads(processed_post)
 
   def __writeout_manifest(self):
-    """Write manifest to disk"""
-    print 'Saving manifest to', self.manifest_path
-    self.write_json(self.manifest, self.manifest_path)
+    """Commit posts changed since last write out to manifest on disk, followed by pagination checkpoints"""
+    with self.manifest_lock, JinstaScrape.METRICS.timer('stage_seconds', stage='save_manifest'):
+      if self.changed_shortcodes:
+        logger.info('Saving %d changed posts to %s', len(self.changed_shortcodes), self.manifest_path)
+        self.manifest_store.commit(self.manifest, self.changed_shortcodes)
+        JinstaScrape.METRICS.count('posts_saved_total', len(self.changed_shortcodes))
+        self.changed_shortcodes = set()
+        if self.manifest_index and isinstance(self.manifest_store, JournalManifestStore):
+          self.manifest_index.sync() # indexes the lines just appended, whereas a .json manifest would be reindexed whole
+      if self.checkpoints_changed:
+        self.manifest_store.commit_checkpoints(self.checkpoints)
+        self.checkpoints_changed = False
 
   ######## PUBLIC STATIC METHODS ###############################################
   @staticmethod
-  def get_post_node(shortcode, session):
+  def gevent_patched():
+    """Asserts if the standard library has been monkey-patched by gevent"""
+    try:
+      from gevent import monkey
+    except ImportError:
+      return False
+    return monkey.is_module_patched('socket')
+
+  @staticmethod
+  def get_post_node(shortcode, sessions, retry_count=0, block=True):
     """
     Returns media post node of given media shortcode
     Returns None if HTTP request failed
+    Raises RequestDeferred when not blocking and the request has to wait (see request)
+    """
+    return JinstaScrape.fetch_post_node(shortcode, sessions, None, retry_count, block)[0]
+
+  @staticmethod
+  def fetch_post_node(shortcode, sessions, validators=None, retry_count=0, block=True):
+    """
+    Returns (media post node of given media shortcode, its validators as {'etag', 'last_modified'})
+    Given the validators of an earlier fetch, the request is conditional, and NOT_MODIFIED is returned in place of
+    the node if the server answers that the post did not change
+    Returns None, None if HTTP request failed
+    Raises RequestDeferred when not blocking and the request has to wait (see request)
     """
     url = JinstaScrape.VIEW_MEDIA_URL.format(shortcode)
-    response = JinstaScrape.request(url, session, 0)
-    if response:
-      try:
-        payload = response.json()
-        return payload["graphql"]["shortcode_media"]
-      except Exception as e:
-        print 'Parsing {0} encountered: {1}'.format(url, e)
-        return None
-    else:
-      return None
+    validators = validators or {}
+    headers = {}
+    if validators.get('etag'):
+      headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+      headers['If-Modified-Since'] = validators['last_modified']
+    response = JinstaScrape.request(url, sessions, retry_count, block, headers or None)
+    if not response:
+      return None, None
+    received = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    if response.status_code == 304:
+      return JinstaScrape.NOT_MODIFIED, dict((name, value or validators.get(name)) for name, value in received.iteritems())
+    try:
+      payload = serializer.loads(response.content)
+      return payload["graphql"]["shortcode_media"], received
+    except Exception as e:
+      logger.warning('Parsing %s encountered: %s', url, e)
+      return None, None
+
+  @staticmethod
+  def post_validators(post):
+    """Returns the validators post was fetched with, as {'etag', 'last_modified'} whose values may be None"""
+    return {'etag': getattr(post, 'etag', None), 'last_modified': getattr(post, 'last_modified', None)}
 
   @staticmethod
-  def get_posts_generator(query_type, query_value, session):
+  def keep_downloads(old_post, new_post):
+    """
+    Carries the media items of old_post over to new_post, a refetch of the same post, matching them by id
+    Their urls and tagged users are updated in place, so that downloads done or in flight are kept
+    """
+    old_media_items = dict((media.id, media) for media in old_post.media_items)
+    media_items = []
+    for media in new_post.media_items:
+      old_media = old_media_items.get(media.id)
+      if old_media is not None:
+        if hasattr(media, 'url'):
+          old_media.url = media.url
+        old_media.tagged_users = media.tagged_users
+        media = old_media
+      media_items.append(media)
+    new_post.media_items = tuple(media_items)
+
+  @staticmethod
+  def get_posts_generator(query_type, query_value, sessions, end_cursor=''):
     """Returns a python generator for the exhaustive posts from a query"""
-    end_cursor = ''
+    for nodes, _ in JinstaScrape.get_pages_generator(query_type, query_value, sessions, end_cursor):
+      for node in nodes:
+        yield node
+
+  @staticmethod
+  def get_pages_generator(query_type, query_value, sessions, end_cursor=''):
+    """
+    Returns a python generator for the pages of a query after end_cursor, as (post nodes, page's end_cursor)
+    The last page has an empty end_cursor. Generation stops early if a request fails
+    """
     if query_type == 'hashtag':
       getter = JinstaScrape.get_hashtagged_posts
     elif query_type == 'location':
       getter = JinstaScrape.get_location_posts
 
     while True:
-      edges, end_cursor = getter(query_value, end_cursor, session)
-      if not edges: # if request failed
+      with JinstaScrape.METRICS.timer('stage_seconds', stage='paginate'):
+        edges, end_cursor = getter(query_value, end_cursor, sessions)
+      if edges is None: # if request failed
         break
-      for edge_node in edges:
-        yield edge_node['node']
+      yield [edge_node['node'] for edge_node in edges], end_cursor
       if not end_cursor: # end if no more pages left in query
         break
 
   @staticmethod
-  def get_hashtagged_posts(hashtag, end_cursor, session):
+  def query_key(query_type, query_value):
+    """Returns the key of a query in pagination checkpoints"""
+    return '{0}:{1}'.format(query_type, query_value)
+
+  @staticmethod
+  def query_label(query_type, query_value):
+    """Returns how a query is referred to in progress messages"""
+    if query_type == 'hashtag':
+      return '#' + query_value
+    return '{0} {1}'.format(query_type, query_value)
+
+  @staticmethod
+  def get_hashtagged_posts(hashtag, end_cursor, sessions):
     """
     Gets the list of hashtagged posts nodes and edges, end_cursor
     returns None, None if HTTP request failed
     """
     url = JinstaScrape.QUERY_HASHTAG.format(hashtag, end_cursor)
-    response = JinstaScrape.request(url, session, 0)
+    return JinstaScrape.get_query_page(url, 'hashtag', 'edge_hashtag_to_media', sessions)
+
+  @staticmethod
+  def get_location_posts(location_id, end_cursor, sessions):
+    """
+    Gets the list of posts nodes and edges tagged with location of given id, end_cursor
+    returns None, None if HTTP request failed
+    """
+    url = JinstaScrape.QUERY_LOCATION.format(location_id, end_cursor)
+    return JinstaScrape.get_query_page(url, 'location', 'edge_location_to_media', sessions)
+
+  @staticmethod
+  def get_query_page(url, root, edge, sessions):
+    """
+    Gets a page of a graphql query, whose posts are under payload['data'][root][edge]
+    returns edges, end_cursor or None, None if HTTP request failed
+    """
+    response = JinstaScrape.request(url, sessions, 0)
     if response:
       try:
-        payload = response.json()
-        hashtag_result = payload['data']['hashtag']['edge_hashtag_to_media']
+        payload = serializer.loads(response.content)
+        result = payload['data'][root][edge]
         # return edges, end_cursor
-        edges = hashtag_result['edges']
-        end_cursor = hashtag_result['page_info']['end_cursor']
-        return edges, end_cursor 
+        edges = result['edges']
+        end_cursor = result['page_info']['end_cursor']
+        return edges, end_cursor
       except Exception as e:
-        print 'Parsing {0} encountered: {1}'.format(url, e)
+        logger.warning('Parsing %s encountered: %s', url, e)
         return None, None
     else:
       return None, None
 
   @staticmethod
-  def request(url, session, retry_count):
+  def request(url, sessions, retry_count=0, block=True, headers=None):
     """
-    Post get request to given url with exponential backoff retry scheme
-    returns response object on success, else None
+    Post get request to given url with given headers through the next session of the sessions pool with a request
+    slot for it, as paced by that session's rate limits
+    Failures are retried with exponential backoff, dropped connections after RETRY_COOLDOWN,
+    and HTTP 429 pauses the session's requests sharing url's budget, retrying right away with another session
+    When block is False, waits are raised as RequestDeferred for the caller to requeue instead of slept through
+    returns response object on success, or on HTTP 304 to a conditional request, else None
     """
-    print 'Requesting', url
-    response = session.get(url)
-    if Response(response.status_code).is_success:
-      return response
-    else:
-      print 'HTTP {0} for {1}'.format(str(response.status_code), url)
-      if retry_count < JinstaScrape.MAX_RETRIES:
-        # Determine suitable timeout
-        timeout = 2 ** (6 + retry_count) # use exponential backoff (start at 64s)
-        if 'Retry-After' in response.headers:
-          timeout = int(response.headers['Retry-After'])
-        print 'Retrying in {0}s'.format(timeout)
-        # Timeout
-        time.sleep(timeout)
-        # Retry
-        return JinstaScrape.request(url, session, retry_count + 1)
-      else:
-        print 'Max retries exceeded. Aborting current query.'
+    budget = RateScheduler.budget_for(url)[0]
+    while True:
+      identity, delay = sessions.acquire(url)
+      if delay:
+        JinstaScrape.METRICS.count('wait_seconds_total', delay, budget=budget, reason='throttle')
+        if not block:
+          raise RequestDeferred(delay, retry_count)
+        time.sleep(delay)
+        continue
+
+      logger.debug('Requesting %s', url)
+      try:
+        with JinstaScrape.METRICS.timer('request_seconds', budget=budget):
+          response = identity.session.get(url, headers=headers)
+      except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+        logger.warning('Connection for %s dropped: %s', url, e)
+        JinstaScrape.METRICS.count('requests_total', budget=budget, status='dropped')
+        sessions.record(identity, 'dropped')
+        if retry_count >= JinstaScrape.MAX_RETRIES:
+          logger.warning('Max retries exceeded. Aborting current query.')
+          return None
+        retry_count += 1
+        JinstaScrape.METRICS.count('wait_seconds_total', JinstaScrape.RETRY_COOLDOWN, budget=budget, reason='backoff')
+        if not block:
+          raise RequestDeferred(JinstaScrape.RETRY_COOLDOWN, retry_count)
+        time.sleep(JinstaScrape.RETRY_COOLDOWN)
+        continue
+      JinstaScrape.METRICS.count('requests_total', budget=budget, status=str(response.status_code))
+      sessions.record(identity, response.status_code)
+      if Response(response.status_code).is_success or (headers and response.status_code == 304):
+        return response
+
+      logger.warning('HTTP %d for %s', response.status_code, url)
+      if retry_count >= JinstaScrape.MAX_RETRIES:
+        logger.warning('Max retries exceeded. Aborting current query.')
         return None
+      timeout = JinstaScrape.retry_timeout(response, retry_count)
+      retry_count += 1
+      if response.status_code == 429:
+        identity.scheduler.pause(url, timeout) # the other sessions take its requests meanwhile
+        continue
+      logger.info('Retrying in %ds', timeout)
+      JinstaScrape.METRICS.count('wait_seconds_total', timeout, budget=budget, reason='backoff')
+      if not block:
+        raise RequestDeferred(timeout, retry_count)
+      time.sleep(timeout)
+
+  @staticmethod
+  def retry_timeout(response, retry_count):
+    """Returns seconds to wait before retrying a failed response, honoring Retry-After if given"""
+    try:
+      return int(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+      return 2 ** (6 + retry_count) # use exponential backoff (start at 64s)
 
   @staticmethod
-  def get_location_posts():
-    # TODO
-    return
+  def read_list(file_path):
+    """Returns the non-empty lines of a text file, skipping comments starting with #"""
+    with open(file_path) as f:
+      return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
 
   @staticmethod
   def write_file(data, file_path):
@@ -275,14 +1047,17 @@ class JinstaScrape(object):
       f.write(data)
 
   @staticmethod
-  def write_json(data, file_path):
-    """Writes json data to given file_path"""
+  def write_json(data, file_path, pretty=False):
+    """Writes json data to given file_path, on one line unless pretty"""
     with open(file_path, 'wb') as f:
-      json.dump(data, codecs.getwriter('utf-8')(f), indent=2, ensure_ascii=False)
+      serializer.dump(data, f, pretty)
   
   @staticmethod
-  def process_post(post_node):
-    """Processes and formats scraped post node into desired format"""
+  def process_post(post_node, validators=None):
+    """
+    Processes and formats scraped post node into desired format, returned as a compact Post
+    validators the post node was fetched with, if any, are kept for conditional refetches
+    """
     processed_post = {
       '__typename': post_node['__typename'],
       'id': post_node['id'],
@@ -317,8 +1092,13 @@ class JinstaScrape(object):
 
     # process likes
     processed_post['likes'] = JinstaScrape.process_likes(post_node)
+
+    # keep validators
+    for name, value in (validators or {}).iteritems():
+      if value:
+        processed_post[name] = value
     
-    return processed_post
+    return Post.from_dict(processed_post)
 
   @staticmethod
   def process_media(post_node):
@@ -446,67 +1226,134 @@ class JinstaScrape(object):
 
   @staticmethod
   def extract_tags(text):
-    """Extracts the hashtags from given text"""    
-    tags = []
-    # include words and emojis
-    tags = re.findall(
-      r"(?<!&)#(\w+|(?:[\xA9\xAE\u203C\u2049\u2122\u2139\u2194-\u2199\u21A9\u21AA\u231A\u231B\u2328\u2388\u23CF\u23E9-\u23F3\u23F8-\u23FA\u24C2\u25AA\u25AB\u25B6\u25C0\u25FB-\u25FE\u2600-\u2604\u260E\u2611\u2614\u2615\u2618\u261D\u2620\u2622\u2623\u2626\u262A\u262E\u262F\u2638-\u263A\u2648-\u2653\u2660\u2663\u2665\u2666\u2668\u267B\u267F\u2692-\u2694\u2696\u2697\u2699\u269B\u269C\u26A0\u26A1\u26AA\u26AB\u26B0\u26B1\u26BD\u26BE\u26C4\u26C5\u26C8\u26CE\u26CF\u26D1\u26D3\u26D4\u26E9\u26EA\u26F0-\u26F5\u26F7-\u26FA\u26FD\u2702\u2705\u2708-\u270D\u270F\u2712\u2714\u2716\u271D\u2721\u2728\u2733\u2734\u2744\u2747\u274C\u274E\u2753-\u2755\u2757\u2763\u2764\u2795-\u2797\u27A1\u27B0\u27BF\u2934\u2935\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55\u3030\u303D\u3297\u3299]|\uD83C[\uDC04\uDCCF\uDD70\uDD71\uDD7E\uDD7F\uDD8E\uDD91-\uDD9A\uDE01\uDE02\uDE1A\uDE2F\uDE32-\uDE3A\uDE50\uDE51\uDF00-\uDF21\uDF24-\uDF93\uDF96\uDF97\uDF99-\uDF9B\uDF9E-\uDFF0\uDFF3-\uDFF5\uDFF7-\uDFFF]|\uD83D[\uDC00-\uDCFD\uDCFF-\uDD3D\uDD49-\uDD4E\uDD50-\uDD67\uDD6F\uDD70\uDD73-\uDD79\uDD87\uDD8A-\uDD8D\uDD90\uDD95\uDD96\uDDA5\uDDA8\uDDB1\uDDB2\uDDBC\uDDC2-\uDDC4\uDDD1-\uDDD3\uDDDC-\uDDDE\uDDE1\uDDE3\uDDEF\uDDF3\uDDFA-\uDE4F\uDE80-\uDEC5\uDECB-\uDED0\uDEE0-\uDEE5\uDEE9\uDEEB\uDEEC\uDEF0\uDEF3]|\uD83E[\uDD10-\uDD18\uDD80-\uDD84\uDDC0]|(?:0\u20E3|1\u20E3|2\u20E3|3\u20E3|4\u20E3|5\u20E3|6\u20E3|7\u20E3|8\u20E3|9\u20E3|#\u20E3|\\*\u20E3|\uD83C(?:\uDDE6\uD83C(?:\uDDEB|\uDDFD|\uDDF1|\uDDF8|\uDDE9|\uDDF4|\uDDEE|\uDDF6|\uDDEC|\uDDF7|\uDDF2|\uDDFC|\uDDE8|\uDDFA|\uDDF9|\uDDFF|\uDDEA)|\uDDE7\uD83C(?:\uDDF8|\uDDED|\uDDE9|\uDDE7|\uDDFE|\uDDEA|\uDDFF|\uDDEF|\uDDF2|\uDDF9|\uDDF4|\uDDE6|\uDDFC|\uDDFB|\uDDF7|\uDDF3|\uDDEC|\uDDEB|\uDDEE|\uDDF6|\uDDF1)|\uDDE8\uD83C(?:\uDDF2|\uDDE6|\uDDFB|\uDDEB|\uDDF1|\uDDF3|\uDDFD|\uDDF5|\uDDE8|\uDDF4|\uDDEC|\uDDE9|\uDDF0|\uDDF7|\uDDEE|\uDDFA|\uDDFC|\uDDFE|\uDDFF|\uDDED)|\uDDE9\uD83C(?:\uDDFF|\uDDF0|\uDDEC|\uDDEF|\uDDF2|\uDDF4|\uDDEA)|\uDDEA\uD83C(?:\uDDE6|\uDDE8|\uDDEC|\uDDF7|\uDDEA|\uDDF9|\uDDFA|\uDDF8|\uDDED)|\uDDEB\uD83C(?:\uDDF0|\uDDF4|\uDDEF|\uDDEE|\uDDF7|\uDDF2)|\uDDEC\uD83C(?:\uDDF6|\uDDEB|\uDDE6|\uDDF2|\uDDEA|\uDDED|\uDDEE|\uDDF7|\uDDF1|\uDDE9|\uDDF5|\uDDFA|\uDDF9|\uDDEC|\uDDF3|\uDDFC|\uDDFE|\uDDF8|\uDDE7)|\uDDED\uD83C(?:\uDDF7|\uDDF9|\uDDF2|\uDDF3|\uDDF0|\uDDFA)|\uDDEE\uD83C(?:\uDDF4|\uDDE8|\uDDF8|\uDDF3|\uDDE9|\uDDF7|\uDDF6|\uDDEA|\uDDF2|\uDDF1|\uDDF9)|\uDDEF\uD83C(?:\uDDF2|\uDDF5|\uDDEA|\uDDF4)|\uDDF0\uD83C(?:\uDDED|\uDDFE|\uDDF2|\uDDFF|\uDDEA|\uDDEE|\uDDFC|\uDDEC|\uDDF5|\uDDF7|\uDDF3)|\uDDF1\uD83C(?:\uDDE6|\uDDFB|\uDDE7|\uDDF8|\uDDF7|\uDDFE|\uDDEE|\uDDF9|\uDDFA|\uDDF0|\uDDE8)|\uDDF2\uD83C(?:\uDDF4|\uDDF0|\uDDEC|\uDDFC|\uDDFE|\uDDFB|\uDDF1|\uDDF9|\uDDED|\uDDF6|\uDDF7|\uDDFA|\uDDFD|\uDDE9|\uDDE8|\uDDF3|\uDDEA|\uDDF8|\uDDE6|\uDDFF|\uDDF2|\uDDF5|\uDDEB)|\uDDF3\uD83C(?:\uDDE6|\uDDF7|\uDDF5|\uDDF1|\uDDE8|\uDDFF|\uDDEE|\uDDEA|\uDDEC|\uDDFA|\uDDEB|\uDDF4)|\uDDF4\uD83C\uDDF2|\uDDF5\uD83C(?:\uDDEB|\uDDF0|\uDDFC|\uDDF8|\uDDE6|\uDDEC|\uDDFE|\uDDEA|\uDDED|\uDDF3|\uDDF1|\uDDF9|\uDDF7|\uDDF2)|\uDDF6\uD83C\uDDE6|\uDDF7\uD83C(?:\uDDEA|\uDDF4|\uDDFA|\uDDFC|\uDDF8)|\uDDF8\uD83C(?:\uDDFB|\uDDF2|\uDDF9|\uDDE6|\uDDF3|\uDDE8|\uDDF1|\uDDEC|\uDDFD|\uDDF0|\uDDEE|\uDDE7|\uDDF4|\uDDF8|\uDDED|\uDDE9|\uDDF7|\uDDEF|\uDDFF|\uDDEA|\uDDFE)|\uDDF9\uD83C(?:\uDDE9|\uDDEB|\uDDFC|\uDDEF|\uDDFF|\uDDED|\uDDF1|\uDDEC|\uDDF0|\uDDF4|\uDDF9|\uDDE6|\uDDF3|\uDDF7|\uDDF2|\uDDE8|\uDDFB)|\uDDFA\uD83C(?:\uDDEC|\uDDE6|\uDDF8|\uDDFE|\uDDF2|\uDDFF)|\uDDFB\uD83C(?:\uDDEC|\uDDE8|\uDDEE|\uDDFA|\uDDE6|\uDDEA|\uDDF3)|\uDDFC\uD83C(?:\uDDF8|\uDDEB)|\uDDFD\uD83C\uDDF0|\uDDFE\uD83C(?:\uDDF9|\uDDEA)|\uDDFF\uD83C(?:\uDDE6|\uDDF2|\uDDFC))))[\ufe00-\ufe0f\u200d]?)+",
-      text, re.UNICODE)
-    tags = list(set(tags))
-
-    return tags
-
-  @staticmethod
-  def download_media(media, downloads_directory, post_shortcode, session):
-    """Downloads the media to directory"""
-    JinstaScrape.make_directory(downloads_directory)
-    url = media['url']
-    file_name = post_shortcode + '.' + url.split('/')[-1].split('?')[0]
-    file_path = os.path.join(downloads_directory, file_name)
-    is_video = True if 'mp4' in file_name else False
-
-    if not os.path.isfile(file_path):
-      with open(file_path, 'wb') as media_file:
-        try:
-          # Video
-          if is_video:
-            r = session.get(url, stream=True)
-            for chunk in r.iter_content(chunk_size=1024):
-              if chunk:
-                media_file.write(chunk)
-          # Image
-          else:
-            content = session.get(url).content
-            media_file.write(content)
-          
-          # Update media for successful download
-          media['downloaded_path'] = file_path
-          media['downloaded_at'] = str(datetime.now())
-        except requests.exceptions.ConnectionError:
-          time.sleep(JinstaScrape.RETRY_COOLDOWN)
-          # Video
-          if is_video:
-            r = session.get(url, stream=True)
-            for chunk in r.iter_content(chunk_size=1024):
-              if chunk:
-                media_file.write(chunk)
-          # Image
-          else:
-            content = session.get(url).content
-            media_file.write(content)
+    """Extracts the hashtags from given text"""
+    return tag_tokenizer.extract_tags(text)
 
   @staticmethod
-  def make_directory(directory):
-    """Creates a directory."""
+  def download_media(media, media_store, post_shortcode, sessions, retry_count=0, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Downloads the media into media_store, streaming it in chunks of chunk_size bytes to a .part file that is
+    moved into the store once its size checks out. A .part file left by an interrupted download is resumed
+    with an HTTP Range request. Media whose asset is already in the store is recorded without any request
+    A file recorded by an earlier version, which did not check sizes, is moved to the .part file and resumed likewise
+    Returns (path, size, sha256) of the stored file, for record_download
+    Raises RequestDeferred instead of waiting when rate limited or when the transfer was cut short
+    """
+    url = media.url
+    file_path, sha256 = media_store.lookup(url)
+    if file_path:
+      return file_path, os.path.getsize(file_path), sha256
+    part_path = media_store.partial_path(post_shortcode, url)
+    if media.downloaded_path and os.path.isfile(media.downloaded_path) and not os.path.isfile(part_path):
+      os.rename(media.downloaded_path, part_path) # possibly truncated
+    budget = RateScheduler.budget_for(url)[0]
+    identity, delay = sessions.acquire(url)
+    if delay:
+      JinstaScrape.METRICS.count('wait_seconds_total', delay, budget=budget, reason='throttle')
+      raise RequestDeferred(delay, retry_count)
+
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
     try:
-      os.makedirs(directory)
-    except OSError as err:
-      if err.errno == errno.EEXIST and os.path.isdir(directory):
-        # Directory already exists
-        pass
-      else:
-        # Target dir exists as a file, or a different error
+      with JinstaScrape.METRICS.timer('request_seconds', budget=budget):
+        r = identity.session.get(url, stream=True, headers=headers)
+      JinstaScrape.METRICS.count('requests_total', budget=budget, status=str(r.status_code))
+      sessions.record(identity, r.status_code)
+      try:
+        if r.status_code == 416:
+          if r.headers.get('Content-Range') != 'bytes */{0}'.format(offset): # part no longer fits the asset
+            os.remove(part_path)
+            raise RequestDeferred(0, retry_count + 1)
+          expected_size = offset # part is whole already
+          _, sha256 = JinstaScrape.file_digest(part_path, chunk_size)
+        else:
+          if not Response(r.status_code).is_success:
+            if retry_count >= JinstaScrape.MAX_RETRIES:
+              raise IOError('HTTP {0}, max retries exceeded'.format(r.status_code))
+            timeout = JinstaScrape.retry_timeout(r, retry_count)
+            if r.status_code == 429:
+              identity.scheduler.pause(url, timeout)
+              raise RequestDeferred(0, retry_count + 1) # another session may take it right away
+            JinstaScrape.METRICS.count('wait_seconds_total', timeout, budget=budget, reason='backoff')
+            raise RequestDeferred(timeout, retry_count + 1)
+
+          if r.status_code != 206: # whole asset was sent
+            offset = 0
+          expected_size = JinstaScrape.expected_size(r, offset)
+          if offset:
+            _, sha256 = JinstaScrape.file_digest(part_path, chunk_size)
+          else:
+            sha256 = hashlib.sha256()
+          with open(part_path, 'ab' if offset else 'wb') as part_file:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+              part_file.write(chunk)
+              sha256.update(chunk)
+              JinstaScrape.METRICS.count('downloaded_bytes_total', len(chunk))
+      finally:
+        r.close()
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+      JinstaScrape.METRICS.count('requests_total', budget=budget, status='dropped')
+      sessions.record(identity, 'dropped')
+      if retry_count >= JinstaScrape.MAX_RETRIES:
         raise
+      JinstaScrape.METRICS.count('wait_seconds_total', JinstaScrape.RETRY_COOLDOWN, budget=budget, reason='backoff')
+      raise RequestDeferred(JinstaScrape.RETRY_COOLDOWN, retry_count + 1) # resumes from .part
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+      if retry_count >= JinstaScrape.MAX_RETRIES:
+        raise IOError('Expected {0} bytes but got {1}'.format(expected_size, size))
+      raise RequestDeferred(JinstaScrape.RETRY_COOLDOWN, retry_count + 1) # resumes from .part
+    file_path = media_store.add(url, part_path, sha256.hexdigest())
+    return file_path, size, sha256.hexdigest()
+
+  @staticmethod
+  def record_download(media, file_path, size, sha256):
+    """Update media item for successful download"""
+    media.downloaded_path = file_path
+    media.downloaded_at = str(datetime.now())
+    media.size = size
+    media.sha256 = sha256
+
+  @staticmethod
+  def download_lane(media):
+    """Returns the lane of DownloadScheduler that media is downloaded in"""
+    return 'video' if media.typename == JinstaScrape.VIDEO_TYPENAME else 'image'
+
+  @staticmethod
+  def media_url_expiring(url):
+    """
+    Asserts if a signed CDN media url expires within MEDIA_URL_EXPIRY_MARGIN seconds, going by the unix time in
+    hex of its oe query parameter. Unsigned urls do not expire
+    """
+    expiry = parse_qs(urlparse(url).query).get('oe')
+    try:
+      return int(expiry[0], 16) - time.time() < JinstaScrape.MEDIA_URL_EXPIRY_MARGIN
+    except (TypeError, ValueError):
+      return False
+
+  @staticmethod
+  def expected_size(response, offset):
+    """Returns the size the file should have once response is written after offset bytes, or None if unknown"""
+    if 'Content-Encoding' in response.headers: # lengths are of the encoded body
+      return None
+    content_range = response.headers.get('Content-Range', '') # e.g. bytes 100-999/1000
+    if response.status_code == 206 and '/' in content_range and not content_range.endswith('*'):
+      return int(content_range.rsplit('/', 1)[1])
+    if 'Content-Length' in response.headers:
+      return offset + int(response.headers['Content-Length'])
+    return None
+
+  @staticmethod
+  def file_digest(file_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Returns size and sha256 hash object of file"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+      for chunk in iter(lambda: f.read(chunk_size), b''):
+        sha256.update(chunk)
+        size += len(chunk)
+    return size, sha256
 
   @staticmethod
   def time_elapsed(start_datetime):
@@ -514,18 +1361,65 @@ class JinstaScrape(object):
     d = datetime.now() - start_datetime # datetime timedelta
     return "%s days, %.2dh: %.2dm: %.2ds" % (d.days,d.seconds//3600,(d.seconds//60)%60, d.seconds%60)
 
+  @staticmethod
+  def as_completed(futures):
+    """
+    Yields futures as they complete, like concurrent.futures.as_completed
+    Waits with a timeout, as KeyboardInterrupt only gets through to a waiting main thread between timeouts on Python 2
+    """
+    pending = set(futures)
+    while pending:
+      done, pending = concurrent.futures.wait(pending, JinstaScrape.INTERRUPT_POLL_INTERVAL, concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        yield future
+
 def main():
   parser = argparse.ArgumentParser(
     description="Scrapes Instagram posts by hashtags and locations",
     formatter_class=argparse.RawDescriptionHelpFormatter
   )
-  parser.add_argument('--scrape-by-hashtags', '-sbh', default=True, help='Indicates if scraping by hashtags')
+  parser.add_argument('--scrape-by-hashtags', '-sbh', action='store_true', default=True, help='Indicates if scraping by hashtags, which is the default')
+  parser.add_argument('--no-scrape-by-hashtags', '-nsbh', action='store_false', dest='scrape_by_hashtags', help='Skip scraping by hashtags')
   parser.add_argument('--hashtags-path', '-hp', default='./hashtags.txt', help='Path for text file containing list of hashtags to scrape')
-  parser.add_argument('--manifest-path', '-mp', default='./manifest.json', help='Path for JSON manifest file')
-  parser.add_argument('--download', '-d', default=False, help='Download the images and videos')
+  parser.add_argument('--scrape-by-locations', '-sbl', action='store_true', help='Indicates if scraping by locations')
+  parser.add_argument('--locations-path', '-lp', default='./locations.txt', help='Path for text file containing list of location ids to scrape')
+  parser.add_argument('--manifest-path', '-mp', default='./manifest.jsonl', help='Path for manifest file. Append-only if it ends in .jsonl, else a single JSON file')
+  parser.add_argument('--pretty-json', '-pj', action='store_true', help='Indent a .json manifest and its checkpoints for reading, at the cost of slower writes')
+  parser.add_argument('--index-manifest', '-im', action='store_true', help='Keep the manifest index (<manifest path>.index) up to date while scraping. A .json manifest is indexed once the run is done')
+  parser.add_argument('--scrape-workers', '-sw', type=int, default=JinstaScrape.MAX_WORKERS, help='Number of concurrent post fetches while scraping')
+  parser.add_argument('--parallel-queries', '-pq', type=int, default=JinstaScrape.MAX_PARALLEL_QUERIES, help='Number of hashtags and locations paged at once')
+  parser.add_argument('--stop-at-scraped', '-sas', action='store_true', help='Stop paging a query once a whole page was scraped before')
+  parser.add_argument('--refresh-age', '-ra', type=float, default=None, help='Instead of paging queries, refetch posts of manifest last scraped over this many hours ago')
+  parser.add_argument('--refresh-pending', '-rp', action='store_true', help='Instead of paging queries, refetch posts of manifest with media left to download')
+  parser.add_argument('--sessions-path', '-sp', default=None, help='Path for text file of sessions to spread requests across, one per line as: user agent, proxy url and cookies separated by tabs. Defaults to a single session')
+  parser.add_argument('--engine', '-e', choices=JinstaScrape.ENGINES, default='threads', help='Concurrency engine used for requests')
+  parser.add_argument('--role', '-r', choices=JinstaScrape.ROLES, default='standalone', help='Scrape alone, or as coordinator or worker sharing a work queue')
+  parser.add_argument('--queue-path', '-qp', default='./queue.db', help='Path for SQLite work queue shared by coordinator and workers')
+  parser.add_argument('--worker-id', '-wi', default='{0}:{1}'.format(socket.gethostname(), os.getpid()), help='Name a worker holds its leases under')
+  parser.add_argument('--download', '-d', action='store_true', help='Download the images and videos')
+  parser.add_argument('--pipeline', '-pl', action='store_true', help='With -d, download media as posts are scraped rather than afterwards')
   parser.add_argument('--downloads-directory', '-dd', default='./downloads', help='Downloads directory')
+  parser.add_argument('--download-workers', '-dw', type=int, default=JinstaScrape.MAX_WORKERS, help='Number of concurrent media downloads')
+  parser.add_argument('--chunk-size', '-cs', type=int, default=JinstaScrape.DOWNLOAD_CHUNK_SIZE, help='Bytes read and written at a time while downloading')
+  parser.add_argument('--video-workers', '-vw', type=int, default=None, help='Number of download workers kept for videos. Defaults to one in {0}'.format(JinstaScrape.VIDEO_WORKER_SHARE))
+  parser.add_argument('--max-bytes-in-flight', '-mb', type=int, default=JinstaScrape.MAX_DOWNLOAD_BYTES_IN_FLIGHT, help='Bytes of media downloaded at once, going by the mean size of earlier downloads')
+  parser.add_argument('--metrics-path', '-mx', default=None, help='Path to periodically export metrics to')
+  parser.add_argument('--metrics-format', '-mf', choices=MetricsReporter.FORMATS, default='json', help='Format of exported metrics. log writes them to the log instead of a file')
+  parser.add_argument('--metrics-interval', '-mi', type=float, default=10, help='Seconds between metrics exports')
+  parser.add_argument('--log-level', '-ll', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='Level of log messages to show. DEBUG shows every request')
   
   args = parser.parse_args()
+  logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+  del args.log_level
+  if (args.manifest_path == parser.get_default('manifest_path') and not os.path.exists(args.manifest_path)
+      and os.path.exists(JinstaScrape.LEGACY_MANIFEST_PATH)):
+    # Rather than start over from an empty manifest next to the one earlier versions kept by default
+    parser.error('found a manifest at {0}, the default path of earlier versions. Convert it with: '
+      'python manifest_store.py {0} {1}, or keep using it with: -mp {0}'.format(JinstaScrape.LEGACY_MANIFEST_PATH, args.manifest_path))
+  if args.engine == 'gevent' and not JinstaScrape.gevent_patched():
+    # Hand over to the gevent entry point so sockets are patched before requests is imported
+    engine_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gevent_engine.py')
+    os.execv(sys.executable, [sys.executable, engine_path] + sys.argv[1:])
   scraper = JinstaScrape(**vars(args))
   scraper.scrape()
 
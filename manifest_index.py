@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import calendar
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from datetime import datetime
+
+import serializer
+
+from manifest_store import JournalManifestStore, open_store
+
+class ManifestIndex(object):
+  """
+  Persistent secondary index of a manifest in a SQLite file, by default <manifest path>.index
+  Maps tags (lowercased), location ids and owner ids to shortcodes, and shortcodes to taken_at_timestamp
+  For a .jsonl journal it also keeps the offset of each post's latest line, so that posts are read without a scan,
+  and sync only indexes the lines appended since the last sync. Other manifests are reindexed whenever they change
+  """
+  POSTS_PER_BATCH = 10000
+  BUSY_TIMEOUT = 60 # seconds to wait for another process' write lock
+
+  def __init__(self, manifest_path, index_path=None):
+    self.manifest_path = manifest_path
+    self.index_path = index_path or manifest_path + '.index'
+    self.local = threading.local() # one connection per thread
+    with self.transaction() as db:
+      db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+      db.execute('CREATE TABLE IF NOT EXISTS posts (shortcode TEXT PRIMARY KEY, taken_at INTEGER, offset INTEGER)')
+      db.execute('CREATE INDEX IF NOT EXISTS posts_taken_at ON posts (taken_at)')
+      db.execute('CREATE TABLE IF NOT EXISTS post_keys (kind TEXT, key TEXT, shortcode TEXT)')
+      db.execute('CREATE INDEX IF NOT EXISTS keys_kind_key ON post_keys (kind, key)')
+      db.execute('CREATE INDEX IF NOT EXISTS post_keys_shortcode ON post_keys (shortcode)')
+
+  def sync(self):
+    """Brings index up to date with manifest on disk. Returns the number of posts (re)indexed"""
+    if not os.path.isfile(self.manifest_path):
+      return 0
+    stat = os.stat(self.manifest_path)
+    meta = self.__meta()
+    journal = isinstance(open_store(self.manifest_path), JournalManifestStore)
+    if journal and meta.get('inode') == stat.st_ino and meta.get('watermark', 0) <= stat.st_size:
+      start = meta.get('watermark', 0) # journal was only appended to since
+      if start == stat.st_size:
+        return 0
+    elif not journal and meta.get('inode') == stat.st_ino and meta.get('mtime') == stat.st_mtime:
+      return 0
+    else:
+      start = None # manifest was replaced, e.g. compacted, or is not a journal
+
+    post_count = 0
+    with self.transaction() as db:
+      if start is None:
+        db.execute('DELETE FROM posts')
+        db.execute('DELETE FROM post_keys')
+      if journal:
+        records = _iter_journal_lines(self.manifest_path, start or 0)
+      else:
+        records = ((None, None, post) for post in open_store(self.manifest_path).iter_posts())
+      watermark = start or 0
+      batch = []
+      for offset, end, post in records:
+        batch.append((offset, post))
+        watermark = end
+        if len(batch) >= ManifestIndex.POSTS_PER_BATCH:
+          post_count += ManifestIndex.__index_posts(db, batch)
+          batch = []
+      post_count += ManifestIndex.__index_posts(db, batch)
+      db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [
+        ('inode', stat.st_ino), ('mtime', stat.st_mtime), ('watermark', watermark)
+      ])
+    return post_count
+
+  def shortcodes(self, tag=None, location=None, owner=None, since=None, until=None):
+    """
+    Returns shortcodes of posts matching every given filter, oldest first
+    since and until bound taken_at_timestamp, as unix timestamps in [since, until)
+    """
+    query, parameters = ManifestIndex.__filtered_posts(tag, location, owner, since, until)
+    rows = self.connection().execute('SELECT posts.shortcode ' + query + ' ORDER BY posts.taken_at', parameters)
+    return [shortcode for shortcode, in rows]
+
+  def time_buckets(self, bucket_seconds, tag=None, location=None, owner=None, since=None, until=None):
+    """Returns (bucket start timestamp, post count) of posts matching every given filter, per bucket_seconds"""
+    query, parameters = ManifestIndex.__filtered_posts(tag, location, owner, since, until)
+    rows = self.connection().execute(
+      'SELECT posts.taken_at / ? * ? AS bucket, COUNT(*) ' + query + ' GROUP BY bucket ORDER BY bucket',
+      [bucket_seconds, bucket_seconds] + parameters
+    )
+    return rows.fetchall()
+
+  def posts(self, shortcodes):
+    """Yields posts of given shortcodes from manifest, seeking to their lines if it is a journal"""
+    if not shortcodes:
+      return
+    rows = []
+    for i in range(0, len(shortcodes), 500): # stay below SQLite's bound on parameters
+      chunk = shortcodes[i:i + 500]
+      rows.extend(self.connection().execute(
+        'SELECT offset FROM posts WHERE shortcode IN ({0})'.format(','.join('?' * len(chunk))), chunk
+      ))
+    offsets = sorted(offset for offset, in rows)
+    if offsets and offsets[0] is not None:
+      with open(self.manifest_path, 'rb') as f:
+        for offset in offsets:
+          f.seek(offset)
+          yield serializer.loads(f.readline())
+      return
+    wanted = set(shortcodes)
+    for post in open_store(self.manifest_path).iter_posts():
+      if post['shortcode'] in wanted:
+        yield post
+
+  def connection(self):
+    """Returns this thread's connection to the index, in autocommit mode"""
+    if not hasattr(self.local, 'connection'):
+      self.local.connection = sqlite3.connect(self.index_path, timeout=ManifestIndex.BUSY_TIMEOUT, isolation_level=None)
+    return self.local.connection
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """Runs the block in a transaction, committed unless the block raises"""
+    db = self.connection()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+      yield db
+    except:
+      db.execute('ROLLBACK')
+      raise
+    db.execute('COMMIT')
+
+  def __meta(self):
+    return dict(self.connection().execute('SELECT key, value FROM meta'))
+
+  @staticmethod
+  def __index_posts(db, batch):
+    """Replaces the index entries of posts in batch of (journal offset, post). Returns the number of posts"""
+    db.executemany('DELETE FROM post_keys WHERE shortcode = ?', [(post['shortcode'],) for _, post in batch])
+    db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?)',
+      [(post['shortcode'], post['taken_at_timestamp'], offset) for offset, post in batch])
+    db.executemany('INSERT INTO post_keys VALUES (?, ?, ?)', [
+      key + (post['shortcode'],) for _, post in batch for key in ManifestIndex.keys_of(post)
+    ])
+    return len(batch)
+
+  @staticmethod
+  def keys_of(post):
+    """Returns the (kind, key) pairs post is indexed under"""
+    keys = set(('tag', tag.lower()) for tag in post['tags'])
+    if post['location']:
+      keys.add(('location', unicode(post['location']['id'])))
+    keys.add(('owner', unicode(post['owner']['id'])))
+    return keys
+
+  @staticmethod
+  def __filtered_posts(tag, location, owner, since, until):
+    """Returns the FROM and WHERE clauses selecting posts that match every given filter, and their parameters"""
+    query = ['FROM posts']
+    conditions = []
+    parameters = []
+    for i, (kind, key) in enumerate([('tag', tag and tag.lower()), ('location', location), ('owner', owner)]):
+      if key is not None:
+        query.append('JOIN post_keys AS k{0} ON k{0}.shortcode = posts.shortcode AND k{0}.kind = ? AND k{0}.key = ?'.format(i))
+        parameters.extend([kind, unicode(key)])
+    if since is not None:
+      conditions.append('posts.taken_at >= ?')
+      parameters.append(since)
+    if until is not None:
+      conditions.append('posts.taken_at < ?')
+      parameters.append(until)
+    if conditions:
+      query.append('WHERE ' + ' AND '.join(conditions))
+    return ' '.join(query), parameters
+
+def _iter_journal_lines(path, start):
+  """Yields (offset, end offset, post) of every complete line of journal from byte offset start"""
+  with open(path, 'rb') as f:
+    f.seek(start)
+    offset = start
+    for line in f:
+      if not line.endswith('\n'):
+        break # torn write from a crash during commit
+      end = offset + len(line)
+      if line.strip():
+        yield offset, end, serializer.loads(line)
+      offset = end
+
+def parse_time(value):
+  """Returns unix timestamp of a YYYY-MM-DD date (UTC) or of a timestamp given as is"""
+  if value is None or value.isdigit():
+    return value and int(value)
+  return calendar.timegm(datetime.strptime(value, '%Y-%m-%d').timetuple())
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Queries posts of a manifest by tag, location, owner and time through its persistent index",
+    formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('--manifest-path', '-mp', default='./manifest.jsonl', help='Path for manifest file (.jsonl journal or .json file)')
+  parser.add_argument('--index-path', '-ip', default=None, help='Path for index. Defaults to <manifest path>.index')
+  parser.add_argument('--tag', '-t', default=None, help='Only posts with this hashtag, without #')
+  parser.add_argument('--location', '-l', default=None, help='Only posts at this location id')
+  parser.add_argument('--owner', '-o', default=None, help='Only posts of this owner id')
+  parser.add_argument('--since', '-s', default=None, help='Only posts taken at or after this date (YYYY-MM-DD, UTC) or unix timestamp')
+  parser.add_argument('--until', '-u', default=None, help='Only posts taken before this date (YYYY-MM-DD, UTC) or unix timestamp')
+  parser.add_argument('--buckets', '-b', type=int, default=None, help='Print post counts per this many seconds (e.g. 86400 for days) instead of shortcodes')
+  parser.add_argument('--posts', '-p', action='store_true', help='Print matching posts as JSON lines instead of shortcodes')
+
+  args = parser.parse_args()
+  index = ManifestIndex(args.manifest_path, args.index_path)
+  indexed_count = index.sync()
+  if indexed_count:
+    print >> sys.stderr, 'Indexed {0} posts'.format(indexed_count)
+  filters = dict(tag=args.tag, location=args.location, owner=args.owner,
+    since=parse_time(args.since), until=parse_time(args.until))
+  if args.buckets:
+    for bucket, count in index.time_buckets(args.buckets, **filters):
+      print '{0}\t{1}'.format(datetime.utcfromtimestamp(bucket).isoformat(), count)
+  elif args.posts:
+    for post in index.posts(index.shortcodes(**filters)):
+      print json.dumps(post, ensure_ascii=False).encode('utf-8')
+  else:
+    for shortcode in index.shortcodes(**filters):
+      print shortcode
+
+if __name__ == '__main__':
+  main()
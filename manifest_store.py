@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import re
+
+import serializer
+
+from post import as_dict
+
+class ManifestStore(object):
+  """
+  Manifest stored as a single JSON object keyed by post shortcode
+  Every commit rewrites the whole file, atomically via a temporary file. Posts are written one per line unless
+  pretty, which indents the whole file for reading at the cost of much slower commits
+  """
+  READ_SIZE = 1 << 16
+  def __init__(self, path, pretty=False):
+    self.path = path
+    self.pretty = pretty
+
+  def load(self, post_factory=None):
+    """
+    Returns manifest on disk as a dict keyed by shortcode, or an empty one if there is none yet
+    Given a post_factory, e.g. Post.from_dict, posts are streamed and kept as it returns them instead of as dicts
+    """
+    if not os.path.isfile(self.path):
+      return {}
+    if post_factory:
+      return dict((post['shortcode'], post_factory(post)) for post in self.iter_posts())
+    with open(self.path, 'rb') as f:
+      return serializer.load(f)
+
+  def iter_posts(self, post_factory=None):
+    """
+    Yields every post of manifest on disk one at a time without loading the whole manifest, as returned by
+    post_factory if given. The JSON object is decoded incrementally, one READ_SIZE chunk at a time
+    """
+    if not os.path.isfile(self.path):
+      return
+    decoder = json.JSONDecoder()
+    with open(self.path, 'rb') as f:
+      reader = _ChunkReader(f, ManifestStore.READ_SIZE)
+      reader.expect('{')
+      while not reader.skip('}'):
+        reader.skip(',')
+        reader.decode(decoder) # shortcode key
+        reader.expect(':')
+        post = reader.decode(decoder)
+        yield post_factory(post) if post_factory else post
+
+  def commit(self, manifest, shortcodes):
+    """Persists manifest, in which posts of given shortcodes changed since the last commit"""
+    with ManifestStore.atomic_writer(self.path) as f:
+      if self.pretty:
+        serializer.dump(dict((shortcode, as_dict(post)) for shortcode, post in manifest.iteritems()), f, pretty=True)
+        return
+      f.write('{')
+      separator = '\n'
+      for shortcode, post in manifest.iteritems():
+        f.write(separator + serializer.dumps(shortcode) + ':' + serializer.dumps(as_dict(post)))
+        separator = ',\n'
+      f.write('\n}\n')
+
+  def compact(self, manifest):
+    """Rewrites manifest on disk without superseded records"""
+    self.commit(manifest, manifest.keys())
+
+  def load_checkpoints(self):
+    """Returns the pagination checkpoints kept alongside manifest, keyed by query"""
+    if not os.path.isfile(self.checkpoints_path()):
+      return {}
+    with open(self.checkpoints_path(), 'rb') as f:
+      return serializer.load(f)
+
+  def commit_checkpoints(self, checkpoints):
+    """Atomically replaces the pagination checkpoints kept alongside manifest"""
+    with ManifestStore.atomic_writer(self.checkpoints_path()) as f:
+      serializer.dump(checkpoints, f, self.pretty)
+
+  def checkpoints_path(self):
+    return self.path + '.checkpoints'
+
+  @staticmethod
+  def atomic_writer(path):
+    """Returns a writer of bytes, or of unicode as utf-8, to path whose contents only replace path once it is closed"""
+    return _AtomicWriter(path)
+
+class JournalManifestStore(ManifestStore):
+  """
+  Append-only manifest with one JSON post per line, where later lines supersede earlier ones of the same shortcode
+  Commits append only the changed posts and are fsynced, so their cost scales with the change, not the manifest.
+  The journal is compacted once superseded lines outnumber live posts by COMPACTION_RATIO
+  """
+  COMPACTION_RATIO = 2
+  MIN_COMPACTION_RECORDS = 10000
+
+  def __init__(self, path, pretty=False):
+    super(JournalManifestStore, self).__init__(path, pretty) # lines are never pretty, only checkpoints are
+    self.record_count = 0 # lines in journal, including superseded ones
+
+  def load(self, post_factory=None):
+    manifest = {}
+    self.record_count = 0
+    if not os.path.isfile(self.path):
+      return manifest
+    valid_length = 0 # bytes of journal up to the last complete line
+    with open(self.path, 'rb') as f:
+      for line in f:
+        if not line.endswith('\n'):
+          break # torn write from a crash during commit
+        valid_length += len(line)
+        if line.strip():
+          post = serializer.loads(line)
+          manifest[post['shortcode']] = post_factory(post) if post_factory else post
+          self.record_count += 1
+    if valid_length < os.path.getsize(self.path):
+      print 'Discarding incomplete last record of', self.path
+      with open(self.path, 'r+b') as f:
+        f.truncate(valid_length)
+    return manifest
+
+  def iter_posts(self, post_factory=None):
+    """
+    Yields the latest record of every post in journal one at a time, as returned by post_factory if given
+    A first pass indexes the last line of each shortcode so that superseded lines can be skipped on the second,
+    hence memory is bounded by that index rather than by the posts themselves
+    """
+    if not os.path.isfile(self.path):
+      return
+    last_lines = {}
+    for line_number, post in self.__iter_records():
+      last_lines[post['shortcode']] = line_number
+    if len(last_lines) == self.record_count:
+      last_lines = None # journal is compact, nothing to skip
+    for line_number, post in self.__iter_records():
+      if last_lines is None or last_lines[post['shortcode']] == line_number:
+        yield post_factory(post) if post_factory else post
+
+  def __iter_records(self):
+    """Yields (line number, post) of every complete line in journal"""
+    self.record_count = 0
+    with open(self.path, 'rb') as f:
+      for line_number, line in enumerate(f):
+        if not line.endswith('\n'):
+          break # torn write from a crash during commit
+        if line.strip():
+          self.record_count += 1
+          yield line_number, serializer.loads(line)
+
+  def commit(self, manifest, shortcodes):
+    if not shortcodes:
+      return
+    with open(self.path, 'ab') as f:
+      for shortcode in shortcodes:
+        f.write(JournalManifestStore.encode_post(manifest[shortcode]))
+      f.flush()
+      os.fsync(f.fileno())
+    self.record_count += len(shortcodes)
+    if self.record_count >= JournalManifestStore.MIN_COMPACTION_RECORDS and \
+        self.record_count > JournalManifestStore.COMPACTION_RATIO * len(manifest):
+      self.compact(manifest)
+
+  def compact(self, manifest):
+    print 'Compacting', self.path
+    with ManifestStore.atomic_writer(self.path) as f:
+      for post in manifest.itervalues():
+        f.write(JournalManifestStore.encode_post(post))
+    self.record_count = len(manifest)
+
+  @staticmethod
+  def encode_post(post):
+    """Returns post, as a dict or a Post, as one line of journal"""
+    return serializer.dumps(as_dict(post)) + '\n'
+
+class _AtomicWriter(object):
+  """Context manager writing to a temporary file that is fsynced and renamed over path on success"""
+  def __init__(self, path):
+    self.path = path
+    self.temp_path = path + '.tmp'
+
+  def __enter__(self):
+    self.file = open(self.temp_path, 'wb')
+    return self
+
+  def write(self, data):
+    self.file.write(data.encode('utf-8') if isinstance(data, unicode) else data)
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.file.close()
+      os.remove(self.temp_path)
+      return False
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.file.close()
+    os.rename(self.temp_path, self.path)
+    return False
+
+class _ChunkReader(object):
+  """Buffered reader over a file for decoding one JSON value at a time"""
+  WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+  def __init__(self, f, read_size):
+    self.file = f
+    self.read_size = read_size
+    self.buffer = ''
+    self.position = 0
+    self.eof = False
+
+  def skip(self, token):
+    """Consumes token if it is next after whitespace. Returns True if it was"""
+    self.__skip_whitespace()
+    while len(self.buffer) - self.position < len(token) and self.__fill():
+      pass
+    if self.buffer.startswith(token, self.position):
+      self.position += len(token)
+      return True
+    return False
+
+  def expect(self, token):
+    """Consumes token, raising ValueError if it is not next after whitespace"""
+    if not self.skip(token):
+      raise ValueError('Expected {0!r} at byte {1} of {2}'.format(token, self.position, self.file.name))
+
+  def decode(self, decoder):
+    """Decodes and consumes the next JSON value, reading further chunks until it is complete"""
+    self.__skip_whitespace()
+    while True:
+      try:
+        value, end = decoder.raw_decode(self.buffer, self.position)
+        # A number running up to the end of buffer may continue in the next chunk
+        if end < len(self.buffer) or self.eof:
+          self.position = end
+          return value
+      except ValueError:
+        if self.eof:
+          raise
+      self.__fill()
+
+  def __skip_whitespace(self):
+    while True:
+      self.position = _ChunkReader.WHITESPACE.match(self.buffer, self.position).end()
+      if self.position < len(self.buffer) or not self.__fill():
+        return
+
+  def __fill(self):
+    """Appends the next chunk to buffer, dropping what was consumed. Returns False at end of file"""
+    if self.eof:
+      return False
+    chunk = self.file.read(self.read_size)
+    self.buffer = self.buffer[self.position:] + chunk
+    self.position = 0
+    self.eof = not chunk
+    return bool(chunk)
+
+def open_store(path, pretty=False):
+  """Returns the manifest store for path: append-only for .jsonl files, else a single JSON file"""
+  if path.endswith('.jsonl'):
+    return JournalManifestStore(path, pretty)
+  return ManifestStore(path, pretty)
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Converts a manifest between single JSON file (.json) and append-only journal (.jsonl) formats",
+    formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('source_path', help='Path of manifest to convert')
+  parser.add_argument('target_path', help='Path of converted manifest. Format follows the file extension')
+  parser.add_argument('--pretty', '-p', action='store_true', help='Indent a .json target for reading instead of writing one post per line')
+
+  args = parser.parse_args()
+  manifest = open_store(args.source_path).load()
+  open_store(args.target_path, args.pretty).compact(manifest)
+  print '{0} posts written to {1}'.format(len(manifest), args.target_path)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import threading
+
+from urlparse import urlparse
+
+class MediaStore(object):
+  """
+  Content-addressed store of downloaded media, laid out under directory as:
+    objects/ab/cd/abcd...<ext>  one file per distinct content, named by its sha256 and sharded by its first bytes
+    partial/                    downloads in progress
+    index                       one line per known asset: asset key, sha256 and extension separated by tabs
+  The index lets an asset that was reached before, e.g. through a repost, be recorded without any request
+  """
+  def __init__(self, directory):
+    self.directory = directory
+    self.objects_directory = os.path.join(directory, 'objects')
+    self.partial_directory = os.path.join(directory, 'partial')
+    self.index_path = os.path.join(directory, 'index')
+    self.lock = threading.Lock()
+    self.index = {} # asset key -> (sha256, extension)
+    self.reused_count = 0 # media recorded from the index without downloading
+    make_directory(self.objects_directory)
+    make_directory(self.partial_directory)
+    self.__load_index()
+
+  def lookup(self, url):
+    """Returns (path, sha256) of the stored object for url if its asset is known, else (None, None)"""
+    with self.lock:
+      entry = self.index.get(MediaStore.asset_key(url))
+    if entry is None:
+      return None, None
+    sha256, extension = entry
+    path = self.object_path(sha256, extension)
+    if not os.path.isfile(path): # object was removed behind our back
+      return None, None
+    with self.lock:
+      self.reused_count += 1
+    return path, sha256
+
+  def partial_path(self, post_shortcode, url):
+    """Returns the path an in-progress download of url is written to"""
+    return os.path.join(self.partial_directory, post_shortcode + '.' + MediaStore.asset_key(url) + '.part')
+
+  def add(self, url, part_path, sha256):
+    """Moves a completed download of url into the store and indexes it. Returns the object's path"""
+    extension = os.path.splitext(MediaStore.asset_key(url))[1]
+    path = self.object_path(sha256, extension)
+    make_directory(os.path.dirname(path))
+    if os.path.isfile(path):
+      os.remove(part_path) # same content arrived through another asset
+    else:
+      os.rename(part_path, path)
+    with self.lock:
+      self.index[MediaStore.asset_key(url)] = (sha256, extension)
+      with open(self.index_path, 'a') as f:
+        f.write('{0}\t{1}\t{2}\n'.format(MediaStore.asset_key(url), sha256, extension))
+    return path
+
+  def object_path(self, sha256, extension):
+    """Returns the path of the object with given content hash"""
+    return os.path.join(self.objects_directory, sha256[:2], sha256[2:4], sha256 + extension)
+
+  @staticmethod
+  def asset_key(url):
+    """
+    Returns the key identifying the asset behind url: its file name
+    CDN hosts and signed query strings differ between requests for the same asset, its file name does not
+    """
+    return urlparse(url).path.split('/')[-1]
+
+  def __load_index(self):
+    if not os.path.isfile(self.index_path):
+      return
+    with open(self.index_path) as f:
+      for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) == 3: # else torn write
+          self.index[fields[0]] = (fields[1], fields[2])
+
+def make_directory(directory):
+  """Creates a directory and its parents unless it exists. Raises OSError if the path is taken by a file"""
+  try:
+    os.makedirs(directory)
+  except OSError as err:
+    if err.errno != errno.EEXIST or not os.path.isdir(directory):
+      raise
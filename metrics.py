@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from manifest_store import ManifestStore
+
+logger = logging.getLogger('jinstascrape.metrics')
+
+class Metrics(object):
+  """
+  Thread-safe registry of counters, gauges and latency histograms, each identified by a name and labels
+  Gauges can also be functions, sampled whenever a snapshot is taken
+  """
+  PREFIX = 'jinstascrape_'
+  BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')) # seconds
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {} # (name, labels) -> value
+    self.gauges = {} # (name, labels) -> value or function returning it
+    self.histograms = {} # (name, labels) -> [count per bucket, sum]
+
+  def count(self, name, amount=1, **labels):
+    """Adds amount to a counter"""
+    key = (name, Metrics.label_items(labels))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + amount
+
+  def gauge(self, name, value, **labels):
+    """Sets a gauge to value, or to a function returning it when sampled"""
+    with self.lock:
+      self.gauges[(name, Metrics.label_items(labels))] = value
+
+  def observe(self, name, seconds, **labels):
+    """Records a duration in a histogram"""
+    key = (name, Metrics.label_items(labels))
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = [[0] * len(Metrics.BUCKETS), 0.0]
+      buckets, _ = self.histograms[key]
+      for i, bound in enumerate(Metrics.BUCKETS):
+        if seconds <= bound:
+          buckets[i] += 1
+          break
+      self.histograms[key][1] += seconds
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    """Records the duration of the block in a histogram unless it raises, e.g. RequestDeferred"""
+    start_time = time.time()
+    yield
+    self.observe(name, time.time() - start_time, **labels)
+
+  def snapshot(self):
+    """Returns every metric as JSON-serializable dicts keyed by name, with one entry per set of labels"""
+    with self.lock:
+      counters = self.counters.items()
+      gauges = self.gauges.items()
+      histograms = [(key, (list(buckets), total)) for key, (buckets, total) in self.histograms.iteritems()]
+    snapshot = {'timestamp': time.time(), 'counters': {}, 'gauges': {}, 'histograms': {}}
+    for (name, labels), value in counters:
+      snapshot['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+    for (name, labels), value in gauges:
+      snapshot['gauges'].setdefault(name, []).append({'labels': dict(labels), 'value': value() if callable(value) else value})
+    for (name, labels), (buckets, total) in histograms:
+      count = sum(buckets)
+      snapshot['histograms'].setdefault(name, []).append({
+        'labels': dict(labels), 'count': count, 'sum': total,
+        'p50': Metrics.quantile(buckets, 0.5), 'p99': Metrics.quantile(buckets, 0.99),
+        'buckets': [[bound if bound != float('inf') else '+Inf', bucket] for bound, bucket in zip(Metrics.BUCKETS, buckets)]
+      })
+    return snapshot
+
+  def prometheus_text(self):
+    """Returns every metric in Prometheus text exposition format"""
+    snapshot = self.snapshot()
+    lines = []
+    for kind in ['counters', 'gauges']:
+      for name, series in sorted(snapshot[kind].iteritems()):
+        lines.append('# TYPE {0}{1} {2}'.format(Metrics.PREFIX, name, kind[:-1]))
+        for entry in series:
+          lines.append('{0}{1}{2} {3}'.format(Metrics.PREFIX, name, Metrics.label_text(entry['labels']), entry['value']))
+    for name, series in sorted(snapshot['histograms'].iteritems()):
+      lines.append('# TYPE {0}{1} histogram'.format(Metrics.PREFIX, name))
+      for entry in series:
+        cumulative = 0
+        for bound, bucket in entry['buckets']:
+          cumulative += bucket
+          labels = dict(entry['labels'], le=str(bound))
+          lines.append('{0}{1}_bucket{2} {3}'.format(Metrics.PREFIX, name, Metrics.label_text(labels), cumulative))
+        lines.append('{0}{1}_sum{2} {3}'.format(Metrics.PREFIX, name, Metrics.label_text(entry['labels']), entry['sum']))
+        lines.append('{0}{1}_count{2} {3}'.format(Metrics.PREFIX, name, Metrics.label_text(entry['labels']), entry['count']))
+    return '\n'.join(lines) + '\n'
+
+  @staticmethod
+  def label_items(labels):
+    return tuple(sorted(labels.iteritems()))
+
+  @staticmethod
+  def label_text(labels):
+    if not labels:
+      return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, value) for key, value in sorted(labels.iteritems())) + '}'
+
+  @staticmethod
+  def quantile(buckets, q):
+    """Returns the upper bound of the bucket holding quantile q, or None if there are no observations"""
+    count = sum(buckets)
+    if not count:
+      return None
+    cumulative = 0
+    for bound, bucket in zip(Metrics.BUCKETS, buckets):
+      cumulative += bucket
+      if cumulative >= q * count:
+        return bound if bound != float('inf') else '+Inf'
+
+class MetricsReporter(object):
+  """
+  Exports metrics every interval seconds on a background thread, and once more when stopped
+  Formats are 'json' and 'prometheus', written atomically over path, or 'log' for a JSON line logged at INFO
+  """
+  FORMATS = ['json', 'prometheus', 'log']
+
+  def __init__(self, metrics, path, format='json', interval=10):
+    self.metrics = metrics
+    self.path = path
+    self.format = format
+    self.interval = interval
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.__run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread:
+      self.thread.join()
+    self.export()
+
+  def export(self):
+    if self.format == 'log':
+      logger.info(json.dumps(self.metrics.snapshot()))
+      return
+    with ManifestStore.atomic_writer(self.path) as f:
+      if self.format == 'prometheus':
+        f.write(self.metrics.prometheus_text())
+      else:
+        f.write(json.dumps(self.metrics.snapshot(), indent=2))
+
+  def __run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.export()
+      except Exception as e:
+        logger.warning('Exporting metrics failed: %s', e)
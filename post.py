@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import operator
+
+import serializer
+
+class Record(object):
+  """
+  Compact form of a JSON object of the manifest, holding its fields in __slots__ rather than in a dict
+  KEYS lists (JSON key, attribute) pairs. A key missing from the object leaves its attribute unset, and keys
+  outside of KEYS are kept in extra, so that to_dict returns exactly the object the record was made from
+  Keys in OPTIONAL_KEYS are expected to be missing at times, the others are read all at once
+  DECODERS and ENCODERS convert the values of some attributes to and from their compact form, and are folded
+  into SETTERS and GETTERS by _prepare once a record class is complete
+  """
+  __slots__ = ['extra']
+  KEYS = []
+  OPTIONAL_KEYS = []
+  DECODERS = {}
+  ENCODERS = {}
+
+  @classmethod
+  def from_dict(cls, d):
+    record = cls.__new__(cls)
+    try:
+      values = cls.GET_REQUIRED(d)
+    except KeyError:
+      values = ()
+      setters = cls.SETTERS # a required key is missing, look up every key
+    else:
+      for (attribute, decoder), value in zip(cls.REQUIRED_SETTERS, values):
+        setattr(record, attribute, decoder(value) if decoder else value)
+      setters = cls.OPTIONAL_SETTERS
+    found_count = len(values)
+    for key, attribute, decoder in setters:
+      if key in d:
+        found_count += 1
+        setattr(record, attribute, decoder(d[key]) if decoder else d[key])
+    if found_count == len(d):
+      record.extra = None
+    else:
+      record.extra = dict((key, value) for key, value in d.iteritems() if key not in cls.ATTRIBUTES)
+    return record
+
+  @classmethod
+  def reader(cls, attributes):
+    """
+    Returns a function making records that only hold given attributes of an object, for read-only uses such as
+    counting, where decoding the other attributes would be wasted. Such records must not be written back
+    """
+    setters = [(key, attribute, decoder) for key, attribute, decoder in cls.SETTERS if attribute in attributes]
+    def read(d):
+      record = cls.__new__(cls)
+      record.extra = None
+      for key, attribute, decoder in setters:
+        if key in d:
+          setattr(record, attribute, decoder(d[key]) if decoder else d[key])
+      return record
+    return read
+
+  def to_dict(self):
+    d = dict(self.extra) if self.extra else {}
+    for key, attribute, encoder in self.GETTERS:
+      try:
+        value = getattr(self, attribute)
+      except AttributeError:
+        continue # key was missing
+      d[key] = encoder(value) if encoder else value
+    return d
+
+  def __eq__(self, other):
+    return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __reduce__(self):
+    return _from_dict, (type(self), self.to_dict())
+
+  def __repr__(self):
+    return '{0}({1!r})'.format(type(self).__name__, self.to_dict())
+
+class _InternedRecord(Record):
+  """
+  Record that is shared by every post holding an equal object, e.g. the owner of many posts. Must not be modified
+  Interned records are kept for the whole process, as the posts of a manifest usually are
+  """
+  __slots__ = []
+
+  @classmethod
+  def from_dict(cls, d):
+    try:
+      if len(d) != len(cls.KEYS):
+        raise KeyError # missing or extra keys, not shared
+      key = cls.GET_REQUIRED(d) # refers to the record's own values
+      record = cls.INTERNED.get(key)
+    except (KeyError, TypeError): # unhashable values, not shared either
+      return super(_InternedRecord, cls).from_dict(d)
+    if record is None:
+      record = super(_InternedRecord, cls).from_dict(d)
+      cls.INTERNED[key] = record
+    return record
+
+class Owner(_InternedRecord):
+  __slots__ = ['id', 'profile_pic_url', 'username', 'full_name', 'is_private', 'is_unpublished', 'is_verified']
+  KEYS = [(attribute, attribute) for attribute in __slots__]
+  INTERNED = {}
+
+class Location(_InternedRecord):
+  __slots__ = ['id', 'name', 'slug', 'has_public_page']
+  KEYS = [(attribute, attribute) for attribute in __slots__]
+  INTERNED = {}
+
+class Caption(Record):
+  __slots__ = ['text', 'caption_is_edited']
+  KEYS = [(attribute, attribute) for attribute in __slots__]
+  OPTIONAL_KEYS = ['caption_is_edited'] # only set if there is a caption
+
+class Comments(Record):
+  """Preview comments of a post, whose nodes are kept packed as JSON"""
+  __slots__ = ['count', 'has_next_page', 'end_cursor', 'comments_disabled', 'entries']
+  KEYS = [(attribute, attribute) for attribute in __slots__]
+
+class Likes(Record):
+  """Preview likes of a post, whose nodes are kept packed as JSON"""
+  __slots__ = ['count', 'entries']
+  KEYS = [(attribute, attribute) for attribute in __slots__]
+
+class MediaItem(Record):
+  """Image or video of a post, updated in place once downloaded. Tagged user nodes are kept packed as JSON"""
+  __slots__ = ['typename', 'shortcode', 'id', 'url', 'downloaded_path', 'downloaded_at', 'size', 'sha256', 'tagged_users']
+  KEYS = [('__typename', 'typename')] + [(attribute, attribute) for attribute in __slots__[1:]]
+  OPTIONAL_KEYS = ['url', 'downloaded_at', 'size', 'sha256'] # url is missing for unknown typenames
+
+  def downloaded(self):
+    """Asserts if media was downloaded and its size checked. Earlier versions recorded downloads without a size"""
+    return bool(self.downloaded_path) and getattr(self, 'size', None) is not None # optional keys may be unset
+
+class Post(Record):
+  """
+  Post of the manifest, as built by JinstaScrape.process_post
+  Owners and locations are shared between the posts that have equal ones, and typenames and tags are interned
+  etag and last_modified are the validators of the post page it was fetched from, if the server sent any
+  """
+  __slots__ = [
+    'typename', 'id', 'shortcode', 'is_video', 'taken_at_timestamp', 'last_scraped_at', 'is_ad', 'location',
+    'owner', 'media_items', 'caption', 'tags', 'comments', 'likes', 'etag', 'last_modified'
+  ]
+  KEYS = [('__typename', 'typename')] + [(attribute, attribute) for attribute in __slots__[1:]]
+  OPTIONAL_KEYS = ['etag', 'last_modified']
+
+######## COMPACT VALUES ########################################################
+_strings = {}
+
+def intern_string(s):
+  """Returns the one copy of s kept for every equal string, e.g. a hashtag used by many posts"""
+  return _strings.setdefault(s, s)
+
+def pack(nodes):
+  """Returns a list of nodes that are only ever written back out as one JSON string, or () if it is empty"""
+  if not isinstance(nodes, list):
+    return nodes
+  return serializer.dumps(nodes) if nodes else ()
+
+def unpack(packed):
+  """Returns the list of nodes packed by pack"""
+  if isinstance(packed, str):
+    return serializer.loads(packed)
+  if packed == ():
+    return []
+  return packed
+
+def _decode_optional(record_class):
+  return lambda value: record_class.from_dict(value) if isinstance(value, dict) else value
+
+def as_dict(value):
+  """Returns a record as the dict it was made from and any other value as is, e.g. a post that is already a dict"""
+  return value.to_dict() if isinstance(value, Record) else value
+
+def _decode_list(decode):
+  return lambda values: tuple([decode(value) for value in values]) if isinstance(values, list) else values
+
+def _encode_list(encode):
+  return lambda values: [encode(value) for value in values] if isinstance(values, tuple) else values
+
+def _from_dict(record_class, d):
+  return record_class.from_dict(d)
+
+Comments.DECODERS = Likes.DECODERS = {'entries': pack}
+Comments.ENCODERS = Likes.ENCODERS = {'entries': unpack}
+MediaItem.DECODERS = {'typename': intern_string, 'tagged_users': pack}
+MediaItem.ENCODERS = {'tagged_users': unpack}
+Post.DECODERS = {
+  'typename': intern_string,
+  'location': _decode_optional(Location),
+  'owner': _decode_optional(Owner),
+  'media_items': _decode_list(_decode_optional(MediaItem)),
+  'caption': _decode_optional(Caption),
+  'tags': _decode_list(intern_string),
+  'comments': _decode_optional(Comments),
+  'likes': _decode_optional(Likes)
+}
+Post.ENCODERS = {
+  'location': as_dict,
+  'owner': as_dict,
+  'media_items': _encode_list(as_dict),
+  'caption': as_dict,
+  'tags': _encode_list(lambda tag: tag),
+  'comments': as_dict,
+  'likes': as_dict
+}
+
+def _prepare(record_class):
+  record_class.ATTRIBUTES = dict(record_class.KEYS)
+  record_class.SETTERS = [
+    (key, attribute, record_class.DECODERS.get(attribute)) for key, attribute in record_class.KEYS
+  ]
+  required_keys = [key for key, _ in record_class.KEYS if key not in record_class.OPTIONAL_KEYS]
+  getter = operator.itemgetter(*required_keys)
+  # as a tuple, raising KeyError if one is missing
+  record_class.GET_REQUIRED = staticmethod(getter if len(required_keys) > 1 else lambda d: (getter(d),))
+  record_class.REQUIRED_SETTERS = [
+    (attribute, decoder) for key, attribute, decoder in record_class.SETTERS if key in required_keys
+  ]
+  record_class.OPTIONAL_SETTERS = [setter for setter in record_class.SETTERS if setter[0] in record_class.OPTIONAL_KEYS]
+  record_class.GETTERS = [
+    (key, attribute, record_class.ENCODERS.get(attribute)) for key, attribute in record_class.KEYS
+  ]
+
+for _record_class in [Owner, Location, Caption, Comments, Likes, MediaItem, Post]:
+  _prepare(_record_class)
@@ -0,0 +1,341 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import random
+import re
+import SocketServer
+import threading
+import time
+
+from urlparse import urlparse, parse_qs
+
+from media_store import make_directory
+
+# Media urls in fixtures start with this prefix, which is replaced by the server's own media url when served
+MEDIA_URL_PREFIX = 'http://replay.invalid/media/'
+FIRST_PAGE = '_first' # fixture name of the page requested without a cursor
+
+class ReplayServer(object):
+  """
+  Local stand-in for Instagram replaying fixtures laid out under fixtures_directory as:
+    hashtags/<tag>/<cursor>.json    graphql payload of the hashtag page requested with after=<cursor>
+    locations/<id>/<cursor>.json    graphql payload of the location page requested with after=<cursor>
+    posts/<shortcode>.json          ?__a=1 payload of the post
+    media/<file name>               media bytes, served with HTTP Range support
+  The first page of a query is stored as FIRST_PAGE.json
+  Every request is delayed by latency seconds (+/- jitter), and answered with a 429 carrying Retry-After
+  or dropped mid-response with given probabilities. Given throttled_agents, only requests sent with one of these
+  User-Agent headers are answered with 429s, as when some identities of a scraper are being throttled
+  JSON payloads carry an ETag, and a request whose If-None-Match matches it is answered with 304 Not Modified
+  Given a url_lifetime, media urls are signed like CDN urls with an oe=<hex unix time> expiry, and requests
+  for expired ones are answered with 403. The ETag does not change with the signatures
+  """
+  MEDIA_URL = re.compile(r'http://[^/"]+/media/[^"?]+') # as rewritten in served payloads
+
+  def __init__(self, fixtures_directory, port=0, latency=0, jitter=0, rate_limit_ratio=0, retry_after=1, drop_ratio=0,
+      url_lifetime=0, seed=0, throttled_agents=None):
+    self.fixtures_directory = fixtures_directory
+    self.latency = latency
+    self.jitter = jitter
+    self.rate_limit_ratio = rate_limit_ratio
+    self.retry_after = retry_after
+    self.drop_ratio = drop_ratio
+    self.url_lifetime = url_lifetime
+    self.throttled_agents = set(throttled_agents) if throttled_agents else None
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.counts = {'requests': 0, 'rate_limited': 0, 'dropped': 0, 'not_modified': 0, 'expired': 0, 'bytes': 0}
+    self.json_cache = {} # fixture path -> (body with media urls rewritten, ETag)
+    self.server = _ThreadingHTTPServer(('127.0.0.1', port), _ReplayHandler)
+    self.server.replay = self
+    self.thread = None
+
+  @property
+  def base_url(self):
+    """Returns the url standing in for https://www.instagram.com/"""
+    return 'http://{0}:{1}/'.format(*self.server.server_address)
+
+  def start(self):
+    """Serves requests on a background thread. Returns base_url"""
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self.base_url
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def serve_forever(self):
+    self.server.serve_forever()
+
+  def next_fault(self, user_agent=None):
+    """Waits out the simulated latency, then returns '429', 'drop' or None for the next response"""
+    with self.lock:
+      self.counts['requests'] += 1
+      delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+      draw = self.random.random()
+      fault = None
+      throttled = self.throttled_agents is None or user_agent in self.throttled_agents
+      rate_limit_ratio = self.rate_limit_ratio if throttled else 0
+      if draw < rate_limit_ratio:
+        fault = '429'
+        self.counts['rate_limited'] += 1
+      elif draw < rate_limit_ratio + self.drop_ratio:
+        fault = 'drop'
+        self.counts['dropped'] += 1
+    if delay > 0:
+      time.sleep(delay)
+    return fault
+
+  def count(self, name, amount=1):
+    with self.lock:
+      self.counts[name] += amount
+
+  def fixture_path(self, *parts):
+    return os.path.join(self.fixtures_directory, *parts)
+
+  def json_body(self, path):
+    """
+    Returns (body, ETag) of fixture at path with media urls pointing at this server, and signed if they expire,
+    or (None, None) if there is none
+    """
+    if path not in self.json_cache:
+      if not os.path.isfile(path):
+        return None, None
+      with open(path, 'rb') as f:
+        body = f.read().replace(MEDIA_URL_PREFIX, self.base_url + 'media/')
+      self.json_cache[path] = body, '"{0}"'.format(hashlib.sha1(body).hexdigest()[:16])
+    body, etag = self.json_cache[path]
+    if self.url_lifetime:
+      signature = '?oe={0:X}'.format(int(time.time() + self.url_lifetime))
+      body = ReplayServer.MEDIA_URL.sub(lambda match: match.group(0) + signature, body)
+    return body, etag
+
+  @staticmethod
+  def url_expired(query):
+    """Asserts if the query string of a media url carries an oe expiry that has passed"""
+    expiry = parse_qs(query).get('oe')
+    return bool(expiry) and int(expiry[0], 16) < time.time()
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+class _ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1' # keep-alive, as sessions pool connections
+  wbufsize = -1 # buffer headers with the body, flushed once per response
+  disable_nagle_algorithm = True # else delayed ACKs add ~40ms to every keep-alive response
+
+  def do_GET(self):
+    replay = self.server.replay
+    fault = replay.next_fault(self.headers.getheader('User-Agent'))
+    if fault == '429':
+      self.send_response(429)
+      self.send_header('Retry-After', str(replay.retry_after))
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+
+    parsed = urlparse(self.path)
+    segments = [segment for segment in parsed.path.split('/') if segment]
+    if segments[:1] == ['media'] and len(segments) == 2:
+      if ReplayServer.url_expired(parsed.query):
+        replay.count('expired')
+        return self.__send_empty(403)
+      return self.__send_media(replay.fixture_path('media', segments[1]), fault)
+    if fault == 'drop':
+      self.close_connection = 1 # before any response
+      return
+    if segments[:2] == ['graphql', 'query']:
+      query = parse_qs(parsed.query, keep_blank_values=True)
+      cursor = query.get('after', [''])[0] or FIRST_PAGE
+      if 'tag_name' in query:
+        path = replay.fixture_path('hashtags', query['tag_name'][0], cursor + '.json')
+      else:
+        path = replay.fixture_path('locations', query.get('id', [''])[0], cursor + '.json')
+    elif segments[:1] == ['p'] and len(segments) == 2:
+      path = replay.fixture_path('posts', segments[1] + '.json')
+    else:
+      path = None
+    body, etag = replay.json_body(path) if path else (None, None)
+    if body is None:
+      return self.__send_empty(404)
+    if self.headers.getheader('If-None-Match') == etag:
+      replay.count('not_modified')
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', etag)
+    self.end_headers()
+    self.wfile.write(body)
+    replay.count('bytes', len(body))
+
+  def __send_media(self, path, fault):
+    """Sends media file at path from the offset of a Range header if any; a dropped response stops halfway"""
+    if not os.path.isfile(path):
+      return self.__send_empty(404)
+    size = os.path.getsize(path)
+    offset = 0
+    range_header = self.headers.getheader('Range')
+    if range_header and range_header.startswith('bytes='):
+      offset = int(range_header[len('bytes='):].split('-')[0])
+      if offset >= size:
+        return self.__send_empty(416, {'Content-Range': 'bytes */{0}'.format(size)})
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(offset, size - 1, size))
+    else:
+      self.send_response(200)
+    self.send_header('Content-Type', 'application/octet-stream')
+    self.send_header('Content-Length', str(size - offset))
+    self.end_headers()
+    with open(path, 'rb') as f:
+      f.seek(offset)
+      body = f.read()
+    if fault == 'drop':
+      body = body[:len(body) // 2]
+      self.close_connection = 1
+    self.wfile.write(body)
+    self.server.replay.count('bytes', len(body))
+
+  def __send_empty(self, status, headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, format, *args):
+    pass # one line per request would dominate benchmarks
+
+def generate_fixtures(fixtures_directory, hashtags, pages, posts_per_page=100, media_size=32 * 1024, overlap=0.1, seed=0):
+  """
+  Writes synthetic fixtures for hashtags, each paging through pages of posts_per_page posts
+  A fraction overlap of each page's posts also appear under other hashtags, and carousels and videos are mixed in
+  Returns the number of distinct posts
+  """
+  rng = random.Random(seed)
+  shared_pool = ['shared{0:06d}'.format(i) for i in range(max(1, int(len(hashtags) * pages * posts_per_page * overlap)))]
+  posts = set()
+  for tag in hashtags:
+    tag_directory = os.path.join(fixtures_directory, 'hashtags', tag)
+    make_directory(tag_directory)
+    for page in range(pages):
+      shortcodes = [
+        rng.choice(shared_pool) if rng.random() < overlap else '{0}{1:04d}{2:03d}'.format(tag, page, i)
+        for i in range(posts_per_page)
+      ]
+      end_cursor = 'p{0}'.format(page + 1) if page + 1 < pages else None
+      payload = {'data': {'hashtag': {'edge_hashtag_to_media': {
+        'count': pages * posts_per_page,
+        'page_info': {'has_next_page': end_cursor is not None, 'end_cursor': end_cursor},
+        'edges': [{'node': {'shortcode': shortcode, 'id': shortcode}} for shortcode in shortcodes]
+      }}}}
+      with open(os.path.join(tag_directory, ('p{0}'.format(page) if page else FIRST_PAGE) + '.json'), 'wb') as f:
+        json.dump(payload, f)
+      posts.update(shortcodes)
+
+  make_directory(os.path.join(fixtures_directory, 'posts'))
+  make_directory(os.path.join(fixtures_directory, 'media'))
+  for shortcode in sorted(posts):
+    node = _synthetic_post_node(shortcode, rng)
+    with open(os.path.join(fixtures_directory, 'posts', shortcode + '.json'), 'wb') as f:
+      json.dump({'graphql': {'shortcode_media': node}}, f)
+    for media_node in node.get('edge_sidecar_to_children', {'edges': [{'node': node}]})['edges']:
+      url = media_node['node'].get('video_url') or media_node['node']['display_url']
+      with open(os.path.join(fixtures_directory, 'media', url[len(MEDIA_URL_PREFIX):]), 'wb') as f:
+        f.write(os.urandom(media_size))
+  return len(posts)
+
+def _synthetic_post_node(shortcode, rng):
+  """Returns a post node shaped like a ?__a=1 payload"""
+  def media_node(index, typename):
+    node = {
+      '__typename': typename,
+      'shortcode': '{0}_{1}'.format(shortcode, index),
+      'id': '{0}{1}'.format(abs(hash(shortcode)), index),
+      'display_url': '{0}{1}_{2}_n.jpg'.format(MEDIA_URL_PREFIX, shortcode, index),
+      'edge_media_to_tagged_user': {'edges': []}
+    }
+    if typename == 'GraphVideo':
+      node['video_url'] = '{0}{1}_{2}_n.mp4'.format(MEDIA_URL_PREFIX, shortcode, index)
+    return node
+
+  draw = rng.random()
+  typename = 'GraphSidecar' if draw < 0.2 else 'GraphVideo' if draw < 0.3 else 'GraphImage'
+  node = media_node(0, 'GraphImage' if typename == 'GraphSidecar' else typename)
+  node.update({
+    '__typename': typename,
+    'shortcode': shortcode,
+    'is_video': typename == 'GraphVideo',
+    'taken_at_timestamp': 1500000000 + rng.randint(0, 10 ** 7),
+    'is_ad': False,
+    'location': None,
+    'owner': {
+      'id': str(rng.randint(1, 10 ** 6)), 'profile_pic_url': MEDIA_URL_PREFIX + 'profile.jpg', 'username': 'user',
+      'full_name': 'User', 'is_private': False, 'is_unpublished': False, 'is_verified': False
+    },
+    'edge_media_to_caption': {'edges': [{'node': {'text': u'Replayed post #replay #{0} ☀'.format(shortcode)}}]},
+    'caption_is_edited': False,
+    'comments_disabled': False,
+    'edge_media_to_comment': {'count': 0, 'page_info': {'has_next_page': False, 'end_cursor': None}, 'edges': []},
+    'edge_media_preview_like': {'count': rng.randint(0, 500), 'edges': []}
+  })
+  if typename == 'GraphSidecar':
+    node['edge_sidecar_to_children'] = {'edges': [{'node': media_node(i, 'GraphImage')} for i in range(2)]}
+  return node
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Local stand-in for Instagram that replays fixtures, for offline runs and benchmarks",
+    formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  subparsers = parser.add_subparsers(dest='command')
+
+  generate_parser = subparsers.add_parser('generate', help='Write synthetic fixtures')
+  generate_parser.add_argument('--fixtures-directory', '-fd', default='./fixtures', help='Directory to write fixtures to')
+  generate_parser.add_argument('--hashtags', '-t', default='replay', help='Comma separated hashtags to generate')
+  generate_parser.add_argument('--pages', '-p', type=int, default=5, help='Pages per hashtag')
+  generate_parser.add_argument('--posts-per-page', '-pp', type=int, default=100, help='Posts per page')
+  generate_parser.add_argument('--media-size', '-ms', type=int, default=32 * 1024, help='Bytes per media file')
+  generate_parser.add_argument('--overlap', '-o', type=float, default=0.1, help='Fraction of posts shared between hashtags')
+
+  serve_parser = subparsers.add_parser('serve', help='Replay fixtures over HTTP')
+  serve_parser.add_argument('--fixtures-directory', '-fd', default='./fixtures', help='Directory of fixtures to replay')
+  serve_parser.add_argument('--port', '-p', type=int, default=8000, help='Port to listen on')
+  serve_parser.add_argument('--latency', '-l', type=float, default=0, help='Seconds every request is delayed by')
+  serve_parser.add_argument('--jitter', '-j', type=float, default=0, help='Seconds latency varies by, up or down')
+  serve_parser.add_argument('--rate-limit-ratio', '-rl', type=float, default=0, help='Fraction of requests answered with HTTP 429')
+  serve_parser.add_argument('--retry-after', '-ra', type=int, default=1, help='Retry-After seconds sent with HTTP 429')
+  serve_parser.add_argument('--drop-ratio', '-dr', type=float, default=0, help='Fraction of requests whose connection is dropped')
+  serve_parser.add_argument('--url-lifetime', '-ul', type=float, default=0, help='Seconds signed media urls stay valid. 0 serves unsigned urls')
+  serve_parser.add_argument('--throttled-agents', '-ta', default=None, help='Comma separated user agents that -rl applies to, instead of every request')
+
+  args = parser.parse_args()
+  if args.command == 'generate':
+    post_count = generate_fixtures(args.fixtures_directory, args.hashtags.split(','), args.pages,
+      args.posts_per_page, args.media_size, args.overlap)
+    print '{0} posts written to {1}'.format(post_count, args.fixtures_directory)
+  else:
+    replay = ReplayServer(args.fixtures_directory, args.port, args.latency, args.jitter,
+      args.rate_limit_ratio, args.retry_after, args.drop_ratio, args.url_lifetime,
+      throttled_agents=args.throttled_agents and args.throttled_agents.split(','))
+    print 'Replaying {0} at {1}'.format(args.fixtures_directory, replay.base_url)
+    try:
+      replay.serve_forever()
+    except KeyboardInterrupt:
+      print ('{requests} requests served, {rate_limited} rate limited, {dropped} dropped, {not_modified} not modified, '
+        '{expired} for expired urls, {bytes} bytes sent').format(**replay.counts)
+
+if __name__ == '__main__':
+  main()
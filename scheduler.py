@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import concurrent.futures
+
+from urlparse import urlparse
+
+logger = logging.getLogger('jinstascrape.scheduler')
+
+class RequestDeferred(Exception):
+  """Raised instead of sleeping when a request may only be (re)tried after delay seconds"""
+  def __init__(self, delay, retry_count):
+    super(RequestDeferred, self).__init__('Deferred for {0:.2f}s'.format(delay))
+    self.delay = delay
+    self.retry_count = retry_count
+
+class TokenBucket(object):
+  """Token bucket refilling at rate tokens per second up to capacity tokens"""
+  def __init__(self, rate, capacity):
+    self.rate = float(rate)
+    self.capacity = capacity
+    self.tokens = float(capacity)
+    self.updated_at = time.time()
+    self.paused_until = 0
+
+  def acquire(self, now):
+    """Takes a token and returns 0 if one is available, else returns seconds until one will be"""
+    if now < self.paused_until:
+      return self.paused_until - now
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0
+    return (1 - self.tokens) / self.rate
+
+  def pause(self, now, seconds):
+    """Withholds all tokens for given seconds, then refills from empty"""
+    self.paused_until = max(self.paused_until, now + seconds)
+    self.tokens = 0
+    self.updated_at = self.paused_until
+
+class RateScheduler(object):
+  """
+  Paces requests with a token bucket per (budget, host)
+  Budgets are: 'graphql' for paginated queries, 'post' for ?__a=1 post pages and 'media' for CDN hosts
+  """
+  def __init__(self, budgets):
+    """budgets maps each budget name to a (requests per second, burst size) tuple"""
+    self.budgets = budgets
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def acquire(self, url):
+    """Reserves a request slot for url. Returns 0 if granted, else seconds to wait before asking again"""
+    with self.lock:
+      return self.__bucket(url).acquire(time.time())
+
+  def pause(self, url, seconds):
+    """Pauses every request sharing url's budget, e.g. to honor Retry-After"""
+    with self.lock:
+      self.__bucket(url).pause(time.time(), seconds)
+    logger.warning('Rate limited on %s; pausing it for %ss', RateScheduler.budget_for(url), seconds)
+
+  def __bucket(self, url):
+    key = RateScheduler.budget_for(url)
+    if key not in self.buckets:
+      rate, capacity = self.budgets[key[0]]
+      self.buckets[key] = TokenBucket(rate, capacity)
+    return self.buckets[key]
+
+  @staticmethod
+  def budget_for(url):
+    """Returns the (budget, host) that url is paced under"""
+    parsed = urlparse(url)
+    if '/graphql/' in parsed.path:
+      return 'graphql', parsed.netloc
+    if '__a=1' in parsed.query:
+      return 'post', parsed.netloc
+    return 'media', parsed.netloc
+
+class RequeueingExecutor(object):
+  """
+  Wraps an executor to keep at most max_pending tasks in flight
+  Tasks are called as fn(key, retry_count). A task raising RequestDeferred is requeued once its delay
+  has passed instead of occupying a worker while it waits
+  """
+  def __init__(self, executor, max_pending, on_result, on_error=None, on_cancel=None):
+    """
+    on_result(key, result) is called for every completed task
+    on_error(key, exception) is called for every failed task; failures are re-raised if it is None
+    on_cancel(key) is called for every task dropped by cancel
+    """
+    self.executor = executor
+    self.max_pending = max_pending
+    self.on_result = on_result
+    self.on_error = on_error
+    self.on_cancel = on_cancel
+    self.pending = {} # future -> (fn, key)
+    self.deferred = [] # heap of (ready_at, sequence, fn, key, retry_count)
+    self.sequence = itertools.count() # tie-breaker so heap never compares tasks
+
+  def submit(self, fn, key, retry_count=0, poll_interval=None):
+    """
+    Submits task, first waiting for completions while the executor is saturated
+    Given a poll_interval, waits in steps of as many seconds, e.g. for KeyboardInterrupt to get through
+    """
+    while len(self.pending) >= self.max_pending:
+      self.wait(poll_interval)
+    self.pending[self.executor.submit(fn, key, retry_count)] = (fn, key)
+
+  def drain(self, poll_interval=None):
+    """Waits until every submitted and deferred task has completed, in steps of poll_interval seconds if given"""
+    while self.pending or self.deferred:
+      self.wait(poll_interval)
+
+  def saturated(self):
+    """Asserts if submit would have to wait for completions"""
+    return len(self.pending) >= self.max_pending
+
+  def cancel(self):
+    """Drops every queued and deferred task. Tasks already running are left to finish, but are dropped all the same"""
+    keys = [key for _, key in self.pending.itervalues()] + [key for _, _, _, key, _ in self.deferred]
+    for future in self.pending:
+      future.cancel()
+    self.pending = {}
+    self.deferred = []
+    if self.on_cancel:
+      for key in keys:
+        self.on_cancel(key)
+
+  def __len__(self):
+    return len(self.pending) + len(self.deferred)
+
+  def wait(self, timeout=None):
+    """
+    Resubmits due deferred tasks, then handles the tasks that complete before the next one is due,
+    or within timeout seconds if given. Returns at once if there are no tasks
+    """
+    if not self.pending and not self.deferred:
+      return
+    now = time.time()
+    while self.deferred and self.deferred[0][0] <= now and len(self.pending) < self.max_pending:
+      _, _, fn, key, retry_count = heapq.heappop(self.deferred)
+      self.pending[self.executor.submit(fn, key, retry_count)] = (fn, key)
+
+    if self.deferred and len(self.pending) < self.max_pending: # else only a completion makes room for them
+      due_in = self.deferred[0][0] - now
+      timeout = due_in if timeout is None else min(timeout, due_in)
+    if not self.pending:
+      time.sleep(timeout)
+      return
+    done, _ = concurrent.futures.wait(self.pending.keys(), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+      fn, key = self.pending.pop(future)
+      try:
+        result = future.result()
+      except RequestDeferred as deferral:
+        heapq.heappush(self.deferred, (time.time() + deferral.delay, next(self.sequence), fn, key, deferral.retry_count))
+        continue
+      except Exception as e:
+        if self.on_error is None:
+          raise
+        self.on_error(key, e)
+        continue
+      self.on_result(key, result)
+
+class DownloadScheduler(object):
+  """
+  Index of media pending download, kept up to date as posts are added, from which downloads are taken as room
+  frees up rather than submitted all at once
+  Media waits in one FIFO lane per kind, e.g. 'image' and 'video', tried in the order of lane_workers.
+  A lane keeps to its number of workers unless no other lane has media waiting, so that large videos do not hold
+  up every worker, and downloads in flight are capped at max_bytes_in_flight
+  Sizes are unknown until requested, so a download counts as the mean size of those completed in its lane,
+  starting from SIZE_ESTIMATES
+  """
+  SIZE_ESTIMATES = {'image': 256 << 10, 'video': 8 << 20} # bytes
+
+  def __init__(self, lane_workers, max_bytes_in_flight):
+    """lane_workers is a list of (lane, number of downloads it may have in flight)"""
+    self.lanes = [lane for lane, _ in lane_workers]
+    self.lane_workers = dict(lane_workers)
+    self.max_bytes_in_flight = max_bytes_in_flight
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock) # notified whenever media is queued or taken
+    self.queues = dict((lane, collections.deque()) for lane in self.lanes) # lane -> [shortcode, media]
+    self.waiting = {} # (shortcode, media id) -> its [shortcode, media] in queues
+    self.in_flight = {} # (shortcode, media id) -> (lane, bytes counted)
+    self.lane_in_flight = dict((lane, 0) for lane in self.lanes)
+    self.bytes_in_flight = 0
+    self.completed = dict((lane, [0, 0]) for lane in self.lanes) # lane -> [downloads with a size, bytes]
+
+  def add(self, shortcode, media, lane):
+    """
+    Queues media of post with given shortcode in lane, unless it is downloaded or in flight
+    Media that is already waiting is replaced, so that the download is recorded in the latest version of its post,
+    e.g. in the last line of a journal that holds several for the post
+    """
+    key = (shortcode, media.id)
+    with self.lock:
+      if key in self.waiting:
+        self.waiting[key][1] = media
+        return
+      if media.downloaded() or key in self.in_flight:
+        return
+      self.waiting[key] = entry = [shortcode, media]
+      self.queues[lane].append(entry)
+      self.changed.notify_all()
+
+  def take(self):
+    """Returns the next (shortcode, media) to download if there is room for one in its lane, else None"""
+    with self.lock:
+      for lane in self.lanes:
+        queue = self.queues[lane]
+        while queue and queue[0][1].downloaded(): # recorded meanwhile, e.g. through a repost
+          shortcode, media = queue.popleft()
+          del self.waiting[(shortcode, media.id)]
+        if not queue:
+          continue
+        if self.lane_in_flight[lane] >= self.lane_workers[lane] and \
+            any(self.queues[other] for other in self.lanes if other != lane):
+          continue
+        size = self.__estimate(lane)
+        if self.bytes_in_flight and self.bytes_in_flight + size > self.max_bytes_in_flight:
+          continue
+        shortcode, media = queue.popleft()
+        del self.waiting[(shortcode, media.id)]
+        self.in_flight[(shortcode, media.id)] = (lane, size)
+        self.lane_in_flight[lane] += 1
+        self.bytes_in_flight += size
+        self.changed.notify_all()
+        return shortcode, media
+    return None
+
+  def done(self, shortcode, media):
+    """Frees the room of a download taken before, whether it succeeded or not"""
+    key = (shortcode, media.id)
+    with self.lock:
+      lane, size = self.in_flight.pop(key)
+      self.lane_in_flight[lane] -= 1
+      self.bytes_in_flight -= size
+      if media.downloaded():
+        self.completed[lane][0] += 1
+        self.completed[lane][1] += media.size
+
+  def wait_for_media(self, timeout):
+    """Waits up to timeout seconds for media to be queued. Asserts if there is media waiting"""
+    with self.lock:
+      if not self.__waiting_count():
+        self.changed.wait(timeout)
+      return self.__waiting_count() > 0
+
+  def wait_for_room(self, max_waiting, timeout):
+    """Waits up to timeout seconds for fewer than max_waiting media to be waiting. Asserts if there are"""
+    with self.lock:
+      if self.__waiting_count() >= max_waiting:
+        self.changed.wait(timeout)
+      return self.__waiting_count() < max_waiting
+
+  def __len__(self):
+    """Returns the number of media waiting, not counting those in flight"""
+    with self.lock:
+      return self.__waiting_count()
+
+  def __waiting_count(self):
+    return sum(len(queue) for queue in self.queues.itervalues())
+
+  def __estimate(self, lane):
+    count, total = self.completed[lane]
+    if count:
+      return total // count
+    return DownloadScheduler.SIZE_ESTIMATES.get(lane, DownloadScheduler.SIZE_ESTIMATES['image'])
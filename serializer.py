@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+try:
+  import simplejson
+except ImportError:
+  simplejson = None
+
+# JSON of the manifest, checkpoints, caches and responses, through the fastest backend installed: ujson, then
+# simplejson, then the standard library's json. Values must be plain JSON values, records are converted first with
+# post.as_dict. dumps returns UTF-8 encoded bytes and loads takes bytes or unicode, so nothing is transcoded in between
+# Compact output escapes non-ASCII characters, which keeps the standard library's C encoder on its fast path.
+# Pretty output is indented and keeps them as they are, for reading by people
+
+def _stdlib_dumps(value):
+  return json.dumps(value, separators=(',', ':'))
+
+def _stdlib_pretty(value):
+  return json.dumps(value, indent=2, separators=(',', ': '), ensure_ascii=False)
+
+def _simplejson_dumps(value):
+  return simplejson.dumps(value, separators=(',', ':'))
+
+def _simplejson_pretty(value):
+  return simplejson.dumps(value, indent=2, separators=(',', ': '), ensure_ascii=False)
+
+def _ujson_dumps(value):
+  return ujson.dumps(value, escape_forward_slashes=False)
+
+def _ujson_pretty(value):
+  return ujson.dumps(value, indent=2, escape_forward_slashes=False, ensure_ascii=False)
+
+# name -> (compact dumps, pretty dumps, loads)
+BACKENDS = collections.OrderedDict()
+if ujson:
+  BACKENDS['ujson'] = (_ujson_dumps, _ujson_pretty, ujson.loads)
+if simplejson:
+  BACKENDS['simplejson'] = (_simplejson_dumps, _simplejson_pretty, simplejson.loads)
+BACKENDS['json'] = (_stdlib_dumps, _stdlib_pretty, json.loads)
+
+backend = None
+_dumps = _pretty = _loads = None
+
+def use(name):
+  """Switches every subsequent call to backend of given name, one of BACKENDS"""
+  global backend, _dumps, _pretty, _loads
+  if name not in BACKENDS:
+    raise ValueError('JSON backend {0} is not installed, pick one of {1}'.format(name, ', '.join(BACKENDS)))
+  backend = name
+  _dumps, _pretty, _loads = BACKENDS[name]
+
+def dumps(value, pretty=False):
+  """Returns value as UTF-8 encoded JSON, on one line unless pretty"""
+  encoded = _pretty(value) if pretty else _dumps(value)
+  return encoded.encode('utf-8') if isinstance(encoded, unicode) else encoded
+
+def loads(data):
+  """Returns the value of JSON data, given as UTF-8 encoded bytes or as unicode"""
+  return _loads(data)
+
+def dump(value, f, pretty=False):
+  """Writes value as JSON to binary file f"""
+  f.write(dumps(value, pretty))
+
+def load(f):
+  """Returns the value of the JSON held by binary file f"""
+  return _loads(f.read())
+
+use(next(iter(BACKENDS)))
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+import requests
+
+from scheduler import RateScheduler
+
+logger = logging.getLogger('jinstascrape.session_pool')
+
+class Identity(object):
+  """
+  One requests session with its own cookies, user agent and proxy, paced by its own RateScheduler
+  Keeps counts of its outcomes, and the last HEALTH_WINDOW of them to tell whether it is being throttled
+  """
+  def __init__(self, name, session, scheduler):
+    self.name = name
+    self.session = session
+    self.scheduler = scheduler
+    self.counts = collections.Counter() # outcome -> requests
+    self.recent = collections.deque(maxlen=SessionPool.HEALTH_WINDOW) # True for each unhealthy outcome
+    self.cooling_until = 0
+    self.cooldown_streak = 0 # cooldowns in a row without a healthy window in between
+    self.cooldown_seconds = 0 # spent cooling down in total
+
+  def unhealthy_ratio(self):
+    return sum(self.recent) / float(len(self.recent)) if self.recent else 0.0
+
+class SessionPool(object):
+  """
+  Pool of identities requests are spread across, round robin over those that can take a request right away
+  An identity whose share of HTTP 429, 5xx and dropped connections over its last HEALTH_WINDOW requests exceeds
+  MAX_UNHEALTHY_RATIO is cooled down, taking no requests for COOLDOWN seconds, doubled with every cooldown in a row
+  up to MAX_COOLDOWN. The last identity that is not cooling down never is, so that requests always have one left
+  """
+  HEALTH_WINDOW = 20 # requests
+  MAX_UNHEALTHY_RATIO = 0.25
+  COOLDOWN = 120 # seconds
+  MAX_COOLDOWN = 1800 # seconds
+  OUTCOMES = ['ok', 'throttled', 'error', 'dropped']
+
+  def __init__(self, identities, metrics=None):
+    self.identities = identities
+    self.metrics = metrics
+    self.lock = threading.Lock()
+    self.next_index = 0 # where the next round robin starts
+
+  def acquire(self, url):
+    """
+    Reserves a request slot for url on the next identity that has one
+    Returns (identity, 0) if granted, else (None, seconds to wait before asking again)
+    """
+    with self.lock:
+      now = time.time()
+      delay = None
+      for i in range(len(self.identities)):
+        index = (self.next_index + i) % len(self.identities)
+        identity = self.identities[index]
+        if identity.cooling_until > now:
+          wait = identity.cooling_until - now
+        else:
+          wait = identity.scheduler.acquire(url)
+          if not wait:
+            self.next_index = index + 1
+            return identity, 0
+        delay = wait if delay is None else min(delay, wait)
+      return None, delay
+
+  def record(self, identity, status):
+    """Records the outcome of a request made with identity: its HTTP status, or 'dropped' for a lost connection"""
+    if status == 'dropped':
+      outcome = 'dropped'
+    elif status == 429:
+      outcome = 'throttled'
+    elif status >= 500:
+      outcome = 'error'
+    else:
+      outcome = 'ok' # other client errors, e.g. a deleted post, are no sign of throttling
+    if self.metrics:
+      self.metrics.count('session_requests_total', session=identity.name, outcome=outcome)
+    with self.lock:
+      identity.counts[outcome] += 1
+      identity.recent.append(outcome != 'ok')
+      if len(identity.recent) < SessionPool.HEALTH_WINDOW:
+        return
+      if identity.unhealthy_ratio() <= SessionPool.MAX_UNHEALTHY_RATIO:
+        identity.cooldown_streak = 0
+      elif self.__others_available(identity):
+        self.__cool_down(identity)
+
+  def cooling(self):
+    """Returns the number of identities cooling down"""
+    now = time.time()
+    return sum(identity.cooling_until > now for identity in self.identities)
+
+  def stats(self):
+    """Returns (name, {outcome: requests}, cooldown seconds, cooling) of every identity"""
+    now = time.time()
+    with self.lock:
+      return [
+        (identity.name, dict((outcome, identity.counts[outcome]) for outcome in SessionPool.OUTCOMES),
+          identity.cooldown_seconds, identity.cooling_until > now)
+        for identity in self.identities
+      ]
+
+  def __len__(self):
+    return len(self.identities)
+
+  ######## PRIVATE METHODDS ####################################################
+  def __others_available(self, identity):
+    now = time.time()
+    return any(other is not identity and other.cooling_until <= now for other in self.identities)
+
+  def __cool_down(self, identity):
+    seconds = min(SessionPool.MAX_COOLDOWN, SessionPool.COOLDOWN * 2 ** identity.cooldown_streak)
+    logger.warning('Session %s is being throttled (%d%% of its last %d requests); cooling it down for %ds',
+      identity.name, 100 * identity.unhealthy_ratio(), len(identity.recent), seconds)
+    identity.cooling_until = time.time() + seconds
+    identity.cooldown_streak += 1
+    identity.cooldown_seconds += seconds
+    identity.recent.clear() # judged afresh once back
+    if self.metrics:
+      self.metrics.count('session_cooldowns_total', session=identity.name)
+
+  ######## PUBLIC STATIC METHODS ###############################################
+  @staticmethod
+  def make_session(pool_size, user_agent=None, proxy=None, cookies=None):
+    """
+    Returns a session whose connection pool can serve pool_size concurrent requests per host
+    sending given user agent and cookies (a Cookie header value), through proxy if given
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if user_agent:
+      session.headers['User-Agent'] = user_agent
+    if proxy:
+      session.proxies = {'http': proxy, 'https': proxy}
+    for cookie in (cookies or '').split(';'):
+      name, _, value = cookie.strip().partition('=')
+      if name:
+        session.cookies.set(name, value)
+    return session
+
+  @staticmethod
+  def read_specs(file_path):
+    """
+    Returns the specs of a sessions file, one per line, skipping blank lines and comments starting with #
+    Lines are only stripped of their line break, so that a leading empty field keeps its tab
+    """
+    with open(file_path) as f:
+      lines = [line.rstrip('\r\n') for line in f]
+    return [line for line in lines if line.strip() and not line.strip().startswith('#')]
+
+  @staticmethod
+  def from_specs(specs, pool_size, rate_limits, metrics=None):
+    """
+    Returns a pool of one identity per spec, each paced by its own rate_limits. A spec is a line of
+    user agent, proxy url and cookies separated by tabs, where empty or '-' fields are left out and trailing
+    ones may be omitted. Without specs, the pool holds one identity with the defaults of requests
+    """
+    identities = []
+    for i, spec in enumerate(specs or ['']):
+      fields = [field.strip() for field in spec.split('\t')] + ['', '', '']
+      user_agent, proxy, cookies = [None if field in ('', '-') else field for field in fields[:3]]
+      session = SessionPool.make_session(pool_size, user_agent, proxy, cookies)
+      identities.append(Identity('session{0}'.format(i), session, RateScheduler(rate_limits)))
+    return SessionPool(identities, metrics)
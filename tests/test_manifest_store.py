@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from manifest_store import JournalManifestStore, ManifestStore, open_store
+from post import Post
+from tests.test_post import make_post_dict
+
+def line_count(path):
+  with open(path, 'rb') as f:
+    return sum(1 for _ in f)
+
+class JournalManifestStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'manifest.jsonl')
+    self.min_compaction_records = JournalManifestStore.MIN_COMPACTION_RECORDS
+
+  def tearDown(self):
+    JournalManifestStore.MIN_COMPACTION_RECORDS = self.min_compaction_records
+    shutil.rmtree(self.directory)
+
+  def commit_posts(self, store, manifest, shortcodes, likes=0):
+    for shortcode in shortcodes:
+      post = make_post_dict(shortcode)
+      post['likes']['count'] = likes
+      manifest[shortcode] = Post.from_dict(post)
+    store.commit(manifest, shortcodes)
+
+  def test_open_store(self):
+    self.assertIsInstance(open_store(self.path), JournalManifestStore)
+    self.assertNotIsInstance(open_store(os.path.join(self.directory, 'manifest.json')), JournalManifestStore)
+
+  def test_later_lines_supersede_earlier_ones(self):
+    store = open_store(self.path)
+    manifest = {}
+    self.commit_posts(store, manifest, ['a', 'b'])
+    self.commit_posts(store, manifest, ['a'], likes=5)
+    self.assertEqual(line_count(self.path), 3)
+
+    store = open_store(self.path)
+    loaded = store.load(Post.from_dict)
+    self.assertEqual(sorted(loaded), ['a', 'b'])
+    self.assertEqual(loaded['a'].likes.count, 5)
+    self.assertEqual(store.record_count, 3)
+    self.assertEqual(
+      sorted((post['shortcode'], post['likes']['count']) for post in store.iter_posts()),
+      [('a', 5), ('b', 0)]
+    )
+
+  def test_torn_last_line_is_discarded(self):
+    store = open_store(self.path)
+    manifest = {}
+    self.commit_posts(store, manifest, ['a', 'b'])
+    intact_size = os.path.getsize(self.path)
+    with open(self.path, 'ab') as f:
+      f.write(JournalManifestStore.encode_post(make_post_dict('c'))[:40]) # crash mid-commit
+
+    store = open_store(self.path)
+    self.assertEqual(sorted(post['shortcode'] for post in store.iter_posts()), ['a', 'b'])
+    loaded = store.load(Post.from_dict)
+    self.assertEqual(sorted(loaded), ['a', 'b'])
+    self.assertEqual(os.path.getsize(self.path), intact_size) # truncated to the last complete line
+
+    self.commit_posts(store, loaded, ['c'])
+    self.assertEqual(sorted(open_store(self.path).load()), ['a', 'b', 'c'])
+
+  def test_compaction(self):
+    JournalManifestStore.MIN_COMPACTION_RECORDS = 10
+    store = open_store(self.path)
+    manifest = {}
+    self.commit_posts(store, manifest, ['a', 'b', 'c'])
+    for likes in range(1, 3):
+      self.commit_posts(store, manifest, ['a', 'b', 'c'], likes)
+    self.assertEqual(line_count(self.path), 9) # under MIN_COMPACTION_RECORDS
+    inode = os.stat(self.path).st_ino
+
+    self.commit_posts(store, manifest, ['a'], likes=3)
+    self.assertEqual(line_count(self.path), 3) # 10 lines for 3 posts, over COMPACTION_RATIO
+    self.assertEqual(store.record_count, 3)
+    self.assertNotEqual(os.stat(self.path).st_ino, inode) # replaced atomically
+    self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    loaded = open_store(self.path).load(Post.from_dict)
+    self.assertEqual(dict((shortcode, post.likes.count) for shortcode, post in loaded.iteritems()),
+      {'a': 3, 'b': 2, 'c': 2})
+
+  def test_checkpoints(self):
+    store = open_store(self.path)
+    self.assertEqual(store.load_checkpoints(), {})
+    checkpoints = {'hashtag:sunset': {'end_cursor': 'QVFE', 'page_count': 3}}
+    store.commit_checkpoints(checkpoints)
+    self.assertEqual(open_store(self.path).load_checkpoints(), checkpoints)
+
+class ManifestStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    for pretty in [False, True]:
+      path = os.path.join(self.directory, 'manifest{0}.json'.format(int(pretty)))
+      store = open_store(path, pretty)
+      manifest = dict((shortcode, Post.from_dict(make_post_dict(shortcode))) for shortcode in ['a', 'b'])
+      store.commit(manifest, ['a', 'b'])
+      self.assertEqual(open_store(path).load(Post.from_dict), manifest)
+      self.assertEqual(sorted(post['shortcode'] for post in open_store(path).iter_posts()), ['a', 'b'])
+
+  def test_failed_write_keeps_the_previous_file(self):
+    path = os.path.join(self.directory, 'file')
+    with ManifestStore.atomic_writer(path) as f:
+      f.write('before')
+    with self.assertRaises(ValueError):
+      with ManifestStore.atomic_writer(path) as f:
+        f.write('after')
+        raise ValueError()
+    with open(path, 'rb') as f:
+      self.assertEqual(f.read(), 'before')
+    self.assertFalse(os.path.exists(path + '.tmp'))
+
+if __name__ == '__main__':
+  unittest.main()
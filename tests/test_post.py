@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import copy
+import pickle
+import unittest
+
+from post import MediaItem, Owner, Post, as_dict
+
+def make_post_dict(shortcode='BK82TOvDYI-'):
+  """Returns a post as JinstaScrape.process_post writes it to manifest"""
+  return {
+    '__typename': 'GraphSidecar',
+    'id': '1337',
+    'shortcode': shortcode,
+    'is_video': False,
+    'taken_at_timestamp': 1500000000,
+    'last_scraped_at': 1500000100.5,
+    'is_ad': False,
+    'location': {'id': '42', 'name': u'Zürich', 'slug': 'zurich', 'has_public_page': True},
+    'owner': {
+      'id': '7', 'profile_pic_url': 'https://example.com/7.jpg', 'username': 'someone', 'full_name': 'Some One',
+      'is_private': False, 'is_unpublished': False, 'is_verified': False
+    },
+    'media_items': [
+      {
+        '__typename': 'GraphImage', 'shortcode': shortcode + '0', 'id': '1', 'url': 'https://example.com/a.jpg',
+        'downloaded_path': '', 'tagged_users': [{'user': {'username': 'other'}, 'x': 0.5, 'y': 0.5}]
+      },
+      {
+        '__typename': 'GraphVideo', 'shortcode': shortcode + '1', 'id': '2', 'url': 'https://example.com/b.mp4',
+        'downloaded_path': 'downloads/objects/ab/cd/abcd.mp4', 'downloaded_at': '2018-01-01 00:00:00',
+        'size': 1024, 'sha256': 'abcd', 'tagged_users': []
+      }
+    ],
+    'caption': {'text': u'Sunset #sunset #zürich', 'caption_is_edited': False},
+    'tags': ['sunset', u'zürich'],
+    'comments': {
+      'count': 1, 'has_next_page': False, 'end_cursor': None, 'comments_disabled': False,
+      'entries': [{'id': '9', 'text': 'nice', 'created_at': 1500000050, 'owner': {'id': '8', 'username': 'fan'}}]
+    },
+    'likes': {'count': 3, 'entries': []},
+    'etag': '"abc"',
+    'last_modified': 'Mon, 01 Jan 2018 00:00:00 GMT'
+  }
+
+class RecordTest(unittest.TestCase):
+  def test_round_trip(self):
+    d = make_post_dict()
+    post = Post.from_dict(copy.deepcopy(d))
+    self.assertEqual(post.to_dict(), d)
+    self.assertIsNone(post.extra)
+    self.assertEqual(post.media_items[1].size, 1024)
+    self.assertEqual(post.location.name, u'Zürich')
+
+  def test_extra_keys_are_kept(self):
+    d = make_post_dict()
+    d['edge_media_to_sponsor_user'] = {'edges': []}
+    d['media_items'][0]['accessibility_caption'] = 'A sunset'
+    post = Post.from_dict(copy.deepcopy(d))
+    self.assertEqual(post.to_dict(), d)
+    self.assertEqual(post.extra, {'edge_media_to_sponsor_user': {'edges': []}})
+    self.assertEqual(post.media_items[0].extra, {'accessibility_caption': 'A sunset'})
+
+  def test_missing_optional_keys_are_left_out(self):
+    d = make_post_dict()
+    del d['etag']
+    del d['last_modified']
+    del d['caption']['caption_is_edited']
+    post = Post.from_dict(copy.deepcopy(d))
+    self.assertEqual(post.to_dict(), d)
+    self.assertFalse(hasattr(post, 'etag'))
+
+  def test_missing_required_keys_are_left_out(self):
+    d = make_post_dict()
+    del d['is_ad']
+    del d['media_items'][0]['downloaded_path']
+    post = Post.from_dict(copy.deepcopy(d))
+    self.assertEqual(post.to_dict(), d)
+    self.assertFalse(hasattr(post, 'is_ad'))
+
+  def test_null_nested_records(self):
+    d = make_post_dict()
+    d['location'] = None
+    d['caption'] = None
+    post = Post.from_dict(copy.deepcopy(d))
+    self.assertIsNone(post.location)
+    self.assertEqual(post.to_dict(), d)
+
+  def test_equal_owners_are_shared(self):
+    first = Post.from_dict(make_post_dict('a'))
+    second = Post.from_dict(make_post_dict('b'))
+    self.assertIs(first.owner, second.owner)
+    d = make_post_dict('c')
+    d['owner']['biography'] = 'Not shared' # an extra key
+    third = Post.from_dict(d)
+    self.assertIsNot(third.owner, first.owner)
+    self.assertEqual(third.owner.to_dict(), d['owner'])
+
+  def test_equality_and_pickle(self):
+    post = Post.from_dict(make_post_dict())
+    self.assertEqual(post, Post.from_dict(make_post_dict()))
+    self.assertNotEqual(post, Post.from_dict(make_post_dict('other')))
+    self.assertEqual(pickle.loads(pickle.dumps(post, pickle.HIGHEST_PROTOCOL)), post)
+
+  def test_downloaded(self):
+    post = Post.from_dict(make_post_dict())
+    self.assertFalse(post.media_items[0].downloaded())
+    self.assertTrue(post.media_items[1].downloaded())
+    d = make_post_dict()['media_items'][1]
+    del d['size'] # recorded by an earlier version, which did not check sizes
+    self.assertFalse(MediaItem.from_dict(d).downloaded())
+
+  def test_as_dict(self):
+    d = make_post_dict()
+    self.assertEqual(as_dict(Post.from_dict(copy.deepcopy(d))), d)
+    self.assertIs(as_dict(d), d)
+    self.assertIsInstance(Owner.from_dict(d['owner']), Owner)
+
+if __name__ == '__main__':
+  unittest.main()
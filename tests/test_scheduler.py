@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+import concurrent.futures
+
+from post import MediaItem
+from scheduler import DownloadScheduler, RateScheduler, RequestDeferred, RequeueingExecutor, TokenBucket
+
+def make_media(i, typename='GraphImage'):
+  return MediaItem.from_dict({
+    '__typename': typename, 'shortcode': 's{0}'.format(i), 'id': str(i), 'url': 'https://example.com/{0}'.format(i),
+    'downloaded_path': '', 'tagged_users': []
+  })
+
+class TokenBucketTest(unittest.TestCase):
+  def test_burst_then_refill(self):
+    bucket = TokenBucket(2, 3)
+    bucket.updated_at = 100
+    self.assertEqual([bucket.acquire(100) for _ in range(3)], [0, 0, 0])
+    self.assertAlmostEqual(bucket.acquire(100), 0.5)
+    self.assertAlmostEqual(bucket.acquire(100.25), 0.25) # half a token refilled
+    self.assertEqual(bucket.acquire(100.5), 0)
+    self.assertEqual([bucket.acquire(1000) for _ in range(4)][-1], 0.5) # refills up to capacity only
+
+  def test_pause(self):
+    bucket = TokenBucket(2, 3)
+    bucket.updated_at = 100
+    bucket.pause(100, 10)
+    self.assertEqual(bucket.acquire(105), 5)
+    bucket.pause(105, 1) # does not shorten a longer pause
+    self.assertEqual(bucket.acquire(109), 1)
+    self.assertAlmostEqual(bucket.acquire(110), 0.5) # refills from empty
+    self.assertEqual(bucket.acquire(110.5), 0)
+
+class RateSchedulerTest(unittest.TestCase):
+  def test_budget_for(self):
+    self.assertEqual(RateScheduler.budget_for('https://www.instagram.com/graphql/query/?query_hash=x'),
+      ('graphql', 'www.instagram.com'))
+    self.assertEqual(RateScheduler.budget_for('https://www.instagram.com/p/BK82TOvDYI-/?__a=1'),
+      ('post', 'www.instagram.com'))
+    self.assertEqual(RateScheduler.budget_for('https://scontent.cdninstagram.com/a.jpg'),
+      ('media', 'scontent.cdninstagram.com'))
+
+  def test_buckets_per_budget_and_host(self):
+    scheduler = RateScheduler({'graphql': (0.001, 1), 'post': (0.001, 1), 'media': (0.001, 1)})
+    self.assertEqual(scheduler.acquire('https://a.com/graphql/query/'), 0)
+    self.assertGreater(scheduler.acquire('https://a.com/graphql/query/'), 0)
+    self.assertEqual(scheduler.acquire('https://a.com/p/x/?__a=1'), 0)
+    self.assertEqual(scheduler.acquire('https://b.com/graphql/query/'), 0)
+    scheduler.pause('https://c.com/a.jpg', 60)
+    self.assertGreater(scheduler.acquire('https://c.com/b.jpg'), 59)
+
+class RequeueingExecutorTest(unittest.TestCase):
+  def setUp(self):
+    self.executor = concurrent.futures.ThreadPoolExecutor(2)
+    self.results = {}
+    self.errors = {}
+    self.cancelled = []
+    self.calls = []
+    self.lock = threading.Lock()
+
+  def tearDown(self):
+    self.executor.shutdown()
+
+  def requeueing_executor(self, max_pending=2):
+    return RequeueingExecutor(self.executor, max_pending, self.results.__setitem__, self.errors.__setitem__, self.cancelled.append)
+
+  def task(self, key, retry_count):
+    with self.lock:
+      self.calls.append((key, retry_count))
+    if key == 'fails':
+      raise ValueError(key)
+    if key.startswith('deferred') and retry_count == 0:
+      raise RequestDeferred(0.05, retry_count + 1)
+    return key, retry_count
+
+  def test_deferred_tasks_are_requeued(self):
+    executor = self.requeueing_executor()
+    for key in ['deferred', 'plain', 'fails']:
+      executor.submit(self.task, key, poll_interval=0.01)
+    executor.drain(poll_interval=0.01)
+    self.assertEqual(len(executor), 0)
+    self.assertEqual(self.results, {'deferred': ('deferred', 1), 'plain': ('plain', 0)})
+    self.assertEqual(self.errors.keys(), ['fails'])
+    self.assertEqual(sorted(self.calls), [('deferred', 0), ('deferred', 1), ('fails', 0), ('plain', 0)])
+    self.assertEqual(self.cancelled, [])
+
+  def test_failures_are_raised_without_on_error(self):
+    executor = RequeueingExecutor(self.executor, 2, self.results.__setitem__)
+    executor.submit(self.task, 'fails')
+    with self.assertRaises(ValueError):
+      executor.drain()
+
+  def test_submit_waits_while_saturated(self):
+    executor = self.requeueing_executor(max_pending=1)
+    executor.submit(self.task, 'a')
+    self.assertTrue(executor.saturated())
+    executor.submit(self.task, 'b')
+    self.assertEqual(self.results.keys(), ['a'])
+    executor.drain()
+    self.assertEqual(sorted(self.results), ['a', 'b'])
+
+  def test_cancel(self):
+    started = threading.Event()
+    release = threading.Event()
+    def blocking(key, retry_count):
+      started.set()
+      release.wait()
+    executor = self.requeueing_executor()
+    executor.submit(self.task, 'deferred')
+    while not executor.deferred:
+      executor.wait(0.01)
+    executor.submit(blocking, 'running')
+    started.wait()
+    executor.cancel()
+    release.set()
+    self.assertEqual(sorted(self.cancelled), ['deferred', 'running'])
+    self.assertEqual(len(executor), 0)
+    executor.drain()
+    self.assertEqual(self.results, {})
+
+class DownloadSchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.scheduler = DownloadScheduler([('video', 1), ('image', 2)], 20 << 20)
+
+  def add(self, i, lane):
+    media = make_media(i, 'GraphVideo' if lane == 'video' else 'GraphImage')
+    self.scheduler.add(media.shortcode, media, lane)
+    return media
+
+  def take_all(self):
+    taken = []
+    while True:
+      entry = self.scheduler.take()
+      if entry is None:
+        return taken
+      taken.append(entry[1].id)
+
+  def test_lanes_keep_to_their_workers_while_other_lanes_wait(self):
+    videos = [self.add(i, 'video') for i in range(2)]
+    images = [self.add(i, 'image') for i in range(10, 13)]
+    self.assertEqual(len(self.scheduler), 5)
+    self.assertEqual(self.take_all(), ['0', '10', '11'])
+    self.assertEqual(self.scheduler.lane_in_flight, {'video': 1, 'image': 2})
+    self.scheduler.done(images[0].shortcode, images[0])
+    self.assertEqual(self.take_all(), ['12', '1']) # once no image waits, the video lane may grow
+    self.assertEqual(self.scheduler.lane_in_flight, {'video': 2, 'image': 2})
+    self.assertEqual(self.scheduler.bytes_in_flight, 2 * (8 << 20) + 2 * (256 << 10))
+    self.assertEqual(len(self.scheduler), 0)
+    self.assertEqual(sorted(self.scheduler.in_flight), sorted((item.shortcode, item.id) for item in videos + images[1:]))
+
+  def test_bytes_in_flight_are_capped(self):
+    scheduler = DownloadScheduler([('video', 4)], 10 << 20)
+    media = [make_media(i, 'GraphVideo') for i in range(3)]
+    for item in media:
+      scheduler.add(item.shortcode, item, 'video')
+    self.assertEqual(scheduler.take()[1], media[0])
+    self.assertIsNone(scheduler.take()) # 16MB would be over the cap
+    scheduler.done(media[0].shortcode, media[0]) # failed
+    self.assertEqual((scheduler.bytes_in_flight, scheduler.completed['video']), (0, [0, 0]))
+    self.assertEqual(scheduler.take()[1], media[1])
+
+  def test_first_download_is_taken_whatever_its_size(self):
+    scheduler = DownloadScheduler([('video', 1)], 1 << 20)
+    media = make_media(0, 'GraphVideo')
+    scheduler.add(media.shortcode, media, 'video')
+    self.assertEqual(scheduler.take()[1], media)
+
+  def test_estimates_follow_completed_downloads(self):
+    media = [self.add(i, 'image') for i in range(3)]
+    self.assertEqual(len(self.take_all()), 3)
+    for item, size in zip(media[:2], [1000, 3000]):
+      item.downloaded_path = 'downloads/objects/{0}'.format(item.id)
+      item.size = size
+      self.scheduler.done(item.shortcode, item)
+    self.assertEqual(self.scheduler.completed['image'], [2, 4000])
+    self.assertEqual(self.scheduler.bytes_in_flight, 256 << 10)
+    self.add(3, 'image')
+    self.take_all()
+    self.assertEqual(self.scheduler.bytes_in_flight, (256 << 10) + 2000)
+    self.assertEqual(self.scheduler.in_flight[('s3', '3')], ('image', 2000))
+
+  def test_add_skips_media_downloaded_or_in_flight(self):
+    media = self.add(0, 'image')
+    self.scheduler.add(media.shortcode, media, 'image')
+    self.assertEqual(len(self.scheduler), 1)
+    self.take_all()
+    self.add(0, 'image') # in flight
+    downloaded = make_media(1)
+    downloaded.downloaded_path = 'downloads/objects/1'
+    downloaded.size = 1
+    self.scheduler.add(downloaded.shortcode, downloaded, 'image')
+    self.assertEqual(len(self.scheduler), 0)
+
+  def test_waiting_media_is_replaced_by_its_latest_version(self):
+    self.add(0, 'image')
+    latest = self.add(0, 'image')
+    self.assertEqual(len(self.scheduler), 1)
+    self.assertIs(self.scheduler.take()[1], latest)
+
+  def test_take_skips_media_downloaded_meanwhile(self):
+    media = self.add(0, 'image')
+    self.add(1, 'image')
+    media.downloaded_path = 'downloads/objects/0'
+    media.size = 1
+    self.assertEqual(self.take_all(), ['1'])
+    self.assertEqual(self.scheduler.waiting, {})
+
+  def test_waits(self):
+    self.assertFalse(self.scheduler.wait_for_media(0.01))
+    self.assertTrue(self.scheduler.wait_for_room(1, 0.01))
+    self.add(0, 'image')
+    self.assertTrue(self.scheduler.wait_for_media(0.01))
+    self.assertFalse(self.scheduler.wait_for_room(1, 0.01))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from post import Post
+from tests.test_post import make_post_dict
+from work_queue import WorkQueue
+
+QUERIES = [('hashtag:a', 'hashtag', 'a'), ('hashtag:b', 'hashtag', 'b')]
+
+class WorkQueueTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'queue.db')
+    self.queue = WorkQueue(self.path)
+    self.queue.enqueue(QUERIES, {'hashtag:b': {'end_cursor': 'QVFE', 'page_count': 2}})
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def expire_leases(self):
+    with self.queue.transaction() as db:
+      db.execute("UPDATE tasks SET lease_expires = 0 WHERE state = 'leased'")
+
+  def test_leases_queries_in_order_from_their_checkpoints(self):
+    self.assertEqual(self.queue.lease('w1'), ('hashtag', 'a', {'end_cursor': '', 'page_count': 0}))
+    self.assertEqual(self.queue.lease('w2'), ('hashtag', 'b', {'end_cursor': 'QVFE', 'page_count': 2}))
+    self.assertIsNone(self.queue.lease('w3'))
+    self.assertEqual(self.queue.progress(), (0, 2))
+
+  def test_expired_lease_is_taken_over_from_its_last_checkpoint(self):
+    self.queue.lease('w1')
+    self.queue.store('w1').commit_checkpoints({'hashtag:a': {'end_cursor': 'page2', 'page_count': 1}})
+    self.queue.lease('w2')
+    self.assertIsNone(self.queue.lease('w3')) # leases are live
+
+    self.expire_leases()
+    self.assertEqual(self.queue.lease('w3'), ('hashtag', 'a', {'end_cursor': 'page2', 'page_count': 1}))
+    self.queue.complete('hashtag:a', 'w1') # too late, w3 holds it now
+    self.assertEqual(self.queue.progress(), (0, 2))
+    self.queue.store('w1').commit_checkpoints({'hashtag:a': {'end_cursor': 'stale', 'page_count': 9}})
+    self.assertEqual(self.queue.checkpoints()['hashtag:a'], {'end_cursor': 'page2', 'page_count': 1})
+
+    self.queue.complete('hashtag:a', 'w3')
+    self.assertEqual(self.queue.progress(), (1, 2))
+
+  def test_commits_renew_leases(self):
+    self.queue.lease('w1')
+    self.expire_leases()
+    self.queue.store('w1').commit_checkpoints({})
+    self.assertEqual(self.queue.lease('w2'), ('hashtag', 'b', {'end_cursor': 'QVFE', 'page_count': 2}))
+    self.assertIsNone(self.queue.lease('w3'))
+
+  def test_released_query_is_leased_again(self):
+    self.queue.lease('w1')
+    self.queue.release('hashtag:a', 'w1')
+    self.assertEqual(self.queue.lease('w2')[1], 'a')
+
+  def test_claims(self):
+    self.queue.mark_scraped(['old'])
+    self.assertIsNone(self.queue.claim('old', 'w1'))
+    self.assertTrue(self.queue.claim('new', 'w1'))
+    self.assertFalse(self.queue.claim('new', 'w2'))
+    self.queue.unclaim('new')
+    self.assertTrue(self.queue.claim('new', 'w2'))
+
+  def test_claims_of_an_expired_worker_are_dropped_on_takeover(self):
+    self.queue.lease('w1')
+    self.assertTrue(self.queue.claim('x', 'w1'))
+    self.assertEqual(self.queue.claimed(['x']), set(['x']))
+    self.expire_leases()
+    self.assertEqual(self.queue.claimed(['x']), set()) # no live lease behind it
+    self.queue.lease('w2')
+    self.assertTrue(self.queue.claim('x', 'w2'))
+
+  def test_claims_are_dropped_with_the_last_lease(self):
+    self.queue.lease('w1')
+    self.queue.lease('w1')
+    self.assertTrue(self.queue.claim('x', 'w1'))
+    self.queue.release('hashtag:a', 'w1')
+    self.assertFalse(self.queue.claim('x', 'w2')) # w1 still pages hashtag:b
+    self.queue.release('hashtag:b', 'w1')
+    self.assertTrue(self.queue.claim('x', 'w2'))
+
+  def test_results(self):
+    self.queue.lease('w1')
+    self.queue.claim('p', 'w1')
+    manifest = {'p': Post.from_dict(make_post_dict('p'))}
+    self.queue.store('w1').commit(manifest, ['p'])
+    self.assertEqual(manifest, {}) # the coordinator owns it from now on
+    self.assertIsNone(self.queue.claim('p', 'w2'))
+    self.assertEqual(self.queue.take_results(10), [make_post_dict('p')])
+    self.assertEqual(self.queue.take_results(10), [])
+
+  def test_enqueue_drops_queries_not_asked_for(self):
+    self.queue.lease('w1')
+    self.queue.enqueue([('hashtag:b', 'hashtag', 'b'), ('location:1', 'location', '1')], {})
+    self.assertEqual(self.queue.progress(), (0, 2))
+    self.assertEqual(self.queue.lease('w2')[:2], ('hashtag', 'b'))
+    self.assertEqual(self.queue.lease('w2')[:2], ('location', '1'))
+
+  def test_claims_of_an_earlier_version_are_migrated(self):
+    path = os.path.join(self.directory, 'old.db')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE claims (shortcode TEXT PRIMARY KEY, scraped INTEGER)')
+    db.execute("INSERT INTO claims VALUES ('old', 1)")
+    db.commit()
+    db.close()
+    queue = WorkQueue(path)
+    self.assertIsNone(queue.claim('old', 'w1'))
+    self.assertTrue(queue.claim('new', 'w1'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import sqlite3
+import threading
+import time
+
+import serializer
+
+from post import as_dict
+
+class WorkQueue(object):
+  """
+  SQLite-backed queue shared by a coordinator and its workers, possibly on several machines via shared storage
+  Holds three tables:
+    tasks    one row per query with its pagination checkpoint, handed out to workers under a renewable lease
+    claims   one row per post that is scraped or being fetched, so that a post is only fetched once across workers
+             a claim being fetched names its worker, and is dropped once that worker lets go of its leases
+    results  processed posts sent back by workers until the coordinator merges them into its manifest
+  A worker that stops renewing its leases, e.g. because it crashed, loses them after LEASE_SECONDS, and the
+  query is resumed from its last checkpoint by whichever worker leases it next
+  """
+  LEASE_SECONDS = 1800
+  BUSY_TIMEOUT = 60 # seconds to wait for another process' write lock
+
+  def __init__(self, path):
+    self.path = path
+    self.local = threading.local() # one connection per thread
+    with self.transaction() as db:
+      db.execute('''CREATE TABLE IF NOT EXISTS tasks (
+        query_key TEXT PRIMARY KEY, query_type TEXT, query_value TEXT, end_cursor TEXT, page_count INTEGER,
+        state TEXT, worker TEXT, lease_expires REAL)''')
+      db.execute('CREATE TABLE IF NOT EXISTS claims (shortcode TEXT PRIMARY KEY, scraped INTEGER, worker TEXT)')
+      if 'worker' not in [column[1] for column in db.execute('PRAGMA table_info(claims)')]: # queue of an earlier version
+        db.execute('ALTER TABLE claims ADD COLUMN worker TEXT')
+      db.execute('CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, shortcode TEXT, post TEXT)')
+
+  ######## COORDINATOR #########################################################
+  def enqueue(self, queries, checkpoints):
+    """
+    Queues (query key, query type, query value) queries that are not queued yet, starting from their checkpoint if any
+    Queries completed by an earlier run are queued again, so that they are paged from their newest posts
+    Queries left by an earlier run that are not among given ones are dropped, whatever their state
+    """
+    with self.transaction() as db:
+      db.execute("DELETE FROM tasks WHERE state = 'done'")
+      db.execute('CREATE TEMP TABLE IF NOT EXISTS queued_keys (query_key TEXT PRIMARY KEY)')
+      db.execute('DELETE FROM queued_keys')
+      db.executemany('INSERT OR IGNORE INTO queued_keys VALUES (?)', ((query[0],) for query in queries))
+      db.execute('DELETE FROM tasks WHERE query_key NOT IN (SELECT query_key FROM queued_keys)')
+      for query_key, query_type, query_value in queries:
+        checkpoint = checkpoints.get(query_key, {'end_cursor': '', 'page_count': 0})
+        db.execute("INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, 'pending', NULL, 0)",
+          (query_key, query_type, query_value, checkpoint['end_cursor'], checkpoint['page_count']))
+
+  def mark_scraped(self, shortcodes):
+    """Records posts of given shortcodes as scraped, so that workers do not fetch them again"""
+    with self.transaction() as db:
+      db.executemany('INSERT OR REPLACE INTO claims (shortcode, scraped) VALUES (?, 1)', ((shortcode,) for shortcode in shortcodes))
+
+  def take_results(self, limit):
+    """Removes and returns up to limit posts sent back by workers, oldest first"""
+    with self.transaction() as db:
+      rows = db.execute('SELECT id, post FROM results ORDER BY id LIMIT ?', (limit,)).fetchall()
+      if rows:
+        db.execute('DELETE FROM results WHERE id <= ?', (rows[-1][0],))
+    return [serializer.loads(post) for _, post in rows]
+
+  def checkpoints(self):
+    """Returns the pagination checkpoints of unfinished queries, keyed by query"""
+    rows = self.connection().execute("SELECT query_key, end_cursor, page_count FROM tasks WHERE state != 'done'")
+    return {
+      query_key: {'end_cursor': end_cursor, 'page_count': page_count}
+      for query_key, end_cursor, page_count in rows
+      if end_cursor
+    }
+
+  def progress(self):
+    """Returns (completed queries, total queries)"""
+    return self.connection().execute("SELECT SUM(state = 'done'), COUNT(*) FROM tasks").fetchone()
+
+  ######## WORKER ##############################################################
+  def lease(self, worker):
+    """
+    Leases the next pending query, or one whose lease expired, to worker
+    Taking over an expired lease drops the claims of the worker that held it, whose fetches died with it
+    Returns (query type, query value, checkpoint) or None if there is none
+    """
+    with self.transaction() as db:
+      row = db.execute(
+        "SELECT query_key, query_type, query_value, end_cursor, page_count, worker FROM tasks "
+        "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) ORDER BY rowid LIMIT 1",
+        (time.time(),)
+      ).fetchone()
+      if row is None:
+        return None
+      query_key, query_type, query_value, end_cursor, page_count, previous_worker = row
+      if previous_worker is not None: # leases of a worker are renewed together, so all of them expired
+        db.execute('DELETE FROM claims WHERE worker = ? AND scraped = 0', (previous_worker,))
+      db.execute("UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ? WHERE query_key = ?",
+        (worker, time.time() + WorkQueue.LEASE_SECONDS, query_key))
+    return query_type, query_value, {'end_cursor': end_cursor, 'page_count': page_count}
+
+  def release(self, query_key, worker):
+    """
+    Hands an unfinished query leased by worker back to the queue
+    Claims of worker are dropped along with its last lease, once none of its queries has fetches left in flight
+    """
+    with self.transaction() as db:
+      db.execute("UPDATE tasks SET state = 'pending', worker = NULL WHERE query_key = ? AND worker = ?", (query_key, worker))
+      if not db.execute("SELECT COUNT(*) FROM tasks WHERE worker = ? AND state = 'leased'", (worker,)).fetchone()[0]:
+        db.execute('DELETE FROM claims WHERE worker = ? AND scraped = 0', (worker,))
+
+  def complete(self, query_key, worker):
+    """Marks a query leased by worker as paged through"""
+    with self.transaction() as db:
+      db.execute("UPDATE tasks SET state = 'done', worker = NULL WHERE query_key = ? AND worker = ?", (query_key, worker))
+
+  def claim(self, shortcode, worker):
+    """
+    Claims the fetch of post with given shortcode for worker
+    Returns None if it has been scraped, False if it is already claimed, else True
+    """
+    with self.transaction() as db:
+      if db.execute('INSERT OR IGNORE INTO claims VALUES (?, 0, ?)', (shortcode, worker)).rowcount:
+        return True
+      scraped, = db.execute('SELECT scraped FROM claims WHERE shortcode = ?', (shortcode,)).fetchone()
+    return None if scraped else False
+
+  def unclaim(self, shortcode):
+    """Gives up a claim whose fetch failed, so that another query may try again"""
+    with self.transaction() as db:
+      db.execute('DELETE FROM claims WHERE shortcode = ? AND scraped = 0', (shortcode,))
+
+  def claimed(self, shortcodes):
+    """Returns those of given shortcodes whose posts are being fetched by a worker that still holds a lease"""
+    shortcodes = list(shortcodes)
+    rows = self.connection().execute(
+      "SELECT shortcode FROM claims WHERE scraped = 0 AND shortcode IN ({0}) AND worker IN "
+      "(SELECT worker FROM tasks WHERE state = 'leased' AND lease_expires >= ?)".format(', '.join('?' * len(shortcodes))),
+      shortcodes + [time.time()]
+    )
+    return set(shortcode for shortcode, in rows)
+
+  def store(self, worker):
+    """Returns a manifest store through which worker sends back its posts and checkpoints"""
+    return WorkerStore(self, worker)
+
+  ######## CONNECTIONS #########################################################
+  def connection(self):
+    """Returns this thread's connection to the queue, in autocommit mode"""
+    if not hasattr(self.local, 'connection'):
+      self.local.connection = sqlite3.connect(self.path, timeout=WorkQueue.BUSY_TIMEOUT, isolation_level=None)
+    return self.local.connection
+
+  @contextlib.contextmanager
+  def transaction(self):
+    """Runs the block in a transaction that takes the write lock up front, and commits it unless the block raises"""
+    db = self.connection()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+      yield db
+    except:
+      db.execute('ROLLBACK')
+      raise
+    db.execute('COMMIT')
+
+class WorkerStore(object):
+  """
+  Manifest store of a worker, which sends its posts and checkpoints back to the queue rather than keeping them
+  Posts are dropped from the worker's manifest once sent, the coordinator owns them from then on
+  Every commit renews the leases of the worker
+  """
+  def __init__(self, work_queue, worker):
+    self.work_queue = work_queue
+    self.worker = worker
+
+  def load(self, post_factory=None):
+    return {}
+
+  def load_checkpoints(self):
+    return {}
+
+  def commit(self, manifest, shortcodes):
+    with self.work_queue.transaction() as db:
+      for shortcode in shortcodes:
+        db.execute('INSERT INTO results (shortcode, post) VALUES (?, ?)', (shortcode, serializer.dumps(as_dict(manifest[shortcode])).decode('utf-8')))
+        db.execute('INSERT OR REPLACE INTO claims (shortcode, scraped) VALUES (?, 1)', (shortcode,))
+      self.__renew_leases(db)
+    for shortcode in shortcodes:
+      del manifest[shortcode]
+
+  def commit_checkpoints(self, checkpoints):
+    with self.work_queue.transaction() as db:
+      for query_key, checkpoint in checkpoints.iteritems():
+        db.execute("UPDATE tasks SET end_cursor = ?, page_count = ? WHERE query_key = ? AND worker = ? AND state = 'leased'",
+          (checkpoint['end_cursor'], checkpoint['page_count'], query_key, self.worker))
+      self.__renew_leases(db)
+
+  def __renew_leases(self, db):
+    db.execute("UPDATE tasks SET lease_expires = ? WHERE worker = ? AND state = 'leased'",
+      (time.time() + WorkQueue.LEASE_SECONDS, self.worker))